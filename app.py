@@ -1,19 +1,41 @@
 # app.py — FinApp (UI clara + tabelas visíveis + botões corrigidos + avisos 3s + valor digitável + CONFIGURAÇÕES + AGENDA PÚBLICA/PRIVADA)
 # Execução: streamlit run app.py
 # Requisitos: streamlit, pandas, openpyxl
-# Opcionais: yfinance (dólar) e plotly (gráficos)
+# Opcionais: yfinance (dólar), plotly (gráficos), Pillow e pypdfium2 (prévias de anexos)
 
+import io
 import os
+import csv
 import time
+import queue
 import hashlib
+import secrets
+import unicodedata
+import itertools
 import sqlite3
+import tempfile
+import threading
 from io import BytesIO
-from datetime import date, datetime, timedelta
-from typing import Optional, Tuple, List
-
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple, List, Callable, Any, Iterable
+
+import numpy as np
 import pandas as pd
 import streamlit as st
+import re
+import json
+import html
+import logging
 import urllib.parse as urlparse
+import urllib.request as urlrequest
+from bisect import bisect_left, bisect_right
 from calendar import monthrange
 
 # ======== USD opcional ========
@@ -30,12 +52,60 @@ except Exception:
     px = None
     go = None
 
+# ======== Prévias de anexos (opcional) ========
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = ImageOps = None
+try:
+    import pypdfium2 as pdfium
+except Exception:
+    pdfium = None
+
 # ---------------------- Constantes ----------------------
 BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, "finapp.db")
+DB_PATH = os.environ.get("FINAPP_DB_PATH") or os.path.join(BASE_DIR, "finapp.db")   # outro arquivo: testes de carga
 ATTACH_DIR = os.path.join(BASE_DIR, "attachments")
+ATTACH_CHUNK = 1024 * 1024    # bytes lidos/gravados por vez ao guardar um anexo
+ATTACH_GC_GRACE_S = 3600      # blobs sem referência mais novos que isso não são coletados (upload em andamento)
+ATTACH_PREVIEW_PX = 1024      # lado maior das prévias (imagens reduzidas e 1ª página dos PDFs)
+ATTACH_PREVIEW_WAIT_S = 2.0   # espera pela prévia na tela antes de mostrar "gerando"
 SQLITE_TIMEOUT = 4.0
+SQLITE_POOL_SIZE = 8          # conexões ociosas mantidas no pool do processo
+SQLITE_STMT_CACHE = 256       # statements preparados mantidos por conexão
+# Modo do journal: 'wal' (leitores concorrentes + fila única de escrita) ou 'delete' (modo antigo)
+SQLITE_JOURNAL_MODE = os.environ.get("FINAPP_JOURNAL_MODE", "wal").strip().lower()
+WAL_BATCH_MAX = 64            # escritas agrupadas em um único commit
+WAL_CHECKPOINT_EVERY = 200    # commits entre checkpoints PASSIVE
+WAL_CHECKPOINT_IDLE_S = 30.0  # sem escritas por este tempo -> checkpoint TRUNCATE
+WAL_SUBMIT_POLL_S = 5.0       # quem espera uma escrita confere a cada N s se a thread de escrita está viva
 PAGE_TITLE = "FinApp | JVSeps® "
+USD_QUOTE_TTL = float(os.environ.get("FINAPP_USD_TTL", "600"))   # segundos até a cotação ser renovada
+USD_QUOTE_RETRY = 60.0                                          # espera após uma falha da fonte
+USD_QUOTE_URL = os.environ.get("FINAPP_USD_QUOTE_URL", "")      # fonte HTTP alternativa (JSON {"price": x})
+# Navegação: 'lazy' executa só a página ativa; 'tabs' mantém as st.tabs (todas as páginas a cada rerun)
+NAV_MODE = os.environ.get("FINAPP_NAV_MODE", "lazy").strip().lower()
+PAGE_MEMO_MAX = 64            # resultados guardados por sessão em page_memo()
+QUERY_CACHE_MAX_ENTRIES = 512                 # cache compartilhado de fetch_df (LRU)
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+QUERY_CACHE_MAX_AGE_S = 300.0                 # idade máxima de uma entrada (rede de segurança p/ escritas externas)
+EXTERNAL_CHECK_S = 0.5                        # intervalo mínimo entre consultas ao PRAGMA data_version
+GRID_PAGE_SIZES = [50, 100, 250, 500]         # linhas por página nas grades paginadas
+SHOW_DF_STYLER_MAX_ROWS = 200                 # acima disso show_df usa st.dataframe (sem Styler/HTML)
+EXPORT_CHUNK_ROWS = 5000                      # linhas lidas do cursor por vez nas exportações
+IMPORT_BATCH_ROWS = 5000                      # linhas por transação (executemany) na importação de extratos
+SEARCH_MAX_RESULTS = 200                      # busca textual: resultados mais relevantes exibidos
+RECON_WINDOW_DAYS = 5                         # conciliação automática: ± dias entre extrato e lançamento
+RECON_MIN_SCORE = 0.35                        # abaixo disso o par não é sugerido
+CAL_OCC_PAST_DAYS = 730                       # agenda: ocorrências materializadas para trás de hoje...
+CAL_OCC_HORIZON_DAYS = 730                    # ...e para frente (janela estendida quando passa da metade)
+ICS_PORT = int(os.environ.get("FINAPP_ICS_PORT", "0") or 0)     # >0 liga o feed .ics por HTTP (assinatura)
+ICS_HOST = os.environ.get("FINAPP_ICS_HOST", "127.0.0.1")
+ICS_BASE_URL = os.environ.get("FINAPP_ICS_BASE_URL", "").rstrip("/")  # URL pública do feed (padrão: host:porta)
+ICS_UID_DOMAIN = "finapp.jgs"
+TRACE_BUFFER_SIZE = 5000                      # eventos de tempo (consultas, escritas, páginas) no diagnóstico
+TRACE_FILE = os.environ.get("FINAPP_TRACE_FILE", "")                  # JSON lines com cada evento (vazio = desligado)
+SLOW_QUERY_MS = float(os.environ.get("FINAPP_SLOW_QUERY_MS", "250"))   # acima disso o plano da consulta é registrado
 
 # ---------------------- Config inicial ----------------------
 st.set_page_config(page_title=PAGE_TITLE, layout="wide")
@@ -108,6 +178,17 @@ def apply_global_styles():
       }}
       .stTabs [role="tab"][aria-selected="true"] * {{ color:#fff !important; }}
 
+      /* ===== Navegação (modo lazy) ===== */
+      .st-key-nav_page {{
+        position: sticky; top: calc(var(--ticker-offset-top) + var(--ticker-height) + 8px); z-index: 999;
+        background: var(--finapp-bg); padding: 6px 0; margin-bottom: 8px;
+      }}
+      .st-key-nav_page [role="radiogroup"] {{ gap: 6px; flex-wrap: wrap; }}
+      .st-key-nav_page [role="radiogroup"] > label {{
+        border-radius: 12px; padding: 8px 14px; background: var(--finapp-bg-2);
+        border: 1px solid var(--finapp-border); box-shadow: var(--finapp-shadow);
+      }}
+
       /* ===== Cards / BANNERS ===== */
       .finapp-card {{
         background: var(--finapp-bg-2); border: 1px solid var(--finapp-border);
@@ -211,7 +292,7 @@ def apply_global_styles():
 apply_global_styles()
 
 # ====================== Faixa rolante (data + USD + direitos) ======================
-def get_usd_brl() -> Optional[float]:
+def _yf_usd_brl() -> Optional[float]:
     try:
         if yf is None:
             return None
@@ -229,6 +310,94 @@ def get_usd_brl() -> Optional[float]:
     except Exception:
         return None
 
+def _http_quote_source(url: str) -> Callable[[], Optional[float]]:
+    """Fonte que lê um JSON {"price": x} (ou um número puro) de uma URL, p.ex. um stub local."""
+    def fetch() -> Optional[float]:
+        try:
+            with urlrequest.urlopen(url, timeout=3) as resp:
+                body = resp.read().decode("utf-8").strip()
+            data = json.loads(body)
+            return float(data["price"] if isinstance(data, dict) else data)
+        except Exception:
+            return None
+    return fetch
+
+class _QuoteCache:
+    """Cotação compartilhada pelo processo com TTL.
+
+    `get()` nunca bloqueia: devolve o último valor conhecido (mesmo vencido) e, se o TTL
+    passou, dispara a renovação numa thread. O último valor bom fica em quote_cache no
+    SQLite, então um processo novo já desenha a faixa com a cotação anterior.
+    """
+
+    def __init__(self, symbol: str, source: Callable[[], Optional[float]], ttl: float):
+        self.symbol = symbol
+        self.source = source
+        self.ttl = ttl
+        self.price: Optional[float] = None
+        self.fetched_at = 0.0
+        self._next_try = 0.0
+        self._loaded = False
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[float]:
+        if not self._loaded:
+            self._load_persisted()
+        now = time.time()
+        if now - self.fetched_at >= self.ttl and now >= self._next_try:
+            self._refresh_async()
+        return self.price
+
+    def _load_persisted(self):
+        self._loaded = True
+        try:
+            with _connect() as conn:
+                row = conn.execute("SELECT price, fetched_at FROM quote_cache WHERE symbol=?", (self.symbol,)).fetchone()
+            if row and self.price is None:
+                self.price, self.fetched_at = float(row[0]), float(row[1])
+        except Exception:
+            pass
+
+    def _refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="finapp-quote-refresh", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            p = self.source()
+            if p:
+                self.price, self.fetched_at = float(p), time.time()
+                _db_write(lambda conn: conn.execute(
+                    "INSERT INTO quote_cache (symbol, price, fetched_at) VALUES (?,?,?) "
+                    "ON CONFLICT(symbol) DO UPDATE SET price=excluded.price, fetched_at=excluded.fetched_at",
+                    (self.symbol, self.price, self.fetched_at),
+                ), tables=("quote_cache",))
+            else:
+                self._next_try = time.time() + USD_QUOTE_RETRY
+        except Exception:
+            self._next_try = time.time() + USD_QUOTE_RETRY
+        finally:
+            self._refreshing = False
+
+@st.cache_resource(show_spinner=False)
+def _usd_quote() -> _QuoteCache:
+    source = _http_quote_source(USD_QUOTE_URL) if USD_QUOTE_URL else _yf_usd_brl
+    return _QuoteCache("USDBRL", source, USD_QUOTE_TTL)
+
+def set_quote_source(source: Callable[[], Optional[float]]):
+    """Troca a fonte da cotação (p.ex. um stub em testes); a próxima leitura já renova."""
+    cache = _usd_quote()
+    cache.source = source
+    cache.fetched_at = 0.0
+    cache._next_try = 0.0
+
+def get_usd_brl() -> Optional[float]:
+    return _usd_quote().get()
+
 def top_ticker():
     hoje = datetime.now().strftime("%d/%m/%y")
     usd = get_usd_brl()
@@ -249,58 +418,653 @@ def do_rerun():
         except Exception:
             pass
 
-def flash(msg: str, kind: str = "success", seconds: float = 3.0):
+# ===== Avisos (fila da sessão, sem time.sleep no servidor) =====
+_NOTICE_KEY = "_finapp_notices"
+_NOTICE_ICONS = {"success": "✅", "info": "ℹ️", "warning": "⚠️", "error": "❌"}
+
+def _show_notice(msg: str, kind: str, seconds: float):
+    if hasattr(st, "toast"):
+        try:
+            st.toast(msg, icon=_NOTICE_ICONS.get(kind), duration=max(1, int(round(seconds))))
+        except TypeError:
+            st.toast(msg, icon=_NOTICE_ICONS.get(kind))
+        return
     if   kind == "success": st.success(msg)
     elif kind == "info":    st.info(msg)
     elif kind == "warning": st.warning(msg)
     elif kind == "error":   st.error(msg)
     else:                   st.write(msg)
-    time.sleep(max(0.1, seconds))
+
+def flash(msg: str, kind: str = "success", seconds: float = 3.0):
+    """Mostra o aviso já e o guarda na fila da sessão até expirar.
+
+    Quase sempre vem seguido de `do_rerun()`, que descarta o que foi desenhado nesta execução;
+    por isso `render_notifications()` o mostra de novo no início da próxima.
+    """
+    _show_notice(msg, kind, seconds)
+    st.session_state.setdefault(_NOTICE_KEY, []).append(
+        {"msg": msg, "kind": kind, "seconds": seconds, "expires": time.time() + max(0.1, seconds)}
+    )
+
+def render_notifications():
+    """Desenha os avisos deixados por uma execução interrompida por rerun (e ainda não expirados)."""
+    now = time.time()
+    for n in st.session_state.pop(_NOTICE_KEY, []):
+        if n["expires"] >= now:
+            _show_notice(n["msg"], n["kind"], n["expires"] - now)
+
+def settle_notifications():
+    """A execução chegou ao fim: os avisos já apareceram nela, então saem da fila."""
+    st.session_state.pop(_NOTICE_KEY, None)
 
 def current_theme_base() -> str:
     return "light"
 
 # ====================== DB helpers ======================
-def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=SQLITE_TIMEOUT)
+def _wal_enabled() -> bool:
+    return SQLITE_JOURNAL_MODE == "wal"
+
+def _open_connection(path: str, isolation_level: Optional[str] = "") -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=SQLITE_TIMEOUT,
+                           isolation_level=isolation_level, cached_statements=SQLITE_STMT_CACHE)
     try:
-        conn.execute("PRAGMA journal_mode=DELETE;")
+        conn.execute(f"PRAGMA journal_mode={'WAL' if _wal_enabled() else 'DELETE'};")
     except Exception:
         pass
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute("PRAGMA temp_store=MEMORY;")
     return conn
 
+class _ConnectionPool:
+    """Pool pequeno de conexões SQLite, compartilhado pelo processo e reaproveitado entre reruns.
+
+    Cada thread usa uma única conexão enquanto houver chamadas aninhadas; os PRAGMAs são
+    aplicados só na abertura e o cache de statements do sqlite3 (`cached_statements`)
+    mantém preparadas as consultas parametrizadas já executadas naquela conexão.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._local = threading.local()
+
+    def _open(self) -> sqlite3.Connection:
+        return _open_connection(self.path)
+
+    def held(self) -> bool:
+        """True se esta thread já está dentro de um `connection()` (chamada aninhada)."""
+        return getattr(self._local, "conn", None) is not None
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def _release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+@st.cache_resource(show_spinner=False)
+def _db_pool() -> _ConnectionPool:
+    return _ConnectionPool(DB_PATH, SQLITE_POOL_SIZE)
+
+@contextmanager
+def _connect():
+    """Conexão do pool com a mesma semântica de `with sqlite3.connect(...)`: commit ao sair, rollback em erro.
+
+    Aninhado, devolve a conexão do `with` externo sem commit/rollback: a transação é de quem a abriu.
+    """
+    pool = _db_pool()
+    nested = pool.held()
+    with pool.connection() as conn:
+        if nested:
+            yield conn
+            return
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+class _WriteQueue:
+    """Thread única de escrita para o modo WAL.
+
+    As escritas entram numa fila e são aplicadas em lotes de até WAL_BATCH_MAX, com um
+    commit por lote; cada item roda num SAVEPOINT próprio, então a falha de um não
+    desfaz os demais. Itens `bulk` (cargas grandes) têm transação só deles, sem SAVEPOINT,
+    cujo custo cresce com o número de páginas alteradas. O checkpoint é feito aqui
+    (autocheckpoint desligado nesta conexão): PASSIVE a cada WAL_CHECKPOINT_EVERY commits
+    ou após cada carga, e TRUNCATE quando a fila fica ociosa.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._q: "queue.Queue[Tuple[Callable[[sqlite3.Connection], Any], Future, bool]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="finapp-sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable[[sqlite3.Connection], Any], bulk: bool = False,
+               timing: Optional[dict] = None) -> Any:
+        """Enfileira `fn` e espera o resultado; `timing` recebe queue_ms (fila) e lock_ms (BEGIN IMMEDIATE)."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Escrita aninhada dentro da fila de escrita.")
+        if not self._thread.is_alive():
+            raise RuntimeError("A fila de escrita parou; reinicie o app.")
+        fut: Future = Future()
+        fut.submitted = time.perf_counter()
+        self._q.put((fn, fut, bulk))
+        try:
+            while True:
+                try:
+                    return fut.result(timeout=WAL_SUBMIT_POLL_S)
+                except TimeoutError:
+                    if not self._thread.is_alive():
+                        raise RuntimeError("A fila de escrita parou; reinicie o app.")
+        finally:
+            if timing is not None:
+                timing.update(getattr(fut, "timing", {}))
+
+    def _open(self) -> sqlite3.Connection:
+        conn = _open_connection(self.path, isolation_level=None)
+        conn.execute("PRAGMA wal_autocheckpoint=0;")
+        return conn
+
+    def _run(self):
+        conn: Optional[sqlite3.Connection] = None
+        commits = 0
+        while True:
+            try:
+                item = self._q.get(timeout=WAL_CHECKPOINT_IDLE_S)
+            except queue.Empty:
+                if commits and conn is not None:
+                    self._checkpoint(conn, "TRUNCATE")
+                    commits = 0
+                continue
+            batch = [item]
+            while len(batch) < WAL_BATCH_MAX:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if conn is None:
+                    conn = self._open()
+                small = [(fn, fut) for fn, fut, bulk in batch if not bulk]
+                if small:
+                    self._apply(conn, small)
+                    commits += 1
+                for fn, fut, bulk in batch:
+                    if bulk:
+                        self._apply(conn, [(fn, fut)])
+                        commits = WAL_CHECKPOINT_EVERY
+                if commits >= WAL_CHECKPOINT_EVERY:
+                    self._checkpoint(conn, "PASSIVE")
+                    commits = 0
+            except BaseException as e:
+                # Falha fora do que _apply trata (abrir a conexão, estado inesperado): a thread
+                # não pode morrer; falha o que ficou pendente e reabre a conexão no próximo lote
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn, commits = None, 0
+
+    def _apply(self, conn: sqlite3.Connection, batch):
+        if conn.in_transaction:   # sobra de um lote anterior (fn que abriu transação, erro no ROLLBACK)
+            conn.execute("ROLLBACK;")
+        t0 = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+        except Exception as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        lock_ms = (time.perf_counter() - t0) * 1000
+        for _, fut in batch:
+            fut.timing = {"queue_ms": (t0 - fut.submitted) * 1000, "lock_ms": lock_ms}
+        if len(batch) == 1:
+            fn, fut = batch[0]
+            try:
+                res = fn(conn)
+                conn.execute("COMMIT;")
+            except Exception as e:
+                try:
+                    conn.execute("ROLLBACK;")
+                except Exception:
+                    pass
+                fut.set_exception(e)
+            else:
+                fut.set_result(res)
+            return
+        done = []
+        try:
+            for fn, fut in batch:
+                conn.execute("SAVEPOINT finapp_w;")
+                try:
+                    res = fn(conn)
+                except Exception as e:
+                    # Se o SQLite já desfez a transação inteira (SQLITE_FULL, IOERR, fn com
+                    # COMMIT/ROLLBACK), o ROLLBACK TO falha e cai no except de fora: o lote todo falha
+                    conn.execute("ROLLBACK TO finapp_w;")
+                    conn.execute("RELEASE finapp_w;")
+                    done.append((fut, None, e))
+                else:
+                    conn.execute("RELEASE finapp_w;")
+                    done.append((fut, res, None))
+            conn.execute("COMMIT;")
+        except Exception as e:
+            try:
+                conn.execute("ROLLBACK;")
+            except Exception:
+                pass
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        for fut, res, err in done:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    @staticmethod
+    def _checkpoint(conn: sqlite3.Connection, mode: str):
+        try:
+            conn.execute(f"PRAGMA wal_checkpoint({mode});").fetchall()
+        except Exception:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def _db_writer() -> _WriteQueue:
+    return _WriteQueue(DB_PATH)
+
+# Tabelas alteradas por triggers quando a tabela da chave é escrita
+_TABLE_DEPENDENTS = {
+    "transactions": ("monthly_rollup", "account_balance_checkpoints", "transactions_fts"),
+    "calendar_events": ("calendar_occurrences", "app_meta"),
+}
+
+@st.cache_resource(show_spinner=False)
+def _write_state() -> dict:
+    # gen: qualquer escrita; epoch: escritas sem tabela conhecida; tables: geração por tabela
+    return {"gen": 0, "epoch": 0, "tables": {}, "lock": threading.Lock()}
+
+class _ExternalChanges:
+    """Percebe commits feitos fora deste processo (outro servidor, manage.py, scripts).
+
+    Uma conexão só para isso consulta o PRAGMA data_version, que muda quando qualquer outra
+    conexão grava no arquivo. As escritas do próprio processo (_db_write) são descontadas:
+    a versão é lida antes e depois delas. Mudança não explicada invalida todos os caches (epoch).
+    """
+
+    def __init__(self, path: str):
+        self._conn = _open_connection(path, isolation_level=None)
+        self._lock = threading.Lock()
+        self._known = self._version()
+        self._checked = time.monotonic()
+
+    def _version(self) -> int:
+        return self._conn.execute("PRAGMA data_version;").fetchone()[0]
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version()
+
+    def poll(self):
+        now = time.monotonic()
+        if now - self._checked < EXTERNAL_CHECK_S:
+            return
+        with self._lock:
+            self._checked = now
+            current = self._version()
+            changed, self._known = current != self._known, current
+        if changed:
+            _bump_generation(None)
+
+    def absorb(self, before: int):
+        """Fim de uma escrita local que começou com a versão `before`: assume a versão nova."""
+        with self._lock:
+            external = before != self._known
+            self._known = self._version()
+        if external:
+            _bump_generation(None)
+
+@st.cache_resource(show_spinner=False)
+def _external_changes() -> _ExternalChanges:
+    return _ExternalChanges(DB_PATH)
+
+def data_generation() -> int:
+    """Contador do processo incrementado a cada escrita; muda sempre que algum dado pode ter mudado."""
+    _external_changes().poll()
+    return _write_state()["gen"]
+
+def table_generations(tables) -> Tuple[int, Tuple[int, ...]]:
+    """(epoch, gerações) das tabelas, para validar resultados guardados em cache."""
+    _external_changes().poll()
+    state = _write_state()
+    gens = state["tables"]
+    return state["epoch"], tuple(gens.get(t, 0) for t in tables)
+
+def _bump_generation(tables: Optional[Tuple[str, ...]] = None):
+    state = _write_state()
+    with state["lock"]:
+        state["gen"] += 1
+        if tables is None:
+            state["epoch"] += 1
+            return
+        gens = state["tables"]
+        for t in tables:
+            for name in (t,) + _TABLE_DEPENDENTS.get(t, ()):
+                gens[name] = gens.get(name, 0) + 1
+
+def _db_write(fn: Callable[[sqlite3.Connection], Any], tables: Optional[Tuple[str, ...]] = None,
+              bulk: bool = False, label: Optional[str] = None) -> Any:
+    """Executa `fn(conn)` numa transação de escrita (fila única no modo WAL). `fn` não deve dar commit.
+
+    `tables` são as tabelas escritas (invalidam o cache de consultas); None invalida tudo.
+    `bulk` marca cargas grandes (milhares de linhas), aplicadas numa transação exclusiva.
+    `label` nomeia a escrita no diagnóstico (padrão: nome da função).
+    """
+    t0, timing = time.perf_counter(), {}
+    external = _external_changes()
+    before = external.version()
+    try:
+        if _wal_enabled():
+            return _db_writer().submit(fn, bulk=bulk, timing=timing)
+        with _connect() as conn:
+            return fn(conn)
+    finally:
+        _bump_generation(tables)
+        external.absorb(before)
+        trace_event("write", label or getattr(fn, "__qualname__", "write"), (time.perf_counter() - t0) * 1000,
+                    lock_ms=timing.get("lock_ms"), queue_ms=timing.get("queue_ms"), bulk=bulk or None)
+
+def page_memo(name: str, fn: Callable[..., Any], *args) -> Any:
+    """`fn(*args)` guardado na sessão até a próxima escrita no banco.
+
+    Com a navegação lazy, voltar para uma página cujos dados não mudaram não refaz as consultas.
+    """
+    memo = st.session_state.setdefault("_page_memo", {})
+    key = (name,) + tuple(args)
+    gen = data_generation()
+    hit = memo.get(key)
+    if hit is not None and hit[0] == gen:
+        return hit[1]
+    value = fn(*args)
+    memo.pop(key, None)
+    memo[key] = (gen, value)
+    while len(memo) > PAGE_MEMO_MAX:
+        memo.pop(next(iter(memo)))
+    return value
+
+# ===== Instrumentação (tempos de consultas, escritas, páginas e gráficos) =====
+_log = logging.getLogger("finapp")
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_PARAM_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@lru_cache(maxsize=2048)
+def sql_fingerprint(query: str) -> str:
+    """SQL normalizado para agrupar execuções: espaços colapsados, literais e listas IN viram `?`."""
+    q = _SQL_LITERAL_RE.sub("?", " ".join(query.split()))
+    return _SQL_PARAM_LIST_RE.sub("(?, ...)", q)
+
+class _Tracer:
+    """Buffer circular (deque) dos eventos de tempo do processo, opcionalmente espelhado em JSON lines.
+
+    Cada evento: ts, kind ('query', 'write', 'page', 'chart'), name (fingerprint do SQL, página
+    ou gráfico), ms e campos opcionais (rows, cached, lock_ms, queue_ms, plan). Consultas acima de
+    SLOW_QUERY_MS levam o EXPLAIN QUERY PLAN, calculado uma vez por fingerprint.
+    """
+
+    def __init__(self, size: int, path: str = ""):
+        self._buf: "deque[dict]" = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self.plans: dict = {}
+
+    def record(self, kind: str, name: str, ms: float, **fields):
+        ev = {"ts": round(time.time(), 3), "kind": kind, "name": name, "ms": round(ms, 3)}
+        ev.update((k, v) for k, v in fields.items() if v is not None)
+        line = json.dumps(ev, ensure_ascii=False, default=str) if self._file else None
+        with self._lock:
+            self._buf.append(ev)
+            if line is not None:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def events(self) -> List[dict]:
+        with self._lock:
+            return list(self._buf)
+
+    def clear(self):
+        with self._lock:
+            self._buf.clear()
+
+    def summary(self, kind: Optional[str] = None) -> pd.DataFrame:
+        """Agregado por (kind, name): execuções, tempo total/médio/p95/máximo, linhas e espera de lock."""
+        df = pd.DataFrame(self.events())
+        if df.empty:
+            return df
+        if kind:
+            df = df[df["kind"] == kind]
+        for col in ("rows", "lock_ms", "cached"):
+            if col not in df:
+                df[col] = np.nan
+        df["cached"] = df["cached"].fillna(False).astype(bool)
+        g = df.groupby(["kind", "name"], sort=False)
+        out = pd.DataFrame({
+            "n": g.size(), "cache": g["cached"].sum(), "total_ms": g["ms"].sum(), "media_ms": g["ms"].mean(),
+            "p95_ms": g["ms"].quantile(0.95), "max_ms": g["ms"].max(),
+            "linhas": g["rows"].mean(), "lock_ms": g["lock_ms"].sum(min_count=1),
+        }).reset_index()
+        return out.sort_values("total_ms", ascending=False, ignore_index=True)
+
+@st.cache_resource(show_spinner=False)
+def _tracer() -> _Tracer:
+    return _Tracer(TRACE_BUFFER_SIZE, TRACE_FILE)
+
+def trace_event(kind: str, name: str, ms: float, **fields):
+    try:
+        _tracer().record(kind, name, ms, **fields)
+    except Exception:
+        pass  # o diagnóstico nunca derruba a página
+
+@contextmanager
+def trace_span(kind: str, name: str, **fields):
+    """Mede o bloco e registra um evento `kind`/`name` no diagnóstico (também quando ele falha ou para)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace_event(kind, name, (time.perf_counter() - t0) * 1000, **fields)
+
+def _slow_query_plan(conn: sqlite3.Connection, query: str, params: Tuple, fingerprint: str) -> Optional[str]:
+    plans = _tracer().plans
+    if fingerprint not in plans:
+        try:
+            rows = conn.execute("EXPLAIN QUERY PLAN " + query, tuple(params)).fetchall()
+            plans[fingerprint] = "; ".join(str(r[-1]) for r in rows)
+        except Exception as e:
+            plans[fingerprint] = f"(sem plano: {e})"
+        _log.warning("consulta lenta (>= %.0f ms): %s\n  plano: %s", SLOW_QUERY_MS, fingerprint, plans[fingerprint])
+    return plans[fingerprint]
+
+# ===== Cache de consultas (compartilhado entre sessões, invalidado por tabela) =====
+_JOIN_TABLE_RE = re.compile(r"\bJOIN\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+# Lista do FROM até a próxima cláusula: "FROM a x, b y WHERE ..." -> "a x, b y"
+_FROM_LIST_RE = re.compile(
+    r"\bFROM\s+(?!\()(.+?)(?=\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING|WINDOW|UNION|EXCEPT|INTERSECT|JOIN|LEFT|INNER|CROSS|ON)\b|[();]|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+_IDENT_RE = re.compile(r"\s*([A-Za-z_][A-Za-z0-9_]*)")
+_WRITE_TABLE_RE = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+([A-Za-z_][A-Za-z0-9_]*)",
+    re.IGNORECASE,
+)
+
+def _read_tables(query: str) -> Tuple[str, ...]:
+    tables = {t.lower() for t in _JOIN_TABLE_RE.findall(query)}
+    for from_list in _FROM_LIST_RE.findall(query):
+        for item in from_list.split(","):
+            m = _IDENT_RE.match(item)
+            if m:
+                tables.add(m.group(1).lower())
+    return tuple(sorted(tables))
+
+def _written_tables(query: str) -> Optional[Tuple[str, ...]]:
+    m = _WRITE_TABLE_RE.match(query)
+    return (m.group(1).lower(),) if m else None
+
+class _QueryCache:
+    """LRU de resultados de fetch_df por (SQL, params).
+
+    Cada entrada guarda as gerações das tabelas lidas no momento da consulta; uma escrita em
+    qualquer uma delas (ver _bump_generation) torna a entrada velha e ela sai no próximo acesso.
+    Escritas de outros processos invalidam tudo (_ExternalChanges); além disso nenhuma entrada
+    vive mais que QUERY_CACHE_MAX_AGE_S.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Tuple[str, Tuple], Tuple[pd.DataFrame, Tuple[str, ...], Tuple, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            df, tables, stamp, size, born = entry
+            if table_generations(tables) != stamp or time.monotonic() - born > QUERY_CACHE_MAX_AGE_S:
+                del self._data[key]
+                self.bytes -= size
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return df
+
+    def put(self, key, df: pd.DataFrame, tables: Tuple[str, ...], stamp: Tuple):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[3]
+            self._data[key] = (df, tables, stamp, size, time.monotonic())
+            self.bytes += size
+            while self._data and (len(self._data) > self.max_entries or self.bytes > self.max_bytes):
+                _, (_, _, _, sz, _) = self._data.popitem(last=False)
+                self.bytes -= sz
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data), "bytes": self.bytes,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions, "invalidations": self.invalidations,
+            }
+
+@st.cache_resource(show_spinner=False)
+def _query_cache() -> _QueryCache:
+    return _QueryCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES)
+
+def query_cache_stats() -> dict:
+    return _query_cache().stats()
+
 def fetch_df(query: str, params: Tuple = ()) -> pd.DataFrame:
+    t0 = time.perf_counter()
+    tables = _read_tables(query) if query.lstrip()[:6].upper() in ("SELECT", "WITH") else ()
+    key = (query, tuple(params))
+    if tables:
+        cached = _query_cache().get(key)
+        if cached is not None:
+            trace_event("query", sql_fingerprint(query), (time.perf_counter() - t0) * 1000,
+                        rows=len(cached), cached=True)
+            return cached.copy()
+        stamp = table_generations(tables)  # antes da consulta: escrita concorrente invalida
+    plan = None
     try:
         with _connect() as conn:
-            return pd.read_sql_query(query, conn, params=params)
+            df = pd.read_sql_query(query, conn, params=params)
+            ms = (time.perf_counter() - t0) * 1000
+            if ms >= SLOW_QUERY_MS:
+                plan = _slow_query_plan(conn, query, params, sql_fingerprint(query))
     except Exception as e:
+        trace_event("query", sql_fingerprint(query), (time.perf_counter() - t0) * 1000, error=str(e))
         st.error(f"Erro ao consultar o banco: {e}")
         return pd.DataFrame()
+    trace_event("query", sql_fingerprint(query), ms, rows=len(df), plan=plan)
+    if tables:
+        _query_cache().put(key, df, tables, stamp)
+        return df.copy()
+    return df
 
 def exec_sql(query: str, params: Tuple = ()) -> Optional[int]:
     try:
-        with _connect() as conn:
-            cur = conn.cursor()
-            cur.execute(query, params)
-            conn.commit()
-            return cur.lastrowid
+        return _db_write(lambda conn: conn.execute(query, params).lastrowid, tables=_written_tables(query),
+                         label=sql_fingerprint(query))
     except Exception as e:
         st.error(f"Erro ao gravar no banco: {e}")
         return None
 
 # ===== Migrações seguras (evitam "duplicate column name") =====
-def _table_columns(table: str) -> List[str]:
+def _table_columns(table: str, conn: Optional[sqlite3.Connection] = None) -> List[str]:
     try:
+        if conn is not None:
+            return [str(r[1]).lower() for r in conn.execute(f"PRAGMA table_xinfo({table});").fetchall()]
         with _connect() as conn:
             cur = conn.cursor()
-            cur.execute(f"PRAGMA table_info({table});")
+            cur.execute(f"PRAGMA table_xinfo({table});")
             cols = [str(r[1]).lower() for r in cur.fetchall()]
             return cols
     except Exception:
         return []
 
+def _add_column(conn: sqlite3.Connection, table: str, column_name: str, column_sql_def: str):
+    """Versão de `add_column_if_not_exists` que roda dentro da transação de uma migração."""
+    if column_name.lower().strip() not in _table_columns(table, conn):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column_sql_def};")
+
 def add_column_if_not_exists(table: str, column_name: str, column_sql_def: str):
     """Adiciona coluna (ALTER TABLE) somente se não existir. Silencioso em caso de corrida."""
     column_name = column_name.lower().strip()
@@ -314,127 +1078,154 @@ def add_column_if_not_exists(table: str, column_name: str, column_sql_def: str):
         # Silenciar para evitar banner vermelho; se falhar aqui, a coluna provavelmente já existe.
         pass
 
-# ====================== Bootstrap DB ======================
+# ====================== Bootstrap DB (migrações versionadas) ======================
 def hash_password(pwd: str) -> str:
     return hashlib.sha256(pwd.encode("utf-8")).hexdigest()
 
-def init_db():
-    os.makedirs(ATTACH_DIR, exist_ok=True)
-    with _connect() as conn:
-        cur = conn.cursor()
+def _m001_base_tables(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            type TEXT CHECK(type IN ('bank','cash','card')) NOT NULL,
+            institution TEXT,
+            number TEXT
+        );
+    """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS accounts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                type TEXT CHECK(type IN ('bank','cash','card')) NOT NULL,
-                institution TEXT,
-                number TEXT
-            );
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            parent_id INTEGER,
+            kind TEXT CHECK(kind IN ('expense','income','tax','payroll')) NOT NULL DEFAULT 'expense'
+        );
+    """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                parent_id INTEGER,
-                kind TEXT CHECK(kind IN ('expense','income','tax','payroll')) NOT NULL DEFAULT 'expense'
-            );
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sectors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE
+        );
+    """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sectors (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            );
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trx_date TEXT NOT NULL,
+            due_date TEXT,
+            paid_date TEXT,
+            type TEXT CHECK(type IN ('expense','income','transfer','tax','payroll','card')) NOT NULL,
+            sector TEXT,
+            cost_center_id INTEGER,
+            category_id INTEGER,
+            account_id INTEGER,
+            card_id INTEGER,
+            method TEXT,
+            doc_number TEXT,
+            counterparty TEXT,
+            description TEXT,
+            amount REAL NOT NULL,
+            status TEXT CHECK(status IN ('planned','paid','overdue','reconciled','canceled')) NOT NULL DEFAULT 'planned',
+            tags TEXT,
+            origin TEXT CHECK(origin IN ('manual','bank','card','import')) DEFAULT 'manual',
+            external_id TEXT UNIQUE,
+            attachment_path TEXT
+        );
+    """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                trx_date TEXT NOT NULL,
-                due_date TEXT,
-                paid_date TEXT,
-                type TEXT CHECK(type IN ('expense','income','transfer','tax','payroll','card')) NOT NULL,
-                sector TEXT,
-                cost_center_id INTEGER,
-                category_id INTEGER,
-                account_id INTEGER,
-                card_id INTEGER,
-                method TEXT,
-                doc_number TEXT,
-                counterparty TEXT,
-                description TEXT,
-                amount REAL NOT NULL,
-                status TEXT CHECK(status IN ('planned','paid','overdue','reconciled','canceled')) NOT NULL DEFAULT 'planned',
-                tags TEXT,
-                origin TEXT CHECK(origin IN ('manual','bank','card','import')) DEFAULT 'manual',
-                external_id TEXT UNIQUE,
-                attachment_path TEXT
-            );
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payroll (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            period TEXT NOT NULL,
+            employee TEXT NOT NULL,
+            gross REAL NOT NULL,
+            charges REAL NOT NULL,
+            benefits REAL NOT NULL,
+            total REAL NOT NULL,
+            paid INTEGER NOT NULL DEFAULT 0
+        );
+    """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS payroll (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                period TEXT NOT NULL,
-                employee TEXT NOT NULL,
-                gross REAL NOT NULL,
-                charges REAL NOT NULL,
-                benefits REAL NOT NULL,
-                total REAL NOT NULL,
-                paid INTEGER NOT NULL DEFAULT 0
-            );
-        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS taxes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            jurisdiction TEXT,
+            code TEXT,
+            periodicity TEXT,
+            due_day INTEGER
+        );
+    """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS taxes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                jurisdiction TEXT,
-                code TEXT,
-                periodicity TEXT,
-                due_day INTEGER
-            );
-        """)
+    # --- Tabela de compromissos da Agenda ---
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS calendar_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            date TEXT,                 -- data base (único) ou início (recorrente)
+            is_recurring INTEGER NOT NULL DEFAULT 0,
+            recur_rule TEXT,           -- 'daily'|'weekly'|'monthly'|'yearly' ou NULL
+            recur_until TEXT,          -- última data (opcional)
+            src_transaction_id INTEGER,
+            is_public INTEGER NOT NULL DEFAULT 0,
+            created_by INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+def _m002_legacy_columns(conn: sqlite3.Connection):
+    # transactions
+    _add_column(conn, "transactions", "show_on_calendar", "show_on_calendar INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "transactions", "cal_is_recurring", "cal_is_recurring INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "transactions", "cal_recur_rule", "cal_recur_rule TEXT")
 
-        # --- Tabela de compromissos da Agenda ---
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS calendar_events (
+    # calendar_events: alguns bancos podem ter usado 'event_date' ao invés de 'date'
+    _add_column(conn, "calendar_events", "event_date", "event_date TEXT")
+    _add_column(conn, "calendar_events", "is_public", "is_public INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "calendar_events", "created_by", "created_by INTEGER")
+
+def _m003_users_clients_suppliers(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            role TEXT CHECK(role IN ('launcher','manager')) NOT NULL DEFAULT 'launcher',
+            account_id INTEGER,
+            sectors TEXT,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    for table in ("clients", "suppliers"):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT,
-                date TEXT,                 -- data base (único) ou início (recorrente)
-                is_recurring INTEGER NOT NULL DEFAULT 0,
-                recur_rule TEXT,           -- 'daily'|'weekly'|'monthly'|'yearly' ou NULL
-                recur_until TEXT,          -- última data (opcional)
-                src_transaction_id INTEGER,
-                is_public INTEGER NOT NULL DEFAULT 0,
-                created_by INTEGER,
+                name TEXT NOT NULL,
+                doc TEXT,
+                contact TEXT,
+                phone TEXT,
+                email TEXT,
+                notes TEXT,
+                is_active INTEGER NOT NULL DEFAULT 1,
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP
             );
         """)
-
-        conn.commit()
-
-    # === Migrações seguras (só cria se faltar) ===
-    # transactions
-    add_column_if_not_exists("transactions", "show_on_calendar", "show_on_calendar INTEGER NOT NULL DEFAULT 0")
-    add_column_if_not_exists("transactions", "cal_is_recurring", "cal_is_recurring INTEGER NOT NULL DEFAULT 0")
-    add_column_if_not_exists("transactions", "cal_recur_rule", "cal_recur_rule TEXT")
-
-    # calendar_events: alguns bancos podem ter usado 'event_date' ao invés de 'date'
-    add_column_if_not_exists("calendar_events", "event_date", "event_date TEXT")
-    add_column_if_not_exists("calendar_events", "is_public", "is_public INTEGER NOT NULL DEFAULT 0")
-    add_column_if_not_exists("calendar_events", "created_by", "created_by INTEGER")
-
-def seed_minimums():
-    if fetch_df("SELECT COUNT(*) as n FROM accounts").iloc[0, 0] == 0:
-        exec_sql("INSERT INTO accounts (name, type, institution, number) VALUES (?,?,?,?)",
-                 ("Conta Corrente Principal", 'bank', 'Banco Exemplo', '0001-1'))
-        exec_sql("INSERT INTO accounts (name, type, institution, number) VALUES (?,?,?,?)",
-                 ("Caixa", 'cash', '', ''))
-    if fetch_df("SELECT COUNT(*) as n FROM categories").iloc[0, 0] == 0:
+    # Bancos antigos podem ter criado essas tabelas à mão com menos colunas
+    for table in ("users", "clients", "suppliers"):
+        _add_column(conn, table, "is_active", "is_active INTEGER NOT NULL DEFAULT 1")
+        _add_column(conn, table, "created_at", "created_at TEXT")
+
+def _m004_seed_minimums(conn: sqlite3.Connection):
+    if conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0] == 0:
+        conn.executemany("INSERT INTO accounts (name, type, institution, number) VALUES (?,?,?,?)", [
+            ("Conta Corrente Principal", 'bank', 'Banco Exemplo', '0001-1'),
+            ("Caixa", 'cash', '', ''),
+        ])
+    if conn.execute("SELECT COUNT(*) FROM categories").fetchone()[0] == 0:
         base = [
             ("Energia Elétrica", None, 'expense'),
             ("Água", None, 'expense'),
@@ -443,11 +1234,358 @@ def seed_minimums():
             ("ICMS", None, 'tax'),
             ("Folha - Salários", None, 'payroll'),
         ]
-        for n, p, k in base:
-            exec_sql("INSERT INTO categories (name,parent_id,kind) VALUES (?,?,?)", (n, p, k))
-    if fetch_df("SELECT COUNT(*) as n FROM sectors").iloc[0, 0] == 0:
-        for s in ["Administrativo", "Produção", "Comercial", "Logística", "Outros"]:
-            exec_sql("INSERT INTO sectors (name) VALUES (?)", (s,))
+        conn.executemany("INSERT INTO categories (name,parent_id,kind) VALUES (?,?,?)", base)
+    if conn.execute("SELECT COUNT(*) FROM sectors").fetchone()[0] == 0:
+        conn.executemany("INSERT INTO sectors (name) VALUES (?)",
+                         [(s,) for s in ["Administrativo", "Produção", "Comercial", "Logística", "Outros"]])
+
+# Conjunto gerenciado de índices de transactions (nome -> colunas). As consultas quentes
+# comparam trx_date direto (texto ISO 'AAAA-MM-DD'), sem date()/strftime(), para usá-los.
+TRANSACTION_INDEXES = {
+    "idx_trx_date": "trx_date",
+    "idx_trx_account_date": "account_id, trx_date",
+    "idx_trx_status_date": "status, trx_date",
+    "idx_trx_type_date": "type, trx_date",
+    "idx_trx_category": "category_id",
+}
+
+def _m005_transaction_indexes(conn: sqlite3.Connection):
+    # Normaliza datas gravadas com hora, para que as comparações por texto equivalham a date(...)
+    conn.execute("""
+        UPDATE transactions SET trx_date = date(trx_date)
+         WHERE date(trx_date) IS NOT NULL AND trx_date <> date(trx_date)
+    """)
+    for name, cols in TRANSACTION_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON transactions({cols});")
+    conn.execute("ANALYZE transactions;")
+
+# Agregado mensal mantido por triggers: cada INSERT/UPDATE/DELETE em transactions ajusta a linha
+# (ym, type, category_id, account_id, sector, status) na mesma transação. Chaves nulas viram 0/''
+# porque NULL não colide em PRIMARY KEY/UPSERT. Totais em centavos inteiros: somas exatas.
+_ROLLUP_KEY = "ym, type, category_id, account_id, sector, status"
+
+def _rollup_key_values(ref: str) -> str:
+    return (f"substr({ref}.trx_date, 1, 7), {ref}.type, IFNULL({ref}.category_id, 0), "
+            f"IFNULL({ref}.account_id, 0), IFNULL({ref}.sector, ''), {ref}.status")
+
+def _cents_sql(ref: str = "") -> str:
+    # mesma expressão da coluna gerada amount_cents (m012), usável antes de ela existir
+    col = f"{ref}.amount" if ref else "amount"
+    return f"CAST(ROUND({col} * 100) AS INTEGER)"
+
+def _rollup_add_sql(ref: str) -> str:
+    return f"""
+        INSERT INTO monthly_rollup ({_ROLLUP_KEY}, total_cents, n)
+        VALUES ({_rollup_key_values(ref)}, {_cents_sql(ref)}, 1)
+        ON CONFLICT({_ROLLUP_KEY}) DO UPDATE SET total_cents = total_cents + excluded.total_cents, n = n + 1;
+    """
+
+def _rollup_sub_sql(ref: str) -> str:
+    match = (f"ym = substr({ref}.trx_date, 1, 7) AND type = {ref}.type "
+             f"AND category_id = IFNULL({ref}.category_id, 0) AND account_id = IFNULL({ref}.account_id, 0) "
+             f"AND sector = IFNULL({ref}.sector, '') AND status = {ref}.status")
+    return f"""
+        UPDATE monthly_rollup SET total_cents = total_cents - {_cents_sql(ref)}, n = n - 1 WHERE {match};
+        DELETE FROM monthly_rollup WHERE n <= 0 AND {match};
+    """
+
+def _create_monthly_rollup(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_rollup (
+            ym TEXT NOT NULL,                          -- 'AAAA-MM'
+            type TEXT NOT NULL,
+            category_id INTEGER NOT NULL DEFAULT 0,    -- 0 = sem categoria
+            account_id INTEGER NOT NULL DEFAULT 0,     -- 0 = sem conta
+            sector TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL,
+            total_cents INTEGER NOT NULL DEFAULT 0,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (ym, type, category_id, account_id, sector, status)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_ai AFTER INSERT ON transactions BEGIN
+            {_rollup_add_sql("NEW")}
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_ad AFTER DELETE ON transactions BEGIN
+            {_rollup_sub_sql("OLD")}
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_au
+        AFTER UPDATE OF trx_date, type, category_id, account_id, sector, status, amount ON transactions BEGIN
+            {_rollup_sub_sql("OLD")}
+            {_rollup_add_sql("NEW")}
+        END;
+    """)
+
+def _m006_monthly_rollup(conn: sqlite3.Connection):
+    _create_monthly_rollup(conn)
+    _rebuild_monthly_rollup(conn)
+
+def _rebuild_monthly_rollup(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM monthly_rollup;")
+    conn.execute(f"""
+        INSERT INTO monthly_rollup ({_ROLLUP_KEY}, total_cents, n)
+        SELECT substr(trx_date, 1, 7), type, IFNULL(category_id, 0), IFNULL(account_id, 0),
+               IFNULL(sector, ''), status, SUM({_cents_sql()}), COUNT(*)
+          FROM transactions
+         GROUP BY 1, 2, 3, 4, 5, 6;
+    """)
+
+def rebuild_monthly_rollup():
+    """Recalcula o monthly_rollup inteiro a partir de transactions (correção/conferência)."""
+    _db_write(_rebuild_monthly_rollup, tables=("monthly_rollup",))
+
+def _m007_quote_cache(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS quote_cache (
+            symbol TEXT PRIMARY KEY,
+            price REAL NOT NULL,
+            fetched_at REAL NOT NULL    -- epoch (s)
+        );
+    """)
+
+def _m008_calendar_occurrences(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    # Uma linha por (data, evento) dentro da janela; a PK em occ_date faz do mês uma busca por faixa
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS calendar_occurrences (
+            occ_date TEXT NOT NULL,
+            event_id INTEGER NOT NULL,
+            PRIMARY KEY (occ_date, event_id)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cal_occ_event ON calendar_occurrences(event_id);")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cal_occ_ad AFTER DELETE ON calendar_events BEGIN
+            DELETE FROM calendar_occurrences WHERE event_id = OLD.id;
+        END;
+    """)
+    today = date.today()
+    _set_occurrence_window(conn, today - timedelta(days=CAL_OCC_PAST_DAYS), today + timedelta(days=CAL_OCC_HORIZON_DAYS))
+    conn.execute("DELETE FROM calendar_occurrences;")
+    _materialize_occurrences(conn)
+
+def _m009_rematerialize_occurrences(conn: sqlite3.Connection):
+    # regra mensal/anual passou a limitar o dia mês a mês (31/01 -> 29/02 -> 31/03), sem acumular
+    conn.execute("DELETE FROM calendar_occurrences;")
+    _materialize_occurrences(conn)
+
+def _m010_calendar_ics(conn: sqlite3.Connection):
+    _add_column(conn, "calendar_events", "updated_at", "updated_at TEXT")
+    _add_column(conn, "calendar_events", "ics_uid", "ics_uid TEXT")
+    conn.execute("UPDATE calendar_events SET updated_at = IFNULL(created_at, strftime('%Y-%m-%d %H:%M:%f','now')) WHERE updated_at IS NULL;")
+    # mesmo UID importado duas vezes pelo mesmo usuário = mesmo evento
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_cal_ics_uid
+        ON calendar_events(ics_uid, IFNULL(created_by, 0)) WHERE ics_uid IS NOT NULL;
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cal_events_ai AFTER INSERT ON calendar_events BEGIN
+            UPDATE calendar_events SET updated_at = strftime('%Y-%m-%d %H:%M:%f','now') WHERE id = NEW.id;
+        END;
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cal_events_au
+        AFTER UPDATE OF title, description, date, event_date, is_recurring, recur_rule, recur_until, is_public
+        ON calendar_events BEGIN
+            UPDATE calendar_events SET updated_at = strftime('%Y-%m-%d %H:%M:%f','now') WHERE id = NEW.id;
+        END;
+    """)
+    # exclusões não deixam updated_at para trás: o feed usa este carimbo no Last-Modified
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cal_events_ad_meta AFTER DELETE ON calendar_events BEGIN
+            INSERT INTO app_meta (key, value) VALUES ('cal_deleted_at', strftime('%Y-%m-%d %H:%M:%f','now'))
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value;
+        END;
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ics_tokens (
+            user_id INTEGER PRIMARY KEY,
+            token TEXT NOT NULL UNIQUE,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+# Saldo acumulado de cada conta no fim de cada mês com movimento (lançamentos cancelados fora).
+# Só um prefixo válido fica gravado: qualquer escrita no mês M apaga os checkpoints >= M daquela
+# conta, e o que falta é recalculado sob demanda a partir do monthly_rollup.
+def _checkpoint_invalidate_sql(ref: str) -> str:
+    return f"""
+        DELETE FROM account_balance_checkpoints
+         WHERE account_id = IFNULL({ref}.account_id, 0) AND ym >= substr({ref}.trx_date, 1, 7);
+    """
+
+def _create_balance_checkpoints(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS account_balance_checkpoints (
+            account_id INTEGER NOT NULL,
+            ym TEXT NOT NULL,                          -- 'AAAA-MM' (saldo ao fim do mês)
+            balance_cents INTEGER NOT NULL,
+            PRIMARY KEY (account_id, ym)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_ckpt_ai AFTER INSERT ON transactions BEGIN
+            {_checkpoint_invalidate_sql("NEW")}
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_ckpt_ad AFTER DELETE ON transactions BEGIN
+            {_checkpoint_invalidate_sql("OLD")}
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_ckpt_au
+        AFTER UPDATE OF trx_date, type, account_id, status, amount ON transactions BEGIN
+            {_checkpoint_invalidate_sql("OLD")}
+            {_checkpoint_invalidate_sql("NEW")}
+        END;
+    """)
+
+def _m011_account_balance_checkpoints(conn: sqlite3.Connection):
+    _create_balance_checkpoints(conn)
+
+# Valor em centavos como coluna gerada de `amount` (arredondado a 2 casas): os agregados do SQL
+# somam inteiros. O rollup e os checkpoints, derivados, são recriados já em centavos.
+_CENTS_TRIGGERS = ("trg_rollup_ai", "trg_rollup_ad", "trg_rollup_au", "trg_ckpt_ai", "trg_ckpt_ad", "trg_ckpt_au")
+
+def _m012_amount_cents(conn: sqlite3.Connection):
+    for name in _CENTS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name};")
+    conn.execute("UPDATE transactions SET amount = ROUND(amount, 2) WHERE amount <> ROUND(amount, 2);")
+    _add_column(conn, "transactions", "amount_cents",
+                f"amount_cents INTEGER GENERATED ALWAYS AS ({_cents_sql()}) VIRTUAL")
+    conn.execute("DROP TABLE IF EXISTS monthly_rollup;")
+    conn.execute("DROP TABLE IF EXISTS account_balance_checkpoints;")
+    _create_monthly_rollup(conn)
+    _rebuild_monthly_rollup(conn)
+    _create_balance_checkpoints(conn)
+
+def _m013_attachment_name(conn: sqlite3.Connection):
+    # attachment_path passa a ser o caminho do blob (relativo a ATTACH_DIR); o nome do arquivo enviado fica aqui
+    _add_column(conn, "transactions", "attachment_name", "attachment_name TEXT")
+
+# Busca textual: índice FTS5 de conteúdo externo (o texto fica só em transactions), mantido por
+# triggers. Acentos são ignorados e prefixos de 2-3 letras têm índice próprio (busca enquanto digita).
+_FTS_COLUMNS = ("description", "counterparty", "doc_number", "tags")
+
+def _fts_values(ref: str) -> str:
+    return ", ".join(f"{ref}.{c}" for c in _FTS_COLUMNS)
+
+def _create_transactions_fts(conn: sqlite3.Connection):
+    cols = ", ".join(_FTS_COLUMNS)
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+            {cols}, content='transactions', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_ai AFTER INSERT ON transactions BEGIN
+            INSERT INTO transactions_fts (rowid, {cols}) VALUES (new.id, {_fts_values("new")});
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_ad AFTER DELETE ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, {cols}) VALUES ('delete', old.id, {_fts_values("old")});
+        END;
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_fts_au AFTER UPDATE OF {cols} ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, {cols}) VALUES ('delete', old.id, {_fts_values("old")});
+            INSERT INTO transactions_fts (rowid, {cols}) VALUES (new.id, {_fts_values("new")});
+        END;
+    """)
+
+def _rebuild_transactions_fts(conn: sqlite3.Connection):
+    conn.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild');")
+
+def rebuild_search_index():
+    """Reindexa a busca textual inteira a partir de transactions (correção/conferência)."""
+    _db_write(_rebuild_transactions_fts, tables=("transactions_fts",), bulk=True)
+
+def _m014_transactions_fts(conn: sqlite3.Connection):
+    _create_transactions_fts(conn)
+    _rebuild_transactions_fts(conn)
+
+def _m015_reconciled_with(conn: sqlite3.Connection):
+    # Par da conciliação automática: a linha do extrato e o lançamento apontam um para o outro
+    _add_column(conn, "transactions", "reconciled_with", "reconciled_with INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trx_reconciled_with ON transactions(reconciled_with) "
+                 "WHERE reconciled_with IS NOT NULL;")
+
+# Ordem importa: cada migração roda uma única vez e fica registrada em schema_version.
+# Todas devem ser idempotentes (IF NOT EXISTS / _add_column) para bancos criados antes do versionamento.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "tabelas base", _m001_base_tables),
+    (2, "colunas de agenda em transactions/calendar_events", _m002_legacy_columns),
+    (3, "users, clients e suppliers", _m003_users_clients_suppliers),
+    (4, "cadastros mínimos", _m004_seed_minimums),
+    (5, "índices de transactions", _m005_transaction_indexes),
+    (6, "monthly_rollup + triggers", _m006_monthly_rollup),
+    (7, "cache da cotação do dólar", _m007_quote_cache),
+    (8, "índice de ocorrências da agenda", _m008_calendar_occurrences),
+    (9, "ocorrências mensais/anuais sem acúmulo do ajuste de dia", _m009_rematerialize_occurrences),
+    (10, "agenda .ics: updated_at, ics_uid e tokens do feed", _m010_calendar_ics),
+    (11, "checkpoints mensais de saldo por conta", _m011_account_balance_checkpoints),
+    (12, "valores em centavos inteiros (amount_cents, rollup e checkpoints)", _m012_amount_cents),
+    (13, "nome original do anexo (armazenamento por conteúdo)", _m013_attachment_name),
+    (14, "busca textual FTS5 em transactions + triggers", _m014_transactions_fts),
+    (15, "vínculo extrato x lançamento da conciliação (reconciled_with)", _m015_reconciled_with),
+]
+
+def _run_migrations() -> int:
+    with _connect() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+        current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            # BEGIN IMMEDIATE serializa com outros processos; relê a versão já com o lock
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                done = conn.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone()
+                if not done:
+                    migrate(conn)
+                    conn.execute("INSERT INTO schema_version (version, description) VALUES (?,?)",
+                                 (version, description))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            current = version
+        return current
+
+@st.cache_resource(show_spinner=False)
+def _schema_state() -> dict:
+    return {"lock": threading.Lock(), "version": None}
+
+def init_db():
+    """Aplica as migrações pendentes uma única vez por processo; reruns seguintes não tocam no schema."""
+    state = _schema_state()
+    if state["version"] is not None:
+        return
+    with state["lock"]:
+        if state["version"] is not None:
+            return
+        os.makedirs(ATTACH_DIR, exist_ok=True)
+        state["version"] = _run_migrations()
 
 # ===== Helper: coluna de data na tabela calendar_events pode variar =====
 _CAL_DATE_COL = None
@@ -471,20 +1609,139 @@ def _detect_calendar_date_col() -> str:
 def cal_date_col() -> str:
     global _CAL_DATE_COL
     if _CAL_DATE_COL is None:
-        _CAL_DATE_COL = _detect_calendar_date_col()
+        state = _schema_state()
+        if "cal_date_col" not in state:
+            state["cal_date_col"] = _detect_calendar_date_col()
+        _CAL_DATE_COL = state["cal_date_col"]
     return _CAL_DATE_COL
 
 # ====================== Escopo (placeholder para multi-empresa) ======================
 def scope_filters(base_query: str, params: List) -> Tuple[str, List]:
     return base_query, params
 
+# ====================== Cadastros em memória (id -> nome) ======================
+# Contas, categorias e setores são tabelas pequenas: os nomes ficam num dict do processo e as
+# páginas trocam ids por nomes no pandas, sem subconsulta por linha. Cada dict guarda o mesmo
+# carimbo do cache de consultas (table_generations): escritas locais na tabela e commits de outros
+# processos (PRAGMA data_version, via _ExternalChanges) o invalidam no próximo acesso, e ele não
+# vive mais que QUERY_CACHE_MAX_AGE_S.
+_DIMENSION_TABLES = ("accounts", "categories", "sectors")
+
+@st.cache_resource(show_spinner=False)
+def _dimension_cache() -> dict:
+    return {"lock": threading.Lock(), "data": {}}
+
+def dimension_names(table: str) -> dict:
+    """{id: nome} de `table` (accounts, categories ou sectors)."""
+    if table not in _DIMENSION_TABLES:
+        raise ValueError(f"cadastro desconhecido: {table}")
+    cache = _dimension_cache()
+    stamp = table_generations((table,))
+    hit = cache["data"].get(table)
+    if hit is not None and hit[0] == stamp and time.monotonic() - hit[2] <= QUERY_CACHE_MAX_AGE_S:
+        return hit[1]
+    with _connect() as conn:
+        names = dict(conn.execute(f"SELECT id, name FROM {table}").fetchall())
+    with cache["lock"]:
+        cache["data"][table] = (stamp, names, time.monotonic())
+    return names
+
+def label_dimensions(df: pd.DataFrame, columns: Iterable[Tuple[str, str]] = (("Categoria", "categories"),
+                                                                           ("Conta", "accounts"))) -> pd.DataFrame:
+    """Troca, nas colunas presentes, os ids pelos nomes do cadastro; ids sem cadastro viram NaN."""
+    for col, table in columns:
+        if col in df.columns:
+            df[col] = df[col].map(dimension_names(table))
+    return df
+
+def category_totals(query: str, params: Tuple = ()) -> pd.DataFrame:
+    """Consulta com (category_id, Total) -> Categoria/Total por nome, do maior para o menor."""
+    df = fetch_df(query, params).rename(columns={"category_id": "Categoria"})
+    if df.empty:
+        return pd.DataFrame(columns=["Categoria", "Total"])
+    df = label_dimensions(df, (("Categoria", "categories"),)).fillna({"Categoria": "(sem categoria)"})
+    return df.groupby("Categoria", as_index=False)["Total"].sum().sort_values("Total", ascending=False, ignore_index=True)
+
 # ====================== Helpers UI/Export ======================
+_PTBR_NUM = str.maketrans(",.", ".,")
+
 def money(v: float) -> str:
     try:
-        return (f"R$ {float(v):,.2f}").replace(",", "X").replace(".", ",").replace("X", ".")
+        # `or 0.0` troca o -0.0 de valores como -0,004 por 0: nunca "R$ -0,00"
+        return f"R$ {round(float(v), 2) or 0.0:,.2f}".translate(_PTBR_NUM)
     except Exception:
         return "R$ 0,00"
 
+def parse_money_cents(raw) -> Optional[int]:
+    """'1.234,56' / '1234.56' / '1234,5' -> 123456 (Decimal, sem passar por float); None se inválido."""
+    s = str(raw or "").strip().replace(" ", "").replace("R$", "")
+    if not s:
+        return None
+    if "," in s and "." in s:
+        s = s.replace(".", "").replace(",", ".") if s.rfind(",") > s.rfind(".") else s.replace(",", "")
+    else:
+        s = s.replace(",", ".")
+    try:
+        return int((Decimal(s) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return None
+
+# Colunas de valor formatadas como R$ nas tabelas e no CSV exportado
+MONEY_COLUMNS = ("Valor", "Total", "Saldo", "Entradas", "Saídas", "Total_Receitas", "Total_Despesas")
+
+_POW10 = 10 ** np.arange(1, 19, dtype=np.int64)
+
+def money_series(values: pd.Series, symbol: bool = True) -> pd.Series:
+    """Formata a coluna inteira em pt-BR (R$ 1.234,56) de uma vez; NaN vira ''.
+
+    Os dígitos são escritos numa matriz de bytes (uma linha por valor, alinhada à direita),
+    sem formatar valor a valor em Python. Não é byte a byte igual a money(): o arredondamento é
+    floor(|v| * 100 + 0,5), que pode diferir em empates de meio centavo com valores grandes
+    (money arredonda pela representação decimal do float).
+    """
+    num = pd.to_numeric(values, errors="coerce").to_numpy(dtype="float64")
+    valid = ~np.isnan(num)
+    num = np.where(valid, num, 0.0)
+    cents = np.floor(np.abs(num) * 100 + 0.5).astype(np.int64)
+    neg = (num < 0) & (cents > 0)
+    reais = cents // 100
+    nd = 1 + (reais[:, None] >= _POW10).sum(axis=1)          # dígitos da parte inteira
+    digits = int(nd.max()) if len(nd) else 1
+    prefix = b"R$ " if symbol else b""
+    width = len(prefix) + 1 + digits + (digits - 1) // 3 + 3
+    rows = np.arange(len(num))
+
+    m = np.full((len(num), width), ord(" "), dtype=np.uint8)
+    m[:, -1] = 48 + cents % 10
+    m[:, -2] = 48 + (cents // 10) % 10
+    m[:, -3] = ord(",")
+    col, rest = width - 4, reais.copy()
+    for i in range(digits):
+        if i and i % 3 == 0:
+            m[nd > i, col] = ord(".")
+            col -= 1
+        show = nd > i
+        m[show, col] = 48 + rest[show] % 10
+        rest //= 10
+        col -= 1
+    start = width - (nd + (nd - 1) // 3 + 3) - neg
+    m[rows[neg], start[neg]] = ord("-")
+    for j, ch in enumerate(prefix):
+        m[rows, start - len(prefix) + j] = ch
+
+    out = np.char.lstrip(m.view(f"S{width}").ravel().astype(f"U{width}"))
+    return pd.Series(out, index=values.index, dtype=object).where(valid, "")
+
+def format_money_columns(df: pd.DataFrame, cols: Optional[Iterable[str]] = None, symbol: bool = True) -> pd.DataFrame:
+    """Cópia de `df` com as colunas de valor (MONEY_COLUMNS por padrão) já formatadas em pt-BR."""
+    cols = [c for c in (cols or MONEY_COLUMNS) if c in df.columns and pd.api.types.is_numeric_dtype(df[c])]
+    if not cols:
+        return df
+    out = df.copy()
+    for c in cols:
+        out[c] = money_series(out[c], symbol=symbol)
+    return out
+
 def safe_label(x):
     try:
         lab = x[1] if isinstance(x, tuple) else x
@@ -494,19 +1751,192 @@ def safe_label(x):
     except Exception:
         return "—"
 
-def export_excel(df: pd.DataFrame, filename: str = "relatorio.xlsx"):
+# ===== Exportação (gerada só quando pedida, em blocos direto do cursor) =====
+_XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Streamlit recente aceita `data` como função e só a chama no clique do botão
+_DEFERRED_DOWNLOADS = "deferred data generation" in (getattr(st.download_button, "__doc__", "") or "")
+
+def _download(label: str, make: Callable[[], Any], file_name: str, mime: str, key: str):
+    if _DEFERRED_DOWNLOADS:
+        st.download_button(label, data=make, file_name=file_name, mime=mime, key=key)
+    elif st.button(f"{label} (preparar)", key=f"{key}_prep"):
+        st.download_button(label, data=make(), file_name=file_name, mime=mime, key=key)
+
+def _iter_query_chunks(query: str, params: Tuple = (), chunk: int = EXPORT_CHUNK_ROWS):
+    """Primeiro os nomes das colunas, depois blocos de até `chunk` linhas lidas do cursor."""
+    with _connect() as conn:
+        cur = conn.execute(query, params)
+        yield [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            yield rows
+
+# Dialeto único dos CSV exportados (consultas e DataFrames): separador ';', decimal ',' e valores
+# 1.234,56 nas MONEY_COLUMNS, em UTF-8 com BOM — abre direto no Excel em português
+_CSV_SEP, _CSV_DECIMAL, _CSV_ENCODING = ";", ",", "utf-8-sig"
+
+def _write_csv_frame(df: pd.DataFrame, text, header: bool = True):
+    format_money_columns(df, symbol=False).to_csv(text, index=False, header=header, sep=_CSV_SEP,
+                                                  decimal=_CSV_DECIMAL, lineterminator="\n")
+
+def write_csv_export(query: str, params: Tuple, out) -> int:
+    """Grava o resultado da consulta como CSV no arquivo binário `out` (mesmo dialeto de export_csv); devolve as linhas."""
+    text = io.TextIOWrapper(out, encoding=_CSV_ENCODING, newline="")
+    chunks = _iter_query_chunks(query, params)
+    cols = next(chunks)
+    _write_csv_frame(pd.DataFrame(columns=cols), text)
+    n = 0
+    for rows in chunks:
+        _write_csv_frame(pd.DataFrame.from_records(rows, columns=cols), text, header=False)
+        n += len(rows)
+    text.flush()
+    text.detach()
+    return n
+
+def write_xlsx_export(query: str, params: Tuple, out) -> int:
+    """Grava o resultado como XLSX com o workbook write-only do openpyxl (memória constante)."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    chunks = _iter_query_chunks(query, params)
+    ws.append(next(chunks))
+    n = 0
+    for rows in chunks:
+        for r in rows:
+            ws.append(r)
+        n += len(rows)
+    wb.save(out)
+    return n
+
+def _tempfile_bytes(fill: Callable[[Any], Any]) -> bytes:
+    # O download do Streamlit só aceita str/bytes/BytesIO/BufferedReader (TemporaryFile é
+    # BufferedRandom): o conteúdo é gerado em blocos num arquivo temporário e entregue como bytes
+    with tempfile.TemporaryFile() as f:
+        fill(f)
+        f.seek(0)
+        return f.read()
+
+def _export_bytes(writer: Callable[[str, Tuple, Any], int], query: str, params: Tuple) -> bytes:
+    return _tempfile_bytes(lambda f: writer(query, tuple(params), f))
+
+def _export_downloads(query: str, params: Tuple, basename: str) -> List[Tuple[str, Callable[[], bytes], str, str]]:
+    """(rótulo, gerador, arquivo, mime) dos botões de export_query."""
+    return [
+        ("⬇️ Exportar Excel", lambda: _export_bytes(write_xlsx_export, query, params), f"{basename}.xlsx", _XLSX_MIME),
+        ("⬇️ Exportar CSV", lambda: _export_bytes(write_csv_export, query, params), f"{basename}.csv", "text/csv"),
+    ]
+
+def export_query(query: str, params: Tuple, basename: str):
+    """Botões de Excel/CSV para uma consulta inteira, sem carregá-la num DataFrame."""
+    for col, (label, make, file_name, mime) in zip(st.columns(2), _export_downloads(query, params, basename)):
+        with col:
+            _download(label, make, file_name, mime, key=f"exp_{basename}_{file_name.rsplit('.', 1)[1]}")
+
+def _df_xlsx_bytes(df: pd.DataFrame) -> bytes:
     buf = BytesIO()
     with pd.ExcelWriter(buf, engine="openpyxl") as writer:
         df.to_excel(writer, index=False)
-    st.download_button("⬇️ Exportar Excel", data=buf.getvalue(),
-                       file_name=filename,
-                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    return buf.getvalue()
+
+def export_excel(df: pd.DataFrame, filename: str = "relatorio.xlsx"):
+    _download("⬇️ Exportar Excel", lambda: _df_xlsx_bytes(df), filename, _XLSX_MIME, key=f"exp_df_{filename}")
+
+def _df_csv_bytes(df: pd.DataFrame) -> bytes:
+    buf = io.StringIO()
+    _write_csv_frame(df, buf)
+    return buf.getvalue().encode(_CSV_ENCODING)
 
 def export_csv(df: pd.DataFrame, filename: str = "relatorio.csv"):
-    st.download_button("⬇️ Exportar CSV",
-                       data=df.to_csv(index=False).encode("utf-8"),
-                       file_name=filename,
-                       mime="text/csv")
+    _download("⬇️ Exportar CSV", lambda: _df_csv_bytes(df), filename, "text/csv", key=f"exp_df_{filename}")
+
+# ====================== Anexos (armazenamento por conteúdo) ======================
+# Cada arquivo é guardado uma vez, pelo sha256 do conteúdo, em ATTACH_DIR/sha256/ab/cd/<hash><ext>;
+# transactions.attachment_path guarda esse caminho relativo. Anexos antigos (caminho absoluto com
+# timestamp no nome) continuam válidos e não são tocados pela coleta.
+_ATTACH_BLOBS = "sha256"
+_ATTACH_EXTS = (".pdf", ".png", ".jpg", ".jpeg")
+
+def _blob_relpath(digest: str, ext: str) -> str:
+    return "/".join((_ATTACH_BLOBS, digest[:2], digest[2:4], digest + ext))
+
+def attachment_abspath(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(ATTACH_DIR, *path.split("/"))
+
+def store_attachment(f, file_name: str) -> str:
+    """Grava o arquivo `f` (lido em blocos) no armazenamento por conteúdo; devolve o caminho relativo.
+
+    Conteúdo já guardado não é gravado de novo: o temporário é descartado e o blob existente
+    tem o mtime renovado (a coleta respeita ATTACH_GC_GRACE_S a partir dele).
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+    ext = ext if ext in _ATTACH_EXTS else ""
+    tmp_dir = os.path.join(ATTACH_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    if hasattr(f, "seek"):
+        f.seek(0)
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                block = f.read(ATTACH_CHUNK)
+                if not block:
+                    break
+                h.update(block)
+                out.write(block)
+            out.flush()
+            os.fsync(out.fileno())
+        rel = _blob_relpath(h.hexdigest(), ext)
+        target = attachment_abspath(rel)
+        if os.path.exists(target):
+            os.utime(target)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp, target)
+        return rel
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def collect_attachment_garbage(dry_run: bool = False, grace_s: float = ATTACH_GC_GRACE_S) -> dict:
+    """Remove blobs que nenhum lançamento referencia (e temporários de uploads interrompidos).
+
+    Só blobs com mtime anterior a `grace_s` segundos são removidos, para não apagar o arquivo de
+    um upload cujo lançamento ainda não foi gravado.
+    """
+    refs = set(fetch_df(
+        "SELECT DISTINCT attachment_path FROM transactions WHERE attachment_path LIKE ?", (_ATTACH_BLOBS + "/%",)
+    )["attachment_path"])
+    cutoff = time.time() - grace_s
+    stats = {"blobs": 0, "referenced": 0, "removed": 0, "freed_bytes": 0}
+    for root in (os.path.join(ATTACH_DIR, _ATTACH_BLOBS), os.path.join(ATTACH_DIR, "tmp")):
+        for dirpath, _, files in os.walk(root, topdown=False):
+            for name in files:
+                full = os.path.join(dirpath, name)
+                rel = os.path.relpath(full, ATTACH_DIR).replace(os.sep, "/")
+                is_blob = rel.startswith(_ATTACH_BLOBS + "/") and not rel.endswith(_PREVIEW_SUFFIX)
+                stats["blobs"] += is_blob
+                if rel in refs or rel.removesuffix(_PREVIEW_SUFFIX) in refs:
+                    stats["referenced"] += 1
+                    continue
+                try:
+                    info = os.stat(full)
+                    if info.st_mtime >= cutoff:
+                        continue
+                    if not dry_run:
+                        os.remove(full)
+                except FileNotFoundError:
+                    continue
+                stats["removed"] += 1
+                stats["freed_bytes"] += info.st_size
+            if not dry_run and dirpath != root:
+                try:
+                    os.rmdir(dirpath)   # só sai se a pasta do shard ficou vazia
+                except OSError:
+                    pass
+    return stats
 
 def _read_file_bytes(path: str) -> Optional[bytes]:
     try:
@@ -515,21 +1945,330 @@ def _read_file_bytes(path: str) -> Optional[bytes]:
     except Exception:
         return None
 
-def show_attachment_ui(path: str):
-    if not path or not os.path.exists(path):
+# ===== Prévias: imagem reduzida ou 1ª página do PDF, em JPEG ao lado do blob (<blob>.preview.jpg) =====
+# v2: prévias passaram a respeitar a orientação EXIF; as antigas (.preview.jpg, possivelmente
+# deitadas) deixam de ser usadas e a coleta de anexos as remove como arquivos sem referência
+_PREVIEW_SUFFIX = ".preview.v2.jpg"
+_PREVIEW_FAILED_MAX = 1024    # falhas lembradas pelo worker (as mais antigas são esquecidas)
+_IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+
+def preview_supported(full: str) -> bool:
+    ext = os.path.splitext(full)[1].lower()
+    return (ext in _IMAGE_EXTS and Image is not None) or (ext == ".pdf" and pdfium is not None and Image is not None)
+
+def _render_preview(full: str, out: str):
+    if full.lower().endswith(".pdf"):
+        doc = pdfium.PdfDocument(full)
+        try:
+            page = doc[0]
+            img = page.render(scale=ATTACH_PREVIEW_PX / max(page.get_size())).to_pil()
+        finally:
+            doc.close()
+    else:
+        img = Image.open(full)
+        img.draft("RGB", (ATTACH_PREVIEW_PX, ATTACH_PREVIEW_PX))   # JPEG: decodifica já reduzido
+        img = ImageOps.exif_transpose(img)   # foto de celular: gira conforme a tag (o JPEG salvo não a leva)
+        img.thumbnail((ATTACH_PREVIEW_PX, ATTACH_PREVIEW_PX))
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, "white")
+        bg.paste(img, mask=img.getchannel("A"))
+        img = bg
+    tmp = f"{out}.{threading.get_ident()}.part"
+    img.save(tmp, "JPEG", quality=80, optimize=True)
+    os.replace(tmp, out)
+
+class _PreviewWorker:
+    """Thread que gera as prévias fora do rerun; pedidos repetidos do mesmo arquivo compartilham o Future.
+
+    Falhas ficam guardadas por arquivo (o blob não muda de conteúdo), até _PREVIEW_FAILED_MAX:
+    pedir de novo devolve o mesmo erro na hora, sem voltar para a fila.
+    """
+
+    def __init__(self):
+        self._q: "queue.Queue[str]" = queue.Queue()
+        self._pending: dict = {}
+        self._failed: "OrderedDict[str, Exception]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="finapp-previews", daemon=True)
+        self._thread.start()
+
+    def submit(self, full: str) -> Future:
+        with self._lock:
+            if full in self._failed:
+                fut = Future()
+                fut.set_exception(self._failed[full])
+                return fut
+            fut = self._pending.get(full)
+            if fut is None:
+                fut = self._pending[full] = Future()
+                self._q.put(full)
+            return fut
+
+    def _run(self):
+        while True:
+            full = self._q.get()
+            with self._lock:
+                fut = self._pending[full]
+            out = full + _PREVIEW_SUFFIX
+            try:
+                if not os.path.exists(out):
+                    with trace_span("preview", os.path.splitext(full)[1].lower()):
+                        _render_preview(full, out)
+            except Exception as e:
+                with self._lock:
+                    self._failed[full] = e
+                    while len(self._failed) > _PREVIEW_FAILED_MAX:
+                        self._failed.popitem(last=False)
+                fut.set_exception(e)
+            else:
+                fut.set_result(out)
+            with self._lock:
+                self._pending.pop(full, None)
+
+    def failed(self, full: str) -> bool:
+        with self._lock:
+            return full in self._failed
+
+@st.cache_resource(show_spinner=False)
+def _preview_worker() -> _PreviewWorker:
+    return _PreviewWorker()
+
+def request_preview(full: str) -> Optional[Future]:
+    """Agenda a prévia de `full` (se o tipo tiver suporte e ela ainda não existir); se a geração já
+    falhou antes, o Future volta com o erro, sem reagendar."""
+    if not preview_supported(full) or os.path.exists(full + _PREVIEW_SUFFIX):
+        return None
+    return _preview_worker().submit(full)
+
+def attachment_preview(full: str, wait: float = ATTACH_PREVIEW_WAIT_S) -> Optional[str]:
+    """Caminho da prévia de `full`, esperando até `wait` s pela geração; None se não houver/atrasar/falhar."""
+    out = full + _PREVIEW_SUFFIX
+    if os.path.exists(out):
+        return out
+    fut = request_preview(full)
+    if fut is None:
+        return None
+    try:
+        return fut.result(timeout=wait)
+    except Exception:
+        return None
+
+def show_attachment_ui(path: str, name: Optional[str] = None):
+    full = attachment_abspath(path) if path else ""
+    if not full or not os.path.exists(full):
         st.warning("Anexo não encontrado no disco.")
         return
-    fname = os.path.basename(path)
-    ext = os.path.splitext(path)[1].lower()
-    data = _read_file_bytes(path)
-    if data is None:
-        st.error("Falha ao abrir o anexo.")
-        return
-    if ext in (".png", ".jpg", ".jpeg"):
-        st.image(data, caption=fname, use_column_width=True)
+    fname = name or os.path.basename(full)
+    ext = os.path.splitext(full)[1].lower()
+    preview = attachment_preview(full)
+    failed = preview is None and preview_supported(full) and _preview_worker().failed(full)
+    if preview:
+        st.image(preview, caption=f"{fname} (prévia)" if ext == ".pdf" else fname, use_column_width=True)
+    elif preview_supported(full) and not failed:
+        st.caption("Gerando a prévia do anexo… ela aparece na próxima atualização da página.")
+    elif failed:
+        # arquivo que o Pillow/pdfium não abriu: o st.image do original falharia do mesmo jeito
+        st.info("Não foi possível gerar a prévia deste anexo. Use o botão para baixar o arquivo.")
+    elif ext in _IMAGE_EXTS:
+        st.image(full, caption=fname, use_column_width=True)
     else:
-        st.info("Pré-visualização inline disponível apenas para imagens. Use o botão para baixar o arquivo.")
-    st.download_button("⬇️ Baixar anexo", data=data, file_name=fname)
+        st.info("Pré-visualização de PDF requer o pypdfium2 (pip install pypdfium2). Use o botão para baixar o arquivo.")
+    # O arquivo só é lido quando o botão é clicado, não a cada rerun
+    _download("⬇️ Baixar anexo", lambda: _read_file_bytes(full), fname, "application/octet-stream",
+              key=f"attach_{os.path.basename(full)}")
+
+# ====================== Importação de extratos (CSV/OFX) ======================
+# Cada linha lida vira um dict: date (ISO), amount (com sinal), description, id, counterparty, doc, category
+_IMPORT_DATE_RE = re.compile(r"^(?:(\d{4})-?(\d{2})-?(\d{2})|(\d{1,2})[/.-](\d{1,2})[/.-](\d{2}|\d{4}))(?!\d)")
+_CSV_COLUMN_HINTS = {
+    "date": ("data", "date", "dt", "data lançamento", "data lancamento"),
+    "amount": ("valor", "amount", "value", "vlr", "valor (r$)"),
+    "description": ("descrição", "descricao", "histórico", "historico", "description", "memo", "lançamento"),
+    "id": ("id", "fitid", "identificador", "id transação", "id transacao"),
+    "counterparty": ("contraparte", "favorecido", "nome", "name", "beneficiário"),
+    "doc": ("documento", "doc", "nº documento", "numero documento", "checknum"),
+    "category": ("categoria", "category"),
+}
+_IMPORT_INSERT_SQL = """
+    INSERT OR IGNORE INTO transactions (
+        trx_date, paid_date, type, category_id, account_id, doc_number, counterparty,
+        description, amount, status, origin, external_id
+    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+@lru_cache(maxsize=4096)  # extratos repetem poucas datas distintas
+def _parse_import_date(s: str) -> Optional[str]:
+    """AAAA-MM-DD, AAAAMMDD (OFX) ou DD/MM/AAAA (também DD-MM-AA e DD.MM.AAAA)."""
+    m = _IMPORT_DATE_RE.match((s or "").strip())
+    if not m:
+        return None
+    y, mo, d = (m.group(1), m.group(2), m.group(3)) if m.group(1) else (m.group(6), m.group(5), m.group(4))
+    y = int(y) + (2000 if len(y) == 2 else 0)
+    try:
+        return date(y, int(mo), int(d)).isoformat()
+    except ValueError:
+        return None
+
+def _parse_import_amount(s) -> Optional[float]:
+    """Aceita 1.234,56 / 1,234.56 / -12,30 / 12,30- / (12,30) / R$ 12,30."""
+    s = str(s or "").strip().replace("R$", "").replace(" ", "").replace("\xa0", "")
+    neg = (s.startswith("(") and s.endswith(")")) or s.endswith("-")
+    s = s.strip("()").rstrip("-")
+    if "," in s and "." in s:
+        s = s.replace(".", "").replace(",", ".") if s.rfind(",") > s.rfind(".") else s.replace(",", "")
+    else:
+        s = s.replace(",", ".")
+    try:
+        v = round(float(s), 2)
+    except ValueError:
+        return None
+    return -v if neg else v
+
+def csv_statement_header(f, encoding: str = "utf-8-sig") -> Tuple[List[str], str]:
+    """(colunas, delimitador) do CSV, lendo só o começo do arquivo; `f` volta ao início."""
+    head = f.read(8192)
+    f.seek(0)
+    sample = head.decode(encoding, errors="ignore")
+    try:
+        delim = csv.Sniffer().sniff(sample, delimiters=";,\t|").delimiter
+    except csv.Error:
+        delim = ";" if sample.count(";") > sample.count(",") else ","
+    first = next(csv.reader(io.StringIO(sample), delimiter=delim), [])
+    return [c.strip() for c in first], delim
+
+def guess_csv_mapping(header: List[str]) -> dict:
+    """Campo -> coluna do CSV, pelo nome do cabeçalho (ausentes ficam None)."""
+    lower = {c.strip().lower(): c for c in header}
+    return {field: next((lower[h] for h in hints if h in lower), None) for field, hints in _CSV_COLUMN_HINTS.items()}
+
+def iter_csv_statement(f, mapping: dict, encoding: str = "utf-8-sig"):
+    """Lê o CSV linha a linha (arquivo binário `f`), usando `mapping` campo -> coluna."""
+    _, delim = csv_statement_header(f, encoding)
+    text = io.TextIOWrapper(f, encoding=encoding, errors="replace", newline="")
+    try:
+        for row in csv.DictReader(text, delimiter=delim):
+            row = {(k or "").strip(): v for k, v in row.items()}
+            get = lambda field: (row.get(mapping[field]) or "").strip() if mapping.get(field) else None
+            yield {
+                "date": _parse_import_date(get("date")),
+                "amount": _parse_import_amount(get("amount")),
+                "description": get("description"),
+                "id": get("id") or None,
+                "counterparty": get("counterparty") or None,
+                "doc": get("doc") or None,
+                "category": get("category"),
+            }
+    finally:
+        text.detach()
+
+_OFX_TAG_RE = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+def _ofx_line(trn: dict) -> dict:
+    memo, name = trn.get("MEMO"), trn.get("NAME")
+    return {
+        "date": _parse_import_date(trn.get("DTPOSTED", "")[:8]),
+        "amount": _parse_import_amount(trn.get("TRNAMT")),
+        "description": memo or name or "",
+        "id": trn.get("FITID") or None,
+        "counterparty": name if memo else None,
+        "doc": trn.get("CHECKNUM") or None,
+        "category": None,
+    }
+
+def iter_ofx_statement(f, chunk: int = 65536):
+    """Lê os <STMTTRN> de um OFX (SGML ou XML) em blocos, sem montar a árvore do arquivo."""
+    head = f.read(4096)
+    f.seek(0)
+    enc = "utf-8" if re.search(rb"(ENCODING|CHARSET)\s*[:=]\s*\"?UTF-?8", head, re.IGNORECASE) else "cp1252"
+    text = io.TextIOWrapper(f, encoding=enc, errors="replace", newline="")
+    trn, buf = None, ""
+    try:
+        while True:
+            data = text.read(chunk)
+            buf += data
+            # a última tag do bloco pode estar cortada: processa só até o último "<"
+            cut = buf.rfind("<") if data else len(buf)
+            if cut <= 0:
+                if not data:
+                    break
+                continue
+            for m in _OFX_TAG_RE.finditer(buf, 0, cut):
+                closing, tag = m.group(1), m.group(2).upper()
+                if tag == "STMTTRN":
+                    if trn:
+                        yield _ofx_line(trn)
+                    trn = None if closing else {}
+                elif trn is not None and not closing:
+                    trn[tag] = html.unescape(m.group(3).strip())
+            buf = buf[cut:]
+            if not data:
+                break
+    finally:
+        text.detach()
+    if trn:
+        yield _ofx_line(trn)
+
+def _import_rows(lines, account_id: int, origin: str, status: str, default_category_id: Optional[int],
+                 categories: dict, stats: dict):
+    seen = {}
+    for ln in lines:
+        stats["read"] += 1
+        dt, amt = ln["date"], ln["amount"]
+        if not dt or not amt:
+            stats["rejected"] += 1
+            continue
+        desc = (ln["description"] or "").strip()
+        if ln["id"]:
+            ext = f"{origin}:{account_id}:{ln['id']}"
+        else:
+            # sem ID do banco: hash do conteúdo + ordem entre linhas idênticas do mesmo arquivo
+            base = f"{account_id}|{dt}|{amt:.2f}|{desc.lower()}"
+            n = seen.get(base, 0)
+            seen[base] = n + 1
+            ext = f"{origin}:{account_id}:h:" + hashlib.sha1(f"{base}|{n}".encode("utf-8")).hexdigest()
+        cat = categories.get((ln["category"] or "").strip().lower(), default_category_id)
+        yield (dt, dt if status in ("paid", "reconciled") else None, "income" if amt > 0 else "expense",
+               cat, account_id, ln["doc"], ln["counterparty"], desc, abs(amt), status, origin, ext)
+
+def import_statement(lines, account_id: int, origin: str = "import", status: str = "paid",
+                     default_category_id: Optional[int] = None, batch_rows: int = IMPORT_BATCH_ROWS) -> dict:
+    """Grava as linhas do extrato em lotes de `batch_rows` (INSERT OR IGNORE por external_id).
+
+    Devolve as contagens (lidas, inseridas, duplicadas, rejeitadas) e a vazão em linhas/s.
+    """
+    cats = fetch_df("SELECT id, name FROM categories")
+    categories = {str(r.name).strip().lower(): int(r.id) for r in cats.itertuples(index=False)}
+    stats = {"read": 0, "inserted": 0, "duplicates": 0, "rejected": 0, "seconds": 0.0, "rows_per_s": 0.0}
+    t0 = time.perf_counter()
+    rows = _import_rows(lines, account_id, origin, status, default_category_id, categories, stats)
+    while True:
+        batch = list(itertools.islice(rows, batch_rows))
+        if not batch:
+            break
+        stats["inserted"] += _db_write(lambda conn: conn.executemany(_IMPORT_INSERT_SQL, batch).rowcount,
+                                       tables=("transactions",), bulk=True)
+    stats["duplicates"] = stats["read"] - stats["rejected"] - stats["inserted"]
+    stats["seconds"] = time.perf_counter() - t0
+    stats["rows_per_s"] = stats["read"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+def import_statement_file(f, file_name: str, account_id: int, mapping: Optional[dict] = None,
+                          encoding: str = "utf-8-sig", default_category_id: Optional[int] = None) -> dict:
+    """OFX pela extensão (origin 'bank'); senão CSV com `mapping` (ou adivinhado pelo cabeçalho)."""
+    if file_name.lower().endswith(".ofx"):
+        return import_statement(iter_ofx_statement(f), account_id, origin="bank",
+                                default_category_id=default_category_id)
+    if mapping is None:
+        mapping = guess_csv_mapping(csv_statement_header(f, encoding)[0])
+    if not (mapping.get("date") and mapping.get("amount")):
+        raise ValueError("Informe as colunas de data e valor do CSV.")
+    return import_statement(iter_csv_statement(f, mapping, encoding), account_id, origin="import",
+                            default_category_id=default_category_id)
+
+def import_summary(file_name: str, stats: dict) -> str:
+    return (f"{file_name}: {stats['inserted']} novo(s), {stats['duplicates']} duplicado(s), "
+            f"{stats['rejected']} rejeitado(s) em {stats['seconds']:.1f} s ({stats['rows_per_s']:,.0f} linhas/s)")
 
 # ====================== Agenda: helpers ======================
 def _parse_date(s: str) -> datetime:
@@ -547,45 +2286,56 @@ def add_calendar_event(
     created_by: Optional[int] = None,
 ):
     col = cal_date_col()
-    exec_sql(
-        f"""
-        INSERT INTO calendar_events (title, description, {col}, is_recurring, recur_rule, recur_until,
-                                     src_transaction_id, is_public, created_by)
-        VALUES (?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            title.strip(),
-            (description or "").strip(),
-            dt.isoformat(),
-            1 if is_recurring else 0,
-            (recur_rule or None),
-            (recur_until.isoformat() if recur_until else None),
-            src_transaction_id,
-            1 if is_public else 0,
-            created_by,
-        ),
-    )
+
+    def _insert(conn: sqlite3.Connection):
+        eid = conn.execute(
+            f"""
+            INSERT INTO calendar_events (title, description, {col}, is_recurring, recur_rule, recur_until,
+                                         src_transaction_id, is_public, created_by)
+            VALUES (?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                title.strip(),
+                (description or "").strip(),
+                dt.isoformat(),
+                1 if is_recurring else 0,
+                (recur_rule or None),
+                (recur_until.isoformat() if recur_until else None),
+                src_transaction_id,
+                1 if is_public else 0,
+                created_by,
+            ),
+        ).lastrowid
+        _materialize_occurrences(conn, [eid])
+        return eid
+    return _calendar_write(_insert)
 
 def update_calendar_event(eid: int, title: str, description: str, dt: date,
                           is_recurring: bool, recur_rule: Optional[str], recur_until: Optional[date],
                           is_public: bool):
     col = cal_date_col()
-    exec_sql(
-        f"""
-        UPDATE calendar_events
-           SET title=?, description=?, {col}=?, is_recurring=?, recur_rule=?, recur_until=?, is_public=?
-         WHERE id=?
-        """,
-        (
-            title.strip(), (description or "").strip(), dt.isoformat(),
-            1 if is_recurring else 0, (recur_rule or None),
-            (recur_until.isoformat() if recur_until else None),
-            1 if is_public else 0,
-            int(eid),
-        ),
-    )
+
+    def _update(conn: sqlite3.Connection):
+        conn.execute(
+            f"""
+            UPDATE calendar_events
+               SET title=?, description=?, {col}=?, is_recurring=?, recur_rule=?, recur_until=?, is_public=?
+             WHERE id=?
+            """,
+            (
+                title.strip(), (description or "").strip(), dt.isoformat(),
+                1 if is_recurring else 0, (recur_rule or None),
+                (recur_until.isoformat() if recur_until else None),
+                1 if is_public else 0,
+                int(eid),
+            ),
+        )
+        conn.execute("DELETE FROM calendar_occurrences WHERE event_id=?", (int(eid),))
+        _materialize_occurrences(conn, [int(eid)])
+    _calendar_write(_update)
 
 def delete_calendar_event(eid: int):
+    # as ocorrências saem pelo trigger trg_cal_occ_ad
     exec_sql("DELETE FROM calendar_events WHERE id=?", (int(eid),))
 
 def duplicate_calendar_event(eid: int, new_owner_id: Optional[int] = None):
@@ -614,54 +2364,170 @@ def duplicate_calendar_event(eid: int, new_owner_id: Optional[int] = None):
         created_by=(
             new_owner_id
             if new_owner_id is not None
-            else (int(r["created_by"]) if pd.notna(r.get("created_by"])) else None)
+            else (int(r["created_by"]) if pd.notna(r.get("created_by")) else None)
         ),
     )
 
-def _expand_event_occurrences(row: pd.Series, month_start: date, month_end: date) -> List[Tuple[date, int, str]]:
-    base = _parse_date(str(row["ev_date"])).date()
-    eid = int(row["id"])
-    title = str(row["title"])
-    is_rec = bool(row.get("is_recurring", 0))
-    rule = (row.get("recur_rule") if pd.notna(row.get("recur_rule")) else None)
-    until = (_parse_date(str(row["recur_until"])).date() if pd.notna(row.get("recur_until")) and row.get("recur_until") else None)
-
-    if not is_rec or not rule:
-        if month_start <= base <= month_end:
-            return [(base, eid, title)]
-        return []
+# ===== Índice de ocorrências (calendar_occurrences) =====
+# Cada evento tem suas datas gravadas dentro de uma janela móvel [de, até] (app_meta); o mês da agenda
+# vira uma busca por faixa em occ_date. Meses fora da janela são expandidos na hora.
+def _calendar_write(fn: Callable[[sqlite3.Connection], Any]) -> Any:
+    try:
+        return _db_write(fn, tables=("calendar_events", "calendar_occurrences"))
+    except Exception as e:
+        st.error(f"Erro ao gravar no banco: {e}")
+        return None
 
-    cur = base
-    out = []
-    hard_limit = 400
-    steps = 0
-    while cur <= month_end and steps < hard_limit:
-        if cur >= month_start:
-            out.append((cur, eid, title))
-        if rule == "daily":
-            cur = cur + pd.Timedelta(days=1).to_pytimedelta()
-        elif rule == "weekly":
-            cur = cur + pd.Timedelta(weeks=1).to_pytimedelta()
-        elif rule == "monthly":
-            y, m = cur.year, cur.month
-            if m == 12:
-                y, m = y+1, 1
-            else:
-                m += 1
-            last = monthrange(y, m)[1]
-            d = min(cur.day, last)
-            cur = date(y, m, d)
-        elif rule == "yearly":
-            try:
-                cur = date(cur.year+1, cur.month, cur.day)
-            except ValueError:
-                cur = date(cur.year+1, cur.month, monthrange(cur.year+1, cur.month)[1])
-        else:
-            break
-        steps += 1
-        if until and cur > until:
-            break
-    return out
+# Passo de cada regra: dias (diária/semanal) ou meses (mensal/anual)
+_RULE_STEP_DAYS = {"daily": 1, "weekly": 7}
+_RULE_STEP_MONTHS = {"monthly": 1, "yearly": 12}
+
+def _event_arrays(ev_dates, is_recurring, recur_rules, recur_untils):
+    """Colunas de calendar_events -> (bases, regras, até) prontos para occurrences_between."""
+    def _days(values):
+        text = pd.Series(list(values), dtype=object).astype(str).str[:10]
+        return pd.to_datetime(text, format="%Y-%m-%d", errors="coerce").to_numpy("datetime64[D]")
+    rules = [
+        r if (not pd.isna(rec) and bool(rec) and (r in _RULE_STEP_DAYS or r in _RULE_STEP_MONTHS)) else None
+        for rec, r in zip(is_recurring, recur_rules)
+    ]
+    bases, untils = _days(ev_dates), _days(recur_untils)
+    return bases, rules, untils
+
+def occurrences_between(bases, rules, untils, start: date, end: date) -> Tuple[np.ndarray, np.ndarray]:
+    """Ocorrências de vários eventos em [start, end], em tempo constante por evento (sem andar passo a passo).
+
+    bases/untils: datetime64[D] (NaT = sem data / sem fim); rules: 'daily'|'weekly'|'monthly'|'yearly'
+    ou None (evento único). Devolve (posição do evento, data), ordenados por evento e data.
+    Diária/semanal: primeira = base + ceil((início - base) / passo) * passo.
+    Mensal/anual: k-ésima = mês da base + k meses, com o dia limitado ao fim daquele mês
+    (31/01 -> 29/02 -> 31/03; o dia não "gruda" no menor mês já visto).
+    """
+    bases = np.asarray(bases, dtype="datetime64[D]")
+    untils = np.asarray(untils, dtype="datetime64[D]")
+    lo, hi = np.datetime64(start, "D"), np.datetime64(end, "D")
+    step_days = np.array([_RULE_STEP_DAYS.get(r, 0) for r in rules], dtype=np.int64)
+    step_months = np.array([_RULE_STEP_MONTHS.get(r, 0) for r in rules], dtype=np.int64)
+    valid = ~np.isnat(bases)
+    stop = np.where(np.isnat(untils), hi, np.minimum(untils, hi))
+    first_from = np.maximum(bases, lo)
+    out_idx, out_dates = [], []
+
+    single = np.nonzero(valid & (step_days == 0) & (step_months == 0) & (bases >= lo) & (bases <= hi))[0]
+    out_idx.append(single)
+    out_dates.append(bases[single])
+
+    def _expand(idx, count):
+        # posição de cada ocorrência dentro do seu evento: 0, 1, ..., count-1
+        rep = np.repeat(idx, count)
+        offs = np.arange(int(count.sum())) - np.repeat(np.cumsum(count) - count, count)
+        return rep, offs
+
+    idx = np.nonzero(valid & (step_days > 0))[0]
+    if len(idx):
+        b, s, stop_i = bases[idx], step_days[idx], stop[idx]
+        k0 = -(-(first_from[idx] - b).astype(np.int64) // s)
+        first = b + (k0 * s).astype("timedelta64[D]")
+        count = np.where(first <= stop_i, (stop_i - first).astype(np.int64) // s + 1, 0)
+        rep, offs = _expand(idx, count)
+        out_idx.append(rep)
+        out_dates.append(np.repeat(first, count) + (offs * np.repeat(s, count)).astype("timedelta64[D]"))
+
+    idx = np.nonzero(valid & (step_months > 0))[0]
+    if len(idx):
+        b, s, stop_i = bases[idx], step_months[idx], stop[idx]
+        bm = b.astype("datetime64[M]")
+        day = (b - bm.astype("datetime64[D]")).astype(np.int64)
+        k0 = (first_from[idx].astype("datetime64[M]") - bm).astype(np.int64) // s
+        k1 = np.where(stop_i >= first_from[idx], (stop_i.astype("datetime64[M]") - bm).astype(np.int64) // s, k0 - 1)
+        count = np.maximum(k1 - k0 + 1, 0)
+        rep, offs = _expand(idx, count)
+        months = np.repeat(bm, count) + ((np.repeat(k0, count) + offs) * np.repeat(s, count)).astype("timedelta64[M]")
+        month_start = months.astype("datetime64[D]")
+        last = ((months + 1).astype("datetime64[D]") - month_start).astype(np.int64) - 1
+        dates = month_start + np.minimum(np.repeat(day, count), last).astype("timedelta64[D]")
+        keep = (dates >= first_from[rep]) & (dates <= stop[rep])
+        out_idx.append(rep[keep])
+        out_dates.append(dates[keep])
+
+    pos = np.concatenate(out_idx)
+    dates = np.concatenate(out_dates).astype("datetime64[D]")
+    order = np.lexsort((dates, pos))
+    return pos[order], dates[order]
+
+def _get_occurrence_window(conn: sqlite3.Connection) -> Optional[Tuple[date, date]]:
+    meta = dict(conn.execute("SELECT key, value FROM app_meta WHERE key IN ('cal_occ_from','cal_occ_to')").fetchall())
+    if "cal_occ_from" not in meta or "cal_occ_to" not in meta:
+        return None
+    return date.fromisoformat(meta["cal_occ_from"]), date.fromisoformat(meta["cal_occ_to"])
+
+def _set_occurrence_window(conn: sqlite3.Connection, start: date, end: date):
+    conn.executemany(
+        "INSERT INTO app_meta (key, value) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        [("cal_occ_from", start.isoformat()), ("cal_occ_to", end.isoformat())],
+    )
+
+def _materialize_occurrences(conn: sqlite3.Connection, event_ids: Optional[List[int]] = None,
+                             start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """Grava em calendar_occurrences as datas dos eventos (todos se None) entre start e end (padrão: janela)."""
+    window = _get_occurrence_window(conn)
+    if window is None:
+        return 0
+    start, end = start or window[0], end or window[1]
+    col = _calendar_date_col_of(conn)
+    q = f"SELECT id, {col}, is_recurring, recur_rule, recur_until FROM calendar_events"
+    params: List = []
+    if event_ids is not None:
+        q += f" WHERE id IN ({','.join('?' * len(event_ids))})"
+        params = [int(e) for e in event_ids]
+    ev = conn.execute(q, params).fetchall()
+    if not ev:
+        return 0
+    ids, ev_dates, is_rec, rules, untils = zip(*ev)
+    pos, dates = occurrences_between(*_event_arrays(ev_dates, is_rec, rules, untils), start, end)
+    ids = np.asarray(ids, dtype=np.int64)[pos]
+    rows = list(zip(dates.astype(str).tolist(), ids.tolist()))
+    conn.executemany("INSERT OR IGNORE INTO calendar_occurrences (occ_date, event_id) VALUES (?,?)", rows)
+    return len(rows)
+
+def _calendar_date_col_of(conn: sqlite3.Connection) -> str:
+    return "date" if "date" in _table_columns("calendar_events", conn) else "event_date"
+
+def occurrence_window() -> Optional[Tuple[date, date]]:
+    """Janela materializada; quando hoje passa da metade do horizonte, estende o fim e avança o início
+    para hoje - CAL_OCC_PAST_DAYS (uma escrita), apagando as ocorrências que ficaram antes dele."""
+    state = _schema_state()
+    window = state.get("cal_occ_window")
+    today = date.today()
+    if window is not None and window[1] >= today + timedelta(days=CAL_OCC_HORIZON_DAYS // 2):
+        return window
+
+    def _extend(conn: sqlite3.Connection):
+        current = _get_occurrence_window(conn)
+        if current is None:
+            return None
+        start, end = current
+        target = today + timedelta(days=CAL_OCC_HORIZON_DAYS)
+        if end < today + timedelta(days=CAL_OCC_HORIZON_DAYS // 2):
+            # o início só anda para frente: meses fora da janela caem na expansão sob demanda
+            start = max(start, today - timedelta(days=CAL_OCC_PAST_DAYS))
+            _set_occurrence_window(conn, start, target)
+            conn.execute("DELETE FROM calendar_occurrences WHERE occ_date < ?", (start.isoformat(),))
+            _materialize_occurrences(conn, start=max(start, end + timedelta(days=1)), end=target)
+            end = target
+        return start, end
+    state["cal_occ_window"] = _db_write(_extend, tables=("calendar_occurrences", "app_meta"))
+    return state["cal_occ_window"]
+
+def _expand_event_occurrences(df: pd.DataFrame, month_start: date, month_end: date) -> List[Tuple[date, int, str]]:
+    """Ocorrências dos eventos de `df` (com coluna ev_date) no intervalo, sem consultar o índice."""
+    if df.empty:
+        return []
+    pos, dates = occurrences_between(
+        *_event_arrays(df["ev_date"], df["is_recurring"], df["recur_rule"], df["recur_until"]), month_start, month_end
+    )
+    ids, titles = df["id"].to_numpy()[pos], df["title"].to_numpy()[pos]
+    return [(d, int(i), str(t)) for d, i, t in zip(dates.astype(object), ids, titles)]
 
 def _get_user_id() -> Optional[int]:
     u = st.session_state.get("user")
@@ -672,33 +2538,382 @@ def get_month_events(year: int, month: int, scope: str = "mine") -> List[Tuple[d
     scope: 'mine'  -> eventos públicos + privados do usuário logado
            'public'-> apenas eventos públicos
     """
-    uid = _get_user_id()
-    col = cal_date_col()
-    if scope == "public":
-        df = fetch_df(f"SELECT *, {col} AS ev_date FROM calendar_events WHERE is_public=1")
-    else:
-        if uid is not None:
-            df = fetch_df(
-                f"SELECT *, {col} AS ev_date FROM calendar_events WHERE (is_public=1) OR (is_public=0 AND created_by=?)",
-                (uid,),
-            )
-        else:
-            df = fetch_df(f"SELECT *, {col} AS ev_date FROM calendar_events WHERE is_public=1")
+    visible, vparams = _calendar_visibility(scope, _get_user_id())
 
     month_start = date(year, month, 1)
     month_end = date(year, month, monthrange(year, month)[1])
-    all_occ = []
-    for _, row in df.iterrows():
-        if pd.isna(row.get("ev_date")) or not str(row["ev_date"]).strip():
-            continue
-        all_occ.extend(_expand_event_occurrences(row, month_start, month_end))
-    return sorted(all_occ, key=lambda x: (x[0], x[1]))
+    window = occurrence_window()
+    if window and window[0] <= month_start and month_end <= window[1]:
+        df = fetch_df(
+            f"""
+            SELECT o.occ_date, e.id, e.title
+            FROM calendar_occurrences o
+            JOIN calendar_events e ON e.id = o.event_id
+            WHERE o.occ_date BETWEEN ? AND ? AND {visible}
+            ORDER BY o.occ_date, e.id
+            """,
+            tuple([month_start.isoformat(), month_end.isoformat()] + vparams),
+        )
+        return [(date.fromisoformat(d), int(eid), str(t)) for d, eid, t in df.itertuples(index=False, name=None)]
+
+    # fora da janela materializada: expande os eventos na hora
+    col = cal_date_col()
+    df = fetch_df(f"SELECT e.*, e.{col} AS ev_date FROM calendar_events e WHERE {visible}", tuple(vparams))
+    return sorted(_expand_event_occurrences(df, month_start, month_end), key=lambda x: (x[0], x[1]))
+
+# ====================== Agenda: iCalendar (.ics) ======================
+# Exporta o escopo "mine"/"public" como VEVENTs com RRULE (sem expandir ocorrências), em blocos do
+# cursor; o mesmo gerador alimenta o download e o feed HTTP opcional (ETag/Last-Modified -> 304).
+_ICS_FREQ = {"daily": "DAILY", "weekly": "WEEKLY", "monthly": "MONTHLY", "yearly": "YEARLY"}
+_ICS_RULE = {v: k for k, v in _ICS_FREQ.items()}
+_ICS_OWN_UID_RE = re.compile(rf"^finapp-(\d+)@{re.escape(ICS_UID_DOMAIN)}$")
+
+def _calendar_visibility(scope: str, user_id: Optional[int], alias: str = "e") -> Tuple[str, List]:
+    if scope == "public" or user_id is None:
+        return f"{alias}.is_public=1", []
+    return f"(({alias}.is_public=1) OR ({alias}.is_public=0 AND {alias}.created_by=?))", [user_id]
+
+def _ics_escape(text: str) -> str:
+    return (str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def _ics_fold(line: str) -> str:
+    """Quebra linhas acima de 75 octetos (RFC 5545 §3.1) sem partir caracteres UTF-8."""
+    if len(line.encode("utf-8")) <= 75:
+        return line
+    parts, cur, size = [], "", 0
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        if size + n > (75 if not parts else 74):
+            parts.append(cur)
+            cur, size = "", 0
+        cur += ch
+        size += n
+    parts.append(cur)
+    return "\r\n ".join(parts)
+
+def _ics_stamp(ts) -> str:
+    try:
+        return datetime.strptime(str(ts)[:19], "%Y-%m-%d %H:%M:%S").strftime("%Y%m%dT%H%M%SZ")
+    except ValueError:
+        return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def _ics_rrule(base: date, rule: str, until) -> str:
+    parts = [f"FREQ={_ICS_FREQ[rule]}"]
+    # a agenda limita o dia ao fim do mês (31 -> 30/29/28); no iCalendar puro esses meses seriam pulados
+    if rule == "monthly" and base.day > 28:
+        parts.append(f"BYMONTHDAY={base.day},-1;BYSETPOS=1")
+    elif rule == "yearly" and base.month == 2 and base.day == 29:
+        parts.append("BYMONTH=2;BYMONTHDAY=29,-1;BYSETPOS=1")
+    if until and pd.notna(until) and str(until).strip():
+        parts.append(f"UNTIL={str(until)[:10].replace('-', '')}")
+    return "RRULE:" + ";".join(parts)
+
+def _ics_vevent(row) -> List[str]:
+    eid, title, desc, ev_date, is_rec, rule, until, is_public, updated_at, ics_uid = row
+    try:
+        base = _parse_date(str(ev_date)[:10]).date()
+    except (TypeError, ValueError):
+        return []
+    stamp = _ics_stamp(updated_at)
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{ics_uid or f'finapp-{eid}@{ICS_UID_DOMAIN}'}",
+        f"DTSTAMP:{stamp}",
+        f"LAST-MODIFIED:{stamp}",
+        f"DTSTART;VALUE=DATE:{base:%Y%m%d}",
+        f"DTEND;VALUE=DATE:{base + timedelta(days=1):%Y%m%d}",
+        f"SUMMARY:{_ics_escape(title or '')}",
+    ]
+    if desc:
+        lines.append(f"DESCRIPTION:{_ics_escape(desc)}")
+    lines.append(f"CLASS:{'PUBLIC' if is_public else 'PRIVATE'}")
+    if is_rec and rule in _ICS_FREQ:
+        lines.append(_ics_rrule(base, rule, until))
+    lines.append("END:VEVENT")
+    return lines
+
+def _ics_events_query(scope: str, user_id: Optional[int]) -> Tuple[str, List]:
+    visible, params = _calendar_visibility(scope, user_id)
+    col = cal_date_col()
+    q = f"""
+        SELECT e.id, e.title, e.description, e.{col}, e.is_recurring, e.recur_rule, e.recur_until,
+               e.is_public, IFNULL(e.updated_at, e.created_at), e.ics_uid
+        FROM calendar_events e
+        WHERE {visible}
+        ORDER BY e.id
+    """
+    return q, params
+
+def iter_ics(scope: str, user_id: Optional[int]):
+    """Gera o .ics do escopo em pedaços de texto (um por bloco de eventos lidos do cursor)."""
+    name = "FinApp - Agenda pública" if scope == "public" else "FinApp - Minha agenda"
+    yield "\r\n".join([
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//JGS Financial//FinApp Agenda//PT-BR",
+        "CALSCALE:GREGORIAN", "METHOD:PUBLISH", _ics_fold(f"X-WR-CALNAME:{_ics_escape(name)}"),
+    ]) + "\r\n"
+    q, params = _ics_events_query(scope, user_id)
+    chunks = _iter_query_chunks(q, tuple(params))
+    next(chunks)
+    for rows in chunks:
+        yield "".join(_ics_fold(line) + "\r\n" for row in rows for line in _ics_vevent(row))
+    yield "END:VCALENDAR\r\n"
+
+def _ics_bytes(scope: str, user_id: Optional[int]) -> bytes:
+    def _fill(f):
+        for chunk in iter_ics(scope, user_id):
+            f.write(chunk.encode("utf-8"))
+    return _tempfile_bytes(_fill)
+
+def ics_feed_state(scope: str, user_id: Optional[int]) -> Tuple[str, datetime]:
+    """(ETag, Last-Modified) do feed sem gerá-lo: contagem, soma dos ids, último updated_at e última exclusão."""
+    visible, params = _calendar_visibility(scope, user_id)
+    with _connect() as conn:
+        n, ids, last = conn.execute(
+            f"SELECT COUNT(*), TOTAL(e.id), MAX(IFNULL(e.updated_at, e.created_at)) FROM calendar_events e WHERE {visible}",
+            params,
+        ).fetchone()
+        deleted = conn.execute("SELECT value FROM app_meta WHERE key='cal_deleted_at'").fetchone()
+    stamps = [str(x) for x in (last, deleted[0] if deleted else None) if x]
+    newest = max(stamps) if stamps else "1970-01-01 00:00:00"
+    etag = hashlib.sha1(f"{scope}|{user_id}|{n}|{ids}|{newest}".encode("utf-8")).hexdigest()[:24]
+    modified = datetime.strptime(newest[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    return f'"{etag}"', modified
+
+def ics_token(user_id: int, rotate: bool = False) -> str:
+    """Token do feed do usuário (criado na primeira vez; `rotate` invalida o link anterior)."""
+    if not rotate:
+        row = fetch_df("SELECT token FROM ics_tokens WHERE user_id=?", (int(user_id),))
+        if not row.empty:
+            return str(row.iloc[0, 0])
+    token = secrets.token_urlsafe(24)
+    _db_write(lambda conn: conn.execute(
+        "INSERT INTO ics_tokens (user_id, token) VALUES (?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET token=excluded.token, created_at=CURRENT_TIMESTAMP",
+        (int(user_id), token),
+    ), tables=("ics_tokens",))
+    return token
+
+def _ics_token_user(token: str) -> Optional[int]:
+    with _connect() as conn:
+        row = conn.execute("SELECT user_id FROM ics_tokens WHERE token=?", (token,)).fetchone()
+    return int(row[0]) if row else None
+
+def ics_feed_url(token: str, scope: str) -> str:
+    base = ICS_BASE_URL or f"http://{'localhost' if ICS_HOST in ('0.0.0.0', '127.0.0.1') else ICS_HOST}:{ICS_PORT}"
+    return f"{base}/ics/{token}/{scope}.ics"
+
+class _IcsHandler(BaseHTTPRequestHandler):
+    """GET/HEAD /ics/<token>/(mine|public).ics; responde 304 quando If-None-Match/If-Modified-Since batem."""
+    server_version = "FinAppICS/1.0"
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body: bool):
+        m = re.fullmatch(r"/ics/([A-Za-z0-9_-]+)/(mine|public)\.ics", urlparse.urlsplit(self.path).path)
+        if not m:
+            self.send_error(404)
+            return
+        user_id = _ics_token_user(m.group(1))
+        if user_id is None:
+            self.send_error(403)
+            return
+        scope = m.group(2)
+        etag, modified = ics_feed_state(scope, user_id)
+        if self._not_modified(etag, modified):
+            self.send_response(304)
+            self._validators(etag, modified)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Content-Disposition", f'inline; filename="finapp-{scope}.ics"')
+        self._validators(etag, modified)
+        self.end_headers()
+        if body:
+            for chunk in iter_ics(scope, user_id):
+                self.wfile.write(chunk.encode("utf-8"))
+
+    def _validators(self, etag: str, modified: datetime):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", format_datetime(modified, usegmt=True))
+        self.send_header("Cache-Control", "private, max-age=300")
+
+    def _not_modified(self, etag: str, modified: datetime) -> bool:
+        inm = self.headers.get("If-None-Match")
+        if inm:
+            return etag in [t.strip() for t in inm.split(",")] or inm.strip() == "*"
+        ims = self.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                return modified.replace(microsecond=0) <= parsedate_to_datetime(ims)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def log_message(self, fmt, *args):
+        pass
+
+@st.cache_resource(show_spinner=False)
+def _ics_server() -> Optional[ThreadingHTTPServer]:
+    """Servidor do feed .ics (uma thread por processo) quando FINAPP_ICS_PORT está definido."""
+    if not ICS_PORT:
+        return None
+    try:
+        srv = ThreadingHTTPServer((ICS_HOST, ICS_PORT), _IcsHandler)
+    except OSError:
+        return None  # porta ocupada (outro processo já serve o feed)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="finapp-ics", daemon=True).start()
+    return srv
+
+def _ics_unescape(text: str) -> str:
+    return re.sub(r"\\([\\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), text)
+
+def _iter_ics_lines(f):
+    """Linhas do .ics já desdobradas (continuações iniciadas por espaço/tab)."""
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", errors="replace", newline="")
+    try:
+        prev = None
+        for raw in text:
+            line = raw.rstrip("\r\n")
+            if line[:1] in (" ", "\t") and prev is not None:
+                prev += line[1:]
+                continue
+            if prev is not None:
+                yield prev
+            prev = line
+        if prev:
+            yield prev
+    finally:
+        text.detach()
+
+def iter_ics_events(f):
+    """VEVENTs do arquivo como dict propriedade -> valor (componentes internos como VALARM são ignorados)."""
+    ev, depth = None, 0
+    for line in _iter_ics_lines(f):
+        name, _, value = line.partition(":")
+        key = name.split(";")[0].upper()
+        if key == "BEGIN":
+            if value.upper() == "VEVENT" and ev is None:
+                ev, depth = {}, 0
+            elif ev is not None:
+                depth += 1
+        elif key == "END":
+            if ev is not None and depth:
+                depth -= 1
+            elif ev is not None and value.upper() == "VEVENT":
+                yield ev
+                ev = None
+        elif ev is not None and not depth and key not in ev:
+            ev[key] = value
+
+def _nth_occurrence(base: date, rule: str, n: int) -> date:
+    k = max(n - 1, 0)
+    if rule in _RULE_STEP_DAYS:
+        return base + timedelta(days=k * _RULE_STEP_DAYS[rule])
+    y, m = divmod(base.month - 1 + k * _RULE_STEP_MONTHS[rule], 12)
+    y, m = base.year + y, m + 1
+    return date(y, m, min(base.day, monthrange(y, m)[1]))
+
+def _ics_event_row(ev: dict, created_by: Optional[int], is_public: bool) -> Tuple[Optional[tuple], bool]:
+    """(linha para calendar_events, regra simplificada?); linha None se não houver DTSTART válido."""
+    base = _parse_import_date((ev.get("DTSTART") or "")[:8])
+    if not base:
+        return None, False
+    base_d = date.fromisoformat(base)
+    rule, until, simplified = None, None, False
+    if ev.get("RRULE"):
+        parts = dict(p.split("=", 1) for p in ev["RRULE"].upper().split(";") if "=" in p)
+        rule = _ICS_RULE.get(parts.pop("FREQ", ""))
+        interval = parts.pop("INTERVAL", "1")
+        until = _parse_import_date(parts.pop("UNTIL", "")[:8])
+        count = parts.pop("COUNT", None)
+        parts.pop("WKST", None)
+        # formas que a agenda representa: o ajuste de fim de mês exportado acima e BYDAY igual ao da data base
+        if parts in ({"BYMONTHDAY": f"{base_d.day},-1", "BYSETPOS": "1"},
+                     {"BYMONTH": "2", "BYMONTHDAY": "29,-1", "BYSETPOS": "1"}):
+            parts = {}
+        if parts.get("BYDAY") == ["MO", "TU", "WE", "TH", "FR", "SA", "SU"][base_d.weekday()] and rule == "weekly":
+            parts.pop("BYDAY")
+        if rule and count and count.isdigit() and not until:
+            until = _nth_occurrence(base_d, rule, int(count)).isoformat()
+        if not rule or interval != "1" or parts:
+            rule, until, simplified = None, None, True
+    uid = ev.get("UID") or hashlib.sha1(
+        f"{ev.get('SUMMARY')}|{base}|{ev.get('RRULE')}".encode("utf-8")).hexdigest()
+    row = (
+        _ics_unescape(ev.get("SUMMARY") or "(sem título)").strip()[:500],
+        _ics_unescape(ev.get("DESCRIPTION") or "").strip(),
+        base, 1 if rule else 0, rule, until, 1 if is_public else 0, created_by, uid,
+    )
+    return row, simplified
+
+def import_ics(f, created_by: Optional[int], is_public: bool = False, batch_rows: int = IMPORT_BATCH_ROWS) -> dict:
+    """Importa os VEVENTs em lotes (INSERT OR IGNORE pelo UID por usuário) e materializa as ocorrências.
+
+    RRULEs que a agenda não representa (INTERVAL > 1, BYDAY múltiplo, ...) viram evento único e são
+    contadas em `simplified`. UIDs exportados por este app para eventos que ainda existem são ignorados.
+    """
+    col = cal_date_col()
+    sql = f"""
+        INSERT OR IGNORE INTO calendar_events (title, description, {col}, is_recurring, recur_rule, recur_until,
+                                               is_public, created_by, ics_uid)
+        VALUES (?,?,?,?,?,?,?,?,?)
+    """
+    stats = {"read": 0, "inserted": 0, "duplicates": 0, "rejected": 0, "simplified": 0,
+             "seconds": 0.0, "rows_per_s": 0.0}
+    t0 = time.perf_counter()
+
+    def _rows():
+        for ev in iter_ics_events(f):
+            stats["read"] += 1
+            row, simplified = _ics_event_row(ev, created_by, is_public)
+            if row is None:
+                stats["rejected"] += 1
+                continue
+            stats["simplified"] += simplified
+            yield row
+
+    def _insert(conn: sqlite3.Connection, batch: List[tuple]) -> int:
+        own = {int(m.group(1)) for r in batch for m in [_ICS_OWN_UID_RE.match(r[-1])] if m}
+        if own:
+            marks = ",".join("?" * len(own))
+            existing = {r[0] for r in conn.execute(f"SELECT id FROM calendar_events WHERE id IN ({marks})", list(own))}
+            batch = [r for r in batch if not (_ICS_OWN_UID_RE.match(r[-1]) and
+                                              int(_ICS_OWN_UID_RE.match(r[-1]).group(1)) in existing)]
+        before = conn.execute("SELECT IFNULL(MAX(id), 0) FROM calendar_events").fetchone()[0]
+        n = conn.executemany(sql, batch).rowcount if batch else 0
+        new_ids = [r[0] for r in conn.execute("SELECT id FROM calendar_events WHERE id > ?", (before,))]
+        _materialize_occurrences(conn, new_ids)
+        return n
+
+    rows = _rows()
+    while True:
+        batch = list(itertools.islice(rows, batch_rows))
+        if not batch:
+            break
+        stats["inserted"] += _db_write(lambda conn: _insert(conn, batch),
+                                       tables=("calendar_events", "calendar_occurrences"), bulk=True)
+    stats["duplicates"] = stats["read"] - stats["rejected"] - stats["inserted"]
+    stats["seconds"] = time.perf_counter() - t0
+    stats["rows_per_s"] = stats["read"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
 
 # ====================== Tabelas estáticas legíveis ======================
 def show_df(df: pd.DataFrame, empty_msg: str = "Sem dados para exibir."):
     if df is None or df.empty:
         st.info(empty_msg)
         return
+    if len(df) > SHOW_DF_STYLER_MAX_ROWS:
+        # Caminho rápido: grade virtualizada no navegador em vez de HTML com CSS por célula
+        st.dataframe(df, use_container_width=True, hide_index=True)
+        return
+    df = format_money_columns(df)
     try:
         styler = (
             df.style
@@ -713,6 +2928,63 @@ def show_df(df: pd.DataFrame, empty_msg: str = "Sem dados para exibir."):
     except Exception:
         st.table(df)
 
+# ====================== Grade paginada (keyset em (trx_date, id)) ======================
+def keyset_grid(
+    key: str,
+    page_query: Callable[[Optional[Tuple], int], Tuple[str, List]],
+    total_query: Tuple[str, List],
+    cursor_cols: Tuple[str, ...] = ("Data", "id"),
+    empty_msg: str = "Sem dados para exibir.",
+    display: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+    stamp: Tuple = (),
+) -> Tuple[pd.DataFrame, Optional[pd.Series]]:
+    """Mostra só a página visível de uma consulta ordenada por (trx_date DESC, id DESC).
+
+    `page_query(after, limit)` devolve o SQL da página que começa depois do cursor `after`
+    (None = primeira); `total_query` é um agregado de uma linha com a coluna `n` (total de
+    linhas) e o que mais a página quiser resumir. `display` ajusta a página antes de exibi-la
+    (ex.: label_dimensions). O cursor leva os valores de `cursor_cols` da última linha; se ele
+    carrega algo derivado dos dados (ex.: saldo), passe em `stamp` o que deve zerar a paginação
+    quando os dados mudam. Devolve (página, linha do agregado).
+    """
+    tq, tp = total_query
+    totals = fetch_df(tq, tuple(tp))
+    agg = totals.iloc[0] if not totals.empty else None
+    total = int(agg["n"] or 0) if agg is not None else 0
+    if total == 0:
+        st.info(empty_msg)
+        return pd.DataFrame(), agg
+
+    size = st.selectbox("Linhas por página", GRID_PAGE_SIZES, index=1, key=f"{key}_size")
+    # A pilha de cursores volta ao início quando o filtro ou o tamanho da página mudam
+    signature = (tq, tuple(tp), size, stamp)
+    if st.session_state.get(f"{key}_sig") != signature:
+        st.session_state[f"{key}_sig"] = signature
+        st.session_state[f"{key}_cursors"] = []
+    cursors: List[Tuple] = st.session_state[f"{key}_cursors"]
+
+    after = cursors[-1] if cursors else None
+    q, p = page_query(after, size + 1)
+    df = fetch_df(q, tuple(p))
+    has_next = len(df) > size
+    df = df.head(size)
+    if display is not None:
+        df = display(df)
+
+    pages = max(1, -(-total // size))
+    c1, c2, c3 = st.columns([1, 2, 1])
+    if c1.button("◀ Anterior", key=f"{key}_prev", disabled=not cursors):
+        cursors.pop()
+        do_rerun()
+    c2.caption(f"Página {len(cursors) + 1} de {pages} • {total:,} registro(s)".replace(",", "."))
+    if c3.button("Próxima ▶", key=f"{key}_next", disabled=not has_next):
+        last = df.iloc[-1]
+        cursors.append(tuple(last[c].item() if hasattr(last[c], "item") else last[c] for c in cursor_cols))
+        do_rerun()
+
+    st.dataframe(df, use_container_width=True, hide_index=True)
+    return df, agg
+
 # ====================== Login & Cadastro (compacto) ======================
 def signup_widget():
     if "user" in st.session_state:
@@ -779,18 +3051,22 @@ def login_widget() -> bool:
     return True
 
 # ====================== KPIs ======================
+# Os painéis somam o monthly_rollup sem os cancelados (inclui linhas de extrato já conciliadas,
+# que ficam como 'canceled' ligadas ao lançamento por reconciled_with)
+_KPI_SQL = (
+    "SELECT "
+    "SUM(CASE WHEN type IN ('expense','tax','payroll','card') THEN total_cents ELSE 0 END) AS desp_cents, "
+    "SUM(CASE WHEN type = 'income' THEN total_cents ELSE 0 END) AS rec_cents "
+    "FROM monthly_rollup WHERE status <> 'canceled'"
+)
+
 def kpis_cards():
-    base = (
-        "SELECT "
-        "SUM(CASE WHEN type IN ('expense','tax','payroll','card') THEN amount ELSE 0 END) AS total_desp, "
-        "SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END) AS total_rec "
-        "FROM transactions WHERE 1=1"
-    )
-    base, params = scope_filters(base, [])
-    df_kpi = fetch_df(base, tuple(params))
-    total_desp = float(df_kpi.iloc[0]["total_desp"] or 0) if not df_kpi.empty else 0.0
-    total_rec  = float(df_kpi.iloc[0]["total_rec"]  or 0) if not df_kpi.empty else 0.0
-    saldo = total_rec - total_desp
+    base, params = scope_filters(_KPI_SQL, [])
+    df_kpi = page_memo("kpis", fetch_df, base, tuple(params))
+    desp_cents = int(df_kpi.iloc[0]["desp_cents"] or 0) if not df_kpi.empty else 0
+    rec_cents  = int(df_kpi.iloc[0]["rec_cents"]  or 0) if not df_kpi.empty else 0
+    total_desp, total_rec = desp_cents / 100, rec_cents / 100
+    saldo = (rec_cents - desp_cents) / 100
 
     st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
     c1, c2, c3 = st.columns(3)
@@ -802,19 +3078,8 @@ def kpis_cards():
 # ====================== Entrada livre de dinheiro ======================
 def money_input(label: str, key: Optional[str] = None, value: str = "", help: Optional[str] = None) -> float:
     raw = st.text_input(label, value=value, key=key, help=help, placeholder="0,00")
-    raw = (raw or "").strip().replace(" ", "")
-    if raw == "":
-        return 0.0
-    cleaned = raw
-    if "," in cleaned and "." in cleaned:
-        cleaned = cleaned.replace(".", "").replace(",", ".")
-    else:
-        cleaned = cleaned.replace(",", ".")
-    try:
-        val = float(cleaned)
-    except Exception:
-        val = 0.0
-    return val
+    cents = parse_money_cents(raw)
+    return cents / 100 if cents is not None else 0.0
 
 # ====================== Formulário genérico ======================
 def form_lancamento_generico(default_type: str = 'expense', label: str = "Novo lançamento", force_account_id: Optional[int] = None):
@@ -847,8 +3112,7 @@ def form_lancamento_generico(default_type: str = 'expense', label: str = "Novo l
         cat_options = [(None, "—")] + [(int(r.id), r.name) for _, r in categories_df.iterrows()]
         cat = c5.selectbox("Categoria", options=cat_options, format_func=safe_label)
 
-        sectors_df = fetch_df("SELECT name FROM sectors ORDER BY name")
-        sector_options = [s for s in sectors_df["name"].tolist()] if not sectors_df.empty else ["Administrativo","Produção","Comercial","Logística","Outros"]
+        sector_options = sorted(dimension_names("sectors").values()) or ["Administrativo","Produção","Comercial","Logística","Outros"]
         sector = c6.selectbox("Setor", sector_options)
 
         c7, c8 = st.columns([2, 1])
@@ -887,14 +3151,12 @@ def form_lancamento_generico(default_type: str = 'expense', label: str = "Novo l
             if amount <= 0:
                 flash("Informe um valor maior que zero.", "warning", 3)
             else:
-                attach_path = None
+                attach_path = attach_name = None
                 if attach is not None:
-                    fname = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{attach.name}"
-                    fpath = os.path.join(ATTACH_DIR, fname)
                     try:
-                        with open(fpath, "wb") as f:
-                            f.write(attach.getbuffer())
-                        attach_path = fpath
+                        attach_path = store_attachment(attach, attach.name)
+                        attach_name = attach.name
+                        request_preview(attachment_abspath(attach_path))   # gerada em segundo plano
                     except Exception as e:
                         flash(f"Falha ao salvar anexo: {e}", "error", 3)
 
@@ -904,15 +3166,15 @@ def form_lancamento_generico(default_type: str = 'expense', label: str = "Novo l
                     INSERT INTO transactions (
                         trx_date, type, sector, cost_center_id, category_id, account_id,
                         method, doc_number, counterparty, description, amount, status, origin, attachment_path,
-                        show_on_calendar, cal_is_recurring, cal_recur_rule
-                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?, ?, ?, ?)
+                        attachment_name, show_on_calendar, cal_is_recurring, cal_recur_rule
+                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?, ?, ?, ?)
                     """,
                     (
                         dt_val.isoformat(), default_type, sector,
                         None,
                         (cat[0] if isinstance(cat, tuple) else None),
                         account_id_final,
-                        method, doc, party, desc, float(amount), status, "manual", attach_path,
+                        method, doc, party, desc, float(amount), status, "manual", attach_path, attach_name,
                         (1 if show_on_cal else 0),
                         (1 if (show_on_cal and recur_kind=="recorrente") else 0),
                         (recur_rule if (show_on_cal and recur_kind=="recorrente") else None)
@@ -935,66 +3197,154 @@ def form_lancamento_generico(default_type: str = 'expense', label: str = "Novo l
                 do_rerun()
     st.markdown('</div>', unsafe_allow_html=True)
 
-def tabela_lancamentos_filtro():
-    st.markdown("### Filtro de lançamentos")
-    st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
-    c1, c2, c3, c4 = st.columns(4)
-    dt_ini = c1.date_input("De", value=date(date.today().year, 1, 1))
-    dt_fim = c2.date_input("Até", value=date.today())
-    tipo = c3.selectbox("Tipo", ["Todos", "income", "expense", "tax", "payroll", "card", "transfer"])
-    status = c4.selectbox("Status", ["Todos", "planned", "paid", "overdue", "reconciled", "canceled"])
-
-    q = """
-        SELECT t.id, t.trx_date as Data, t.type as Tipo, t.description as Descrição, t.amount as Valor,
-               (SELECT name FROM categories c WHERE c.id = t.category_id) as Categoria,
-               (SELECT name FROM accounts a WHERE a.id = t.account_id) as Conta,
-               t.sector as Setor, t.status as Status, t.attachment_path as Anexo
-        FROM transactions t
-        WHERE date(t.trx_date) BETWEEN ? AND ?
-    """
-    params: List = [dt_ini.isoformat(), dt_fim.isoformat()]
+_LANCAMENTOS_COLUMNS = """
+    SELECT t.id, t.trx_date as Data, t.type as Tipo, t.description as Descrição, t.amount as Valor,
+           {categoria} as Categoria, {conta} as Conta,
+           t.sector as Setor, t.status as Status, COALESCE(t.attachment_name, t.attachment_path) as Anexo"""
+_LANCAMENTOS_JOINS = " LEFT JOIN categories c ON c.id = t.category_id LEFT JOIN accounts a ON a.id = t.account_id"
+
+def _lancamentos_columns(labels: bool) -> str:
+    # labels: nomes por JOIN (exportações); senão os ids, trocados por label_dimensions() na página
+    if labels:
+        return _LANCAMENTOS_COLUMNS.format(categoria="c.name", conta="a.name")
+    return _LANCAMENTOS_COLUMNS.format(categoria="t.category_id", conta="t.account_id")
+
+def _lancamentos_filter(dt_ini: str, dt_fim: str, tipo: str = "Todos", status: str = "Todos") -> Tuple[str, List]:
+    where = " WHERE t.trx_date BETWEEN ? AND ?"
+    params: List = [dt_ini, dt_fim]
     if tipo != "Todos":
-        q += " AND t.type = ?"
+        where += " AND t.type = ?"
         params.append(tipo)
     if status != "Todos":
-        q += " AND t.status = ?"
+        where += " AND t.status = ?"
         params.append(status)
+    return where, params
+
+def _lancamentos_query(dt_ini: str, dt_fim: str, tipo: str = "Todos", status: str = "Todos",
+                       after: Optional[Tuple] = None, limit: Optional[int] = None,
+                       labels: bool = True) -> Tuple[str, List]:
+    where, params = _lancamentos_filter(dt_ini, dt_fim, tipo, status)
+    select = _lancamentos_columns(labels) + "\n    FROM transactions t" + (_LANCAMENTOS_JOINS if labels else "")
+    q, params = scope_filters(select + where, params)
+    if after is not None:
+        q += " AND (t.trx_date, t.id) < (?, ?)"
+        params = params + list(after)
+    q += " ORDER BY t.trx_date DESC, t.id DESC"
+    if limit:
+        q += f" LIMIT {int(limit)}"
+    return q, params
+
+def _lancamentos_total_query(dt_ini: str, dt_fim: str, tipo: str = "Todos", status: str = "Todos") -> Tuple[str, List]:
+    where, params = _lancamentos_filter(dt_ini, dt_fim, tipo, status)
+    return scope_filters("SELECT COUNT(*) AS n, SUM(t.amount_cents) / 100.0 AS total FROM transactions t" + where, params)
+
+_SEARCH_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def fts_query(text: str) -> str:
+    """Texto digitado -> consulta FTS5: cada palavra vira um prefixo entre aspas (todas obrigatórias)."""
+    return " ".join(f'"{w}"*' for w in _SEARCH_TOKEN_RE.findall(text))
+
+def _busca_from(texto: str, dt_ini: str, dt_fim: str, tipo: str, status: str,
+                labels: bool = False) -> Tuple[str, List]:
+    where, params = _lancamentos_filter(dt_ini, dt_fim, tipo, status)
+    return (" FROM transactions_fts JOIN transactions t ON t.id = transactions_fts.rowid"
+            + (_LANCAMENTOS_JOINS if labels else "")
+            + where + " AND transactions_fts MATCH ?"), params + [fts_query(texto)]
+
+def _busca_query(texto: str, dt_ini: str, dt_fim: str, tipo: str = "Todos", status: str = "Todos",
+                 limit: Optional[int] = SEARCH_MAX_RESULTS, labels: bool = True) -> Tuple[str, List]:
+    """Lançamentos que casam com `texto` nos filtros da tela, do mais relevante (bm25) ao menos.
+
+    Descrição e contraparte pesam mais que documento e tags; o trecho destaca os termos com «».
+    """
+    frm, params = _busca_from(texto, dt_ini, dt_fim, tipo, status, labels)
+    q = (_lancamentos_columns(labels) + ",\n           snippet(transactions_fts, -1, '«', '»', '…', 12) as Trecho" + frm
+         + " ORDER BY bm25(transactions_fts, 3.0, 3.0, 1.0, 1.0), t.trx_date DESC")
+    if limit:
+        q += f" LIMIT {int(limit)}"
+    return scope_filters(q, params)
+
+def _busca_total_query(texto: str, dt_ini: str, dt_fim: str, tipo: str = "Todos", status: str = "Todos") -> Tuple[str, List]:
+    frm, params = _busca_from(texto, dt_ini, dt_fim, tipo, status)
+    return scope_filters("SELECT COUNT(*) AS n, SUM(t.amount_cents) / 100.0 AS total" + frm, params)
+
+def _busca_grid(texto: str, filtro: Tuple) -> pd.DataFrame:
+    tq, tp = _busca_total_query(texto, *filtro)
+    totals = fetch_df(tq, tuple(tp))
+    n = int(totals.iloc[0]["n"] or 0) if not totals.empty else 0
+    if n == 0:
+        st.info("Nenhum lançamento encontrado para a busca.")
+        return pd.DataFrame()
+    q, p = _busca_query(texto, *filtro, labels=False)
+    df = label_dimensions(fetch_df(q, tuple(p)))
+    shown = f"os {len(df)} mais relevantes" if n > len(df) else "por relevância"
+    st.caption(f"{n:,}".replace(",", ".") + f" resultado(s) • total {money(float(totals.iloc[0]['total'] or 0))} • " + shown)
+    st.dataframe(df, use_container_width=True, hide_index=True)
+    return df
 
-    q, params = scope_filters(q, params)
-    q += " ORDER BY date(t.trx_date) DESC, t.id DESC"
-
-    df = fetch_df(q, tuple(params))
-    show_df(df, empty_msg="Sem lançamentos no período.")
-    col1, col2 = st.columns(2)
-    with col1:
-        export_excel(df, "lancamentos.xlsx")
-    with col2:
-        export_csv(df, "lancamentos.csv")
+def tabela_lancamentos_filtro():
+    st.markdown("### Filtro de lançamentos")
+    st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
+    c1, c2, c3, c4 = st.columns(4)
+    st.session_state.setdefault("flt_ini", date(date.today().year, 1, 1))
+    st.session_state.setdefault("flt_fim", date.today())
+    dt_ini = c1.date_input("De", key="flt_ini")
+    dt_fim = c2.date_input("Até", key="flt_fim")
+    tipo = c3.selectbox("Tipo", ["Todos", "income", "expense", "tax", "payroll", "card", "transfer"], key="flt_tipo")
+    status = c4.selectbox("Status", ["Todos", "planned", "paid", "overdue", "reconciled", "canceled"], key="flt_status")
+
+    busca = st.text_input("Buscar", key="flt_busca", placeholder="descrição, contraparte, documento ou tags",
+                          help="Todas as palavras precisam aparecer; basta o começo de cada uma.")
+
+    filtro = (dt_ini.isoformat(), dt_fim.isoformat(), tipo, status)
+    if fts_query(busca):
+        page = _busca_grid(busca, filtro)
+        if not page.empty:
+            q, params = _busca_query(busca, *filtro, limit=None)
+            export_query(q, tuple(params), "lancamentos_busca")
+    else:
+        page, _ = keyset_grid(
+            "grid_lanc",
+            lambda after, limit: _lancamentos_query(*filtro, after=after, limit=limit, labels=False),
+            _lancamentos_total_query(*filtro),
+            empty_msg="Sem lançamentos no período.",
+            display=label_dimensions,
+        )
+        if not page.empty:
+            q, params = _lancamentos_query(*filtro)
+            export_query(q, tuple(params), "lancamentos")
 
-    st.caption("Clique em um ID abaixo para visualizar o anexo, se houver.")
-    ids = df["id"].tolist() if not df.empty else []
+    st.caption("Escolha um ID da página acima para visualizar o anexo, se houver.")
+    ids = page["id"].tolist() if not page.empty else []
     if ids:
         id_sel = st.selectbox("ID do lançamento", options=ids)
         if id_sel:
-            path = fetch_df("SELECT attachment_path FROM transactions WHERE id=?", (id_sel,))
+            path = fetch_df("SELECT attachment_path, attachment_name FROM transactions WHERE id=?", (id_sel,))
             if not path.empty and pd.notna(path.iloc[0, 0]) and str(path.iloc[0, 0]).strip():
-                show_attachment_ui(str(path.iloc[0, 0]))
+                name = path.iloc[0, 1]
+                show_attachment_ui(str(path.iloc[0, 0]), name if pd.notna(name) else None)
             else:
                 st.info("Este lançamento não possui anexo salvo.")
     st.markdown('</div>', unsafe_allow_html=True)
 
 # ====================== Páginas principais ======================
-def _fluxo_caixa_df():
-    q = """
+_FLUXO_CAIXA_SQL = """
+    SELECT ym, saldo FROM (
         SELECT
-            strftime('%Y-%m', date(trx_date)) as ym,
-            SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-            SUM(CASE WHEN type IN ('expense','tax','payroll','card') THEN amount ELSE 0 END) AS saldo
-        FROM transactions
+            ym,
+            (SUM(CASE WHEN type='income' THEN total_cents ELSE 0 END) -
+             SUM(CASE WHEN type IN ('expense','tax','payroll','card') THEN total_cents ELSE 0 END)) / 100.0 AS saldo
+        FROM monthly_rollup
+        WHERE status <> 'canceled'
         GROUP BY ym
-        ORDER BY ym ASC
-    """
-    df = fetch_df(q)
+        ORDER BY ym DESC
+        LIMIT 6
+    ) ORDER BY ym ASC
+"""
+
+def _fluxo_caixa_df():
+    q = _FLUXO_CAIXA_SQL
+    df = page_memo("fluxo_caixa", fetch_df, q)
     if df.empty:
         return pd.DataFrame({"mes_label": ["Jan","Fev","Mar","Abr","Mai","Jun"], "saldo": [0,0,0,0,0,0]})
     df["ym_dt"] = pd.to_datetime(df["ym"] + "-01")
@@ -1011,11 +3361,12 @@ def page_home():
     df_fluxo = _fluxo_caixa_df()
     tpl = "plotly_white"; paper_bg = "rgba(0,0,0,0)"
     if go and not df_fluxo.empty:
-        fig_fluxo = go.Figure(data=[go.Bar(x=df_fluxo["mes_label"], y=df_fluxo["saldo"])])
-        fig_fluxo.update_layout(template=tpl, paper_bgcolor=paper_bg, plot_bgcolor=paper_bg,
-                                margin=dict(t=20,b=12,l=12,r=12), height=300,
-                                yaxis_title="Saldo (R$)", xaxis_title="Mês")
-        st.plotly_chart(fig_fluxo, use_container_width=True)
+        with trace_span("chart", "home: fluxo de caixa"):
+            fig_fluxo = go.Figure(data=[go.Bar(x=df_fluxo["mes_label"], y=df_fluxo["saldo"])])
+            fig_fluxo.update_layout(template=tpl, paper_bgcolor=paper_bg, plot_bgcolor=paper_bg,
+                                    margin=dict(t=20,b=12,l=12,r=12), height=300,
+                                    yaxis_title="Saldo (R$)", xaxis_title="Mês")
+            st.plotly_chart(fig_fluxo, use_container_width=True)
     else:
         st.bar_chart(df_fluxo.set_index("mes_label"))
 
@@ -1025,38 +3376,33 @@ def page_home():
     tpl = "plotly_white"
 
     q_desp = """
-        SELECT
-            COALESCE((SELECT name FROM categories c WHERE c.id = t.category_id),'(sem categoria)') as Categoria,
-            SUM(t.amount) as Total
-        FROM transactions t
-        WHERE t.type IN ('expense','tax','payroll','card')
-        GROUP BY Categoria
-        ORDER BY Total DESC
+        SELECT r.category_id, SUM(r.total_cents) / 100.0 as Total
+        FROM monthly_rollup r
+        WHERE r.type IN ('expense','tax','payroll','card') AND r.status <> 'canceled'
+        GROUP BY r.category_id
     """
     q_desp, p_desp = scope_filters(q_desp, [])
-    df_desp = fetch_df(q_desp, tuple(p_desp))
+    df_desp = page_memo("home_desp", category_totals, q_desp, tuple(p_desp))
 
     q_rec = """
-        SELECT
-            COALESCE((SELECT name FROM categories c WHERE c.id = t.category_id),'(sem categoria)') as Categoria,
-            SUM(t.amount) as Total
-        FROM transactions t
-        WHERE t.type = 'income'
-        GROUP BY Categoria
-        ORDER BY Total DESC
+        SELECT r.category_id, SUM(r.total_cents) / 100.0 as Total
+        FROM monthly_rollup r
+        WHERE r.type = 'income' AND r.status <> 'canceled'
+        GROUP BY r.category_id
     """
     q_rec, p_rec = scope_filters(q_rec, [])
-    df_rec = fetch_df(q_rec, tuple(p_rec))
+    df_rec = page_memo("home_rec", category_totals, q_rec, tuple(p_rec))
 
     st.markdown('<div class="finapp-grid">', unsafe_allow_html=True)
 
     st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
     st.markdown("**Despesas por Categoria**")
     if px and not df_desp.empty and df_desp["Total"].sum() > 0:
-        fig1 = px.pie(df_desp, names="Categoria", values="Total", hole=0.35, color_discrete_sequence=palette)
-        fig1.update_traces(textposition='inside', textinfo='percent+label')
-        fig1.update_layout(template=tpl, paper_bgcolor=paper_bg, plot_bgcolor=paper_bg, margin=dict(t=20,b=12,l=12,r=12))
-        st.plotly_chart(fig1, use_container_width=True)
+        with trace_span("chart", "home: despesas por categoria"):
+            fig1 = px.pie(df_desp, names="Categoria", values="Total", hole=0.35, color_discrete_sequence=palette)
+            fig1.update_traces(textposition='inside', textinfo='percent+label')
+            fig1.update_layout(template=tpl, paper_bgcolor=paper_bg, plot_bgcolor=paper_bg, margin=dict(t=20,b=12,l=12,r=12))
+            st.plotly_chart(fig1, use_container_width=True)
     elif df_desp.empty:
         st.info("Sem dados de despesas para exibir.")
     else:
@@ -1067,10 +3413,11 @@ def page_home():
     st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
     st.markdown("**Receitas por Categoria**")
     if px and not df_rec.empty and df_rec["Total"].sum() > 0:
-        fig2 = px.pie(df_rec, names="Categoria", values="Total", hole=0.35, color_discrete_sequence=palette)
-        fig2.update_traces(textposition='inside', textinfo='percent+label')
-        fig2.update_layout(template=tpl, paper_bgcolor=paper_bg, plot_bgcolor=paper_bg, margin=dict(t=20,b=12,l=12,r=12))
-        st.plotly_chart(fig2, use_container_width=True)
+        with trace_span("chart", "home: receitas por categoria"):
+            fig2 = px.pie(df_rec, names="Categoria", values="Total", hole=0.35, color_discrete_sequence=palette)
+            fig2.update_traces(textposition='inside', textinfo='percent+label')
+            fig2.update_layout(template=tpl, paper_bgcolor=paper_bg, plot_bgcolor=paper_bg, margin=dict(t=20,b=12,l=12,r=12))
+            st.plotly_chart(fig2, use_container_width=True)
     elif df_rec.empty:
         st.info("Sem dados de receitas para exibir.")
     else:
@@ -1138,7 +3485,7 @@ def page_receitas_despesas():
     tipo_lcto = st.selectbox(
         "Selecione o tipo de lançamento",
         options=["— selecione —", "Receita", "Despesa", "Imposto/Taxa", "Folha", "Cartão"],
-        index=0
+        key="rd_tipo_lcto"
     )
 
     if tipo_lcto == "Receita":
@@ -1157,6 +3504,134 @@ def page_receitas_despesas():
     st.markdown('<div style="height:10px"></div>', unsafe_allow_html=True)
     tabela_lancamentos_filtro()
 
+_SIGNED_CENTS = "CASE WHEN t.type = 'income' THEN t.amount_cents ELSE -t.amount_cents END"
+
+def _refresh_balance_checkpoints(conn: sqlite3.Connection, acc_id: int):
+    """Completa os checkpoints da conta a partir do último ainda válido, acumulando o monthly_rollup."""
+    row = conn.execute(
+        "SELECT ym, balance_cents FROM account_balance_checkpoints WHERE account_id = ? ORDER BY ym DESC LIMIT 1",
+        (acc_id,),
+    ).fetchone()
+    last, base = (row[0], row[1]) if row else ("", 0)
+    conn.execute("""
+        INSERT OR REPLACE INTO account_balance_checkpoints (account_id, ym, balance_cents)
+        SELECT ?, ym, ? + SUM(s) OVER (ORDER BY ym ROWS UNBOUNDED PRECEDING)
+          FROM (SELECT ym, SUM(CASE WHEN type = 'income' THEN total_cents ELSE -total_cents END) AS s
+                  FROM monthly_rollup
+                 WHERE account_id = ? AND status <> 'canceled' AND ym > ?
+                 GROUP BY ym)
+    """, (acc_id, base, acc_id, last))
+
+def ensure_balance_checkpoints(acc_id: int):
+    """Recalcula os checkpoints que as escritas invalidaram (só quando o último mês não bate)."""
+    row = fetch_df("""
+        SELECT (SELECT MAX(ym) FROM account_balance_checkpoints WHERE account_id = ?) AS ck,
+               (SELECT MAX(ym) FROM monthly_rollup WHERE account_id = ? AND status <> 'canceled') AS ro
+    """, (acc_id, acc_id)).iloc[0]
+    if pd.notna(row["ro"]) and row["ck"] != row["ro"]:
+        _db_write(lambda conn: _refresh_balance_checkpoints(conn, acc_id), tables=("account_balance_checkpoints",))
+
+def _saldo_inicial_query(acc_id: int, start: str) -> Tuple[str, List]:
+    # checkpoint do último mês fechado antes de `start` + lançamentos do próprio mês até a véspera
+    q = f"""
+        SELECT IFNULL((SELECT c.balance_cents FROM account_balance_checkpoints c
+                        WHERE c.account_id = ? AND c.ym < ? ORDER BY c.ym DESC LIMIT 1), 0)
+             + IFNULL((SELECT SUM({_SIGNED_CENTS}) FROM transactions t
+                        WHERE t.account_id = ? AND t.status <> 'canceled'
+                          AND t.trx_date >= ? AND t.trx_date < ?), 0) AS saldo_cents
+    """
+    return q, [acc_id, start[:7], acc_id, start[:7] + "-01", start]
+
+def account_opening_balance(acc_id: int, start: str) -> int:
+    """Saldo da conta antes de `start` ('AAAA-MM-DD'), em centavos, sem lançamentos cancelados."""
+    ensure_balance_checkpoints(acc_id)
+    q, p = _saldo_inicial_query(acc_id, start)
+    return int(fetch_df(q, tuple(p)).iloc[0, 0] or 0)
+
+def _extrato_query(acc_id: int, start: str, end: str, closing_cents: int,
+                   after: Optional[Tuple] = None, limit: Optional[int] = None) -> Tuple[str, List]:
+    # Saldo corrido de trás para frente: saldo da linha = semente - o que entrou/saiu depois dela.
+    # Primeira página: semente = saldo final do período. Demais: o cursor (Data, id, Saldo) traz o
+    # saldo da última linha exibida; ela entra no recorte só para ancorar a conta. Assim a janela
+    # só percorre as linhas da página (LIMIT antes do SUM() OVER), não o período inteiro.
+    bound, params = "", [acc_id, start, end]
+    seed = closing_cents
+    if after is not None:
+        bound = " AND (t.trx_date, t.id) <= (?, ?)"
+        params += [after[0], after[1]]
+        seed = round(float(after[2]) * 100)
+    rows = f" LIMIT {int(limit) + (after is not None)}" if limit else ""
+    q = f"""
+        SELECT * FROM (
+            SELECT id, trx_date as Data, type as Tipo, description as Descrição, cents / 100.0 as Valor,
+                   (? - IFNULL(SUM(cents) OVER (ORDER BY trx_date DESC, id DESC
+                                                ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0)) / 100.0 as Saldo,
+                   status as Status
+            FROM (
+                SELECT t.id, t.trx_date, t.type, t.description, t.status, {_SIGNED_CENTS} AS cents
+                FROM transactions t
+                WHERE t.account_id = ? AND t.status <> 'canceled' AND t.trx_date BETWEEN ? AND ?{bound}
+                ORDER BY t.trx_date DESC, t.id DESC{rows}
+            )
+        )
+    """
+    params = [seed] + params
+    if after is not None:
+        q += " WHERE (Data, id) < (?, ?)"
+        params += [after[0], after[1]]
+    q += " ORDER BY Data DESC, id DESC"
+    return q, params
+
+def _extrato_total_query(acc_id: int, start: str, end: str) -> Tuple[str, List]:
+    q = """
+        SELECT COUNT(*) AS n,
+               SUM(CASE WHEN t.type = 'income' THEN t.amount_cents ELSE 0 END) AS entradas_cents,
+               SUM(CASE WHEN t.type = 'income' THEN 0 ELSE t.amount_cents END) AS saidas_cents
+        FROM transactions t
+        WHERE t.account_id = ? AND t.status <> 'canceled' AND t.trx_date BETWEEN ? AND ?
+    """
+    return q, [acc_id, start, end]
+
+def _importar_extrato_ui(acc_id: int):
+    with st.expander("📥 Importar extrato (CSV/OFX)", expanded=False):
+        up = st.file_uploader("Arquivo do banco", type=["ofx", "csv", "txt"], key="imp_file")
+        if up is None:
+            st.caption("OFX é lido direto; no CSV escolha quais colunas trazem data, valor e descrição. "
+                       "Linhas já importadas (mesmo ID do banco ou mesmo conteúdo) são ignoradas.")
+            return
+        cats = fetch_df("SELECT id, name FROM categories ORDER BY name")
+        cat_opts = [(None, "—")] + [(int(r.id), r.name) for _, r in cats.iterrows()]
+        cat = st.selectbox("Categoria padrão", options=cat_opts, format_func=safe_label, key="imp_cat",
+                           help="Usada quando o arquivo não traz categoria (ou ela não existe no cadastro).")
+
+        mapping, encoding = None, "utf-8-sig"
+        if not up.name.lower().endswith(".ofx"):
+            encoding = st.selectbox("Codificação", ["utf-8-sig", "cp1252"], key="imp_enc",
+                                    format_func=lambda x: {"utf-8-sig": "UTF-8", "cp1252": "Windows-1252 (Latin-1)"}[x])
+            header, _ = csv_statement_header(up, encoding)
+            guess = guess_csv_mapping(header)
+            cols = [None] + header
+            labels = {"date": "Data *", "amount": "Valor *", "description": "Descrição", "id": "ID do banco",
+                      "counterparty": "Contraparte", "doc": "Documento", "category": "Categoria"}
+            mapping = {}
+            grid = st.columns(4)
+            for i, (field, lab) in enumerate(labels.items()):
+                mapping[field] = grid[i % 4].selectbox(
+                    lab, cols, index=cols.index(guess[field]), key=f"imp_col_{field}",
+                    format_func=lambda c: "—" if c is None else c,
+                )
+
+        if st.button("Importar", type="primary", key="imp_go"):
+            try:
+                with st.spinner("Importando extrato..."):
+                    stats = import_statement_file(up, up.name, acc_id, mapping=mapping, encoding=encoding,
+                                                  default_category_id=cat[0] if isinstance(cat, tuple) else None)
+            except Exception as e:
+                st.error(f"Falha ao importar: {e}")
+                return
+            flash(import_summary(up.name, stats), "success" if stats["inserted"] else "info", 6)
+            do_rerun()
+
 def page_extratos():
     st.markdown("## Extratos")
     st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
@@ -1167,38 +3642,238 @@ def page_extratos():
         return
 
     nomes = [(int(r.id), f"{r.name} ({r.type})") for _, r in accs.iterrows()]
-    acc_sel = st.selectbox("Conta", options=nomes, index=0, format_func=lambda x: x[1] if isinstance(x, tuple) else x)
+    acc_sel = st.selectbox("Conta", options=nomes, format_func=lambda x: x[1] if isinstance(x, tuple) else x, key="ext_acc")
     acc_id = acc_sel if isinstance(acc_sel, int) else acc_sel[0]
 
-    q = """
-        SELECT t.id, t.trx_date as Data, t.type as Tipo, t.description as Descrição, t.amount as Valor,
-               t.status as Status
-        FROM transactions t
-        WHERE t.account_id = ?
-        ORDER BY date(t.trx_date) DESC, t.id DESC
-    """
-    df = fetch_df(q, (acc_id,))
-    show_df(df, empty_msg="Sem movimentações para esta conta.")
-    saldo = 0.0
-    if not df.empty:
-        entradas = df.loc[df["Tipo"] == "income", "Valor"].sum()
-        saidas = df.loc[df["Tipo"] != "income", "Valor"].sum()
-        saldo = float(entradas - saidas)
-    st.metric("Saldo estimado da conta", money(saldo))
+    c1, c2 = st.columns(2)
+    st.session_state.setdefault("ext_ini", date(date.today().year, 1, 1))
+    st.session_state.setdefault("ext_fim", date.today())
+    ini = c1.date_input("De", key="ext_ini").isoformat()
+    fim = c2.date_input("Até", key="ext_fim").isoformat()
+
+    abertura = account_opening_balance(acc_id, ini)
+    placeholder = st.container()
+    # O agregado sai do cache de consultas (o keyset_grid repete a mesma consulta)
+    tq, tp = _extrato_total_query(acc_id, ini, fim)
+    totals = fetch_df(tq, tuple(tp))
+    agg = totals.iloc[0] if not totals.empty else None
+    entradas = int(agg["entradas_cents"]) if agg is not None and pd.notna(agg["entradas_cents"]) else 0
+    saidas = int(agg["saidas_cents"]) if agg is not None and pd.notna(agg["saidas_cents"]) else 0
+    # cursores carregam o saldo: qualquer escrita em transactions volta à primeira página
+    keyset_grid(
+        "grid_ext",
+        lambda after, limit: _extrato_query(acc_id, ini, fim, abertura + entradas - saidas, after=after, limit=limit),
+        (tq, tp),
+        cursor_cols=("Data", "id", "Saldo"),
+        empty_msg="Sem movimentações para esta conta no período.",
+        stamp=table_generations(("transactions",)),
+    )
+    m1, m2, m3, m4 = placeholder.columns(4)
+    m1.metric("Saldo inicial", money(abertura / 100))
+    m2.metric("Entradas", money(entradas / 100))
+    m3.metric("Saídas", money(saidas / 100))
+    m4.metric("Saldo final", money((abertura + entradas - saidas) / 100))
+    _importar_extrato_ui(acc_id)
     st.markdown('</div>', unsafe_allow_html=True)
 
+_PENDENTES_SQL = """
+    SELECT id, trx_date as Data, description as Descrição, amount as Valor, status as Status
+    FROM transactions
+    WHERE status IN ('planned','paid','overdue')
+    ORDER BY trx_date DESC, id DESC
+    LIMIT 300
+"""
+
+_CONCILIADOS_SQL = """
+    SELECT id, trx_date as Data, description as Descrição, amount as Valor, paid_date as 'Conciliado em'
+    FROM transactions
+    WHERE status='reconciled'
+    ORDER BY paid_date DESC, id DESC
+    LIMIT 300
+"""
+
+# ===== Conciliação automática (extrato importado x lançamentos em aberto) =====
+_STATEMENT_LINES_SQL = """
+    SELECT id, trx_date, type, amount_cents AS cents, account_id,
+           TRIM(IFNULL(description, '') || ' ' || IFNULL(counterparty, '')) AS text
+    FROM transactions
+    WHERE account_id = ? AND origin IN ('bank','import') AND status IN ('planned','paid','overdue')
+"""
+
+# Lançamentos da conta ou sem conta; tipos de saída (tax/payroll/card/...) casam com débitos do extrato
+_RECON_CANDIDATES_SQL = """
+    SELECT id, trx_date, IFNULL(due_date, '') AS due_date,
+           CASE WHEN type = 'income' THEN 'income' ELSE 'expense' END AS type,
+           amount_cents AS cents, IFNULL(account_id, 0) AS account_id,
+           TRIM(IFNULL(description, '') || ' ' || IFNULL(counterparty, '')) AS text
+    FROM transactions
+    WHERE status IN ('planned','paid','overdue') AND IFNULL(origin, 'manual') NOT IN ('bank','import')
+      AND IFNULL(account_id, ?) = ?
+"""
+
+_TOKEN_RE = re.compile(r"[a-z0-9]{2,}")
+
+def _match_tokens(text: str) -> frozenset:
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    return frozenset(_TOKEN_RE.findall(text.encode("ascii", "ignore").decode("ascii")))
+
+@lru_cache(maxsize=4096)
+def _day_ordinal(d: str) -> Optional[int]:
+    try:
+        return date.fromisoformat(str(d)[:10]).toordinal()
+    except ValueError:
+        return None
+
+def match_statement_lines(lines, candidates, window_days: int = RECON_WINDOW_DAYS,
+                          min_score: float = RECON_MIN_SCORE) -> List[Tuple[float, int, int, int]]:
+    """Sugere pares um-para-um (linha do extrato, lançamento).
+
+    lines: (id, data, tipo, centavos, conta, texto); candidates: (id, trx_date, due_date, tipo, centavos,
+    conta ou 0, texto). Os candidatos ficam num dict por (tipo, centavos), cada chave com a lista ordenada
+    por data (trx_date e due_date); cada linha só olha o intervalo ±window_days achado por bisect,
+    em vez de comparar com todos. Score: proximidade da data (60%) + Jaccard das palavras da
+    descrição/contraparte (40%). Devolve [(score, line_id, cand_id, dias)], maior score primeiro.
+    """
+    index = {}
+    for cid, trx, due, typ, cents, acc, text in candidates:
+        toks = _match_tokens(text)
+        for day in {_day_ordinal(trx), _day_ordinal(due) if due else None} - {None}:
+            index.setdefault((typ, cents), []).append((day, cid, acc, toks))
+    days = {}
+    for key, bucket in index.items():
+        bucket.sort(key=lambda e: e[0])
+        days[key] = [e[0] for e in bucket]
+
+    scored = []
+    for lid, d, typ, cents, acc, text in lines:
+        key, day = (typ, cents), _day_ordinal(d)
+        if key not in index or day is None:
+            continue
+        bucket, keys = index[key], days[key]
+        toks = _match_tokens(text)
+        best = {}
+        for cday, cid, cacc, ctoks in bucket[bisect_left(keys, day - window_days):bisect_right(keys, day + window_days)]:
+            if cacc and acc and cacc != acc:
+                continue
+            dd = abs(cday - day)
+            sim = len(toks & ctoks) / len(toks | ctoks) if (toks or ctoks) else 0.0
+            score = 0.6 * (1 - dd / (window_days + 1)) + 0.4 * sim
+            if score >= min_score and score > best.get(cid, (-1.0, 0))[0]:
+                best[cid] = (score, dd)
+        scored.extend((sc, lid, cid, dd) for cid, (sc, dd) in best.items())
+
+    scored.sort(key=lambda x: (-x[0], x[3], x[1], x[2]))
+    used_lines, used_cands, out = set(), set(), []
+    for sc, lid, cid, dd in scored:
+        if lid in used_lines or cid in used_cands:
+            continue
+        used_lines.add(lid)
+        used_cands.add(cid)
+        out.append((sc, lid, cid, dd))
+    return out
+
+def propose_reconciliation(account_id: int, window_days: int = RECON_WINDOW_DAYS,
+                           min_score: float = RECON_MIN_SCORE) -> pd.DataFrame:
+    """Sugestões de conciliação da conta, uma linha por par, com os dados dos dois lados."""
+    lines = fetch_df(_STATEMENT_LINES_SQL, (account_id,))
+    cands = fetch_df(_RECON_CANDIDATES_SQL, (account_id, account_id))
+    cols = ["Aceitar", "Score", "Dias", "extrato_id", "Data extrato", "Extrato", "lanc_id",
+            "Data lançamento", "Lançamento", "Valor"]
+    if lines.empty or cands.empty:
+        return pd.DataFrame(columns=cols)
+    pairs = match_statement_lines(lines.itertuples(index=False, name=None), cands.itertuples(index=False, name=None),
+                                  window_days, min_score)
+    if not pairs:
+        return pd.DataFrame(columns=cols)
+    lk, ck = lines.set_index("id"), cands.set_index("id")
+    lids = [p[1] for p in pairs]
+    cids = [p[2] for p in pairs]
+    return pd.DataFrame({
+        "Aceitar": True,
+        "Score": [round(p[0], 2) for p in pairs],
+        "Dias": [p[3] for p in pairs],
+        "extrato_id": lids,
+        "Data extrato": lk.loc[lids, "trx_date"].values,
+        "Extrato": lk.loc[lids, "text"].values,
+        "lanc_id": cids,
+        "Data lançamento": ck.loc[cids, "trx_date"].values,
+        "Lançamento": ck.loc[cids, "text"].values,
+        "Valor": lk.loc[lids, "cents"].values / 100.0,
+    }, columns=cols)
+
+def apply_reconciliation(pairs: List[Tuple[int, int]]) -> int:
+    """Concilia os pares (linha do extrato, lançamento) numa única transação.
+
+    O lançamento recebe status='reconciled', paid_date = data do extrato e reconciled_with = id da
+    linha. A linha do extrato é mantida (com o external_id, então reimportar continua sendo ignorado)
+    como 'canceled' + reconciled_with = id do lançamento: extrato, KPIs e painéis ignoram cancelados,
+    então o valor não conta duas vezes, mas o dado do banco e o vínculo ficam. Pares cujo lado já não está em aberto são pulados. Devolve os conciliados.
+    """
+    def _apply(conn: sqlite3.Connection) -> int:
+        marks = ",".join("?" * len(pairs))
+        stmt = {r[0]: r[1:] for r in conn.execute(
+            f"SELECT id, trx_date, account_id FROM transactions "
+            f"WHERE id IN ({marks}) AND origin IN ('bank','import') AND status IN ('planned','paid','overdue')",
+            [lid for lid, _ in pairs])}
+        ok = [(lid, cid) for lid, cid in pairs if lid in stmt]
+        cur = conn.executemany(
+            """
+            UPDATE transactions
+               SET status = 'reconciled', paid_date = ?, account_id = IFNULL(account_id, ?), reconciled_with = ?
+             WHERE id = ? AND status IN ('planned','paid','overdue')
+            """,
+            [(stmt[lid][0], stmt[lid][1], lid, cid) for lid, cid in ok],
+        )
+        if cur.rowcount != len(ok):
+            raise RuntimeError("Algum lançamento mudou durante a conciliação; recarregue as sugestões.")
+        conn.executemany("UPDATE transactions SET status = 'canceled', reconciled_with = ? WHERE id = ?",
+                         [(cid, lid) for lid, cid in ok])
+        return cur.rowcount
+    if not pairs:
+        return 0
+    return _db_write(_apply, tables=("transactions",))
+
+def _conciliacao_automatica_ui():
+    st.subheader("Conciliação automática")
+    accs = fetch_df("SELECT id, name FROM accounts ORDER BY name")
+    if accs.empty:
+        st.caption("Cadastre uma conta e importe o extrato em **Extratos** para receber sugestões.")
+        return
+    c1, c2, c3 = st.columns([2, 1, 1])
+    acc = c1.selectbox("Conta do extrato", options=[(int(r.id), r.name) for _, r in accs.iterrows()],
+                       format_func=safe_label, key="rec_acc")
+    window = c2.number_input("Janela (± dias)", min_value=0, max_value=60, value=RECON_WINDOW_DAYS, step=1, key="rec_win")
+    min_score = c3.slider("Score mínimo", 0.0, 1.0, RECON_MIN_SCORE, 0.05, key="rec_min")
+
+    props = page_memo("recon", propose_reconciliation, acc[0], int(window), float(min_score))
+    if props.empty:
+        st.info("Nenhuma linha de extrato importado casou com lançamentos em aberto desta conta.")
+        return
+    st.caption(f"{len(props)} sugestão(ões): mesmo valor, data próxima (lançamento ou vencimento) e descrição parecida.")
+    edited = st.data_editor(
+        props, hide_index=True, use_container_width=True, key="rec_editor",
+        disabled=[c for c in props.columns if c != "Aceitar"],
+        column_config={"Valor": st.column_config.NumberColumn(format="R$ %.2f")},
+    )
+    chosen = edited.loc[edited["Aceitar"], ["extrato_id", "lanc_id"]]
+    if st.button(f"Conciliar {len(chosen)} selecionado(s)", type="primary", key="rec_apply", disabled=chosen.empty):
+        try:
+            n = apply_reconciliation([(int(a), int(b)) for a, b in chosen.itertuples(index=False, name=None)])
+        except Exception as e:
+            flash(f"Falha ao conciliar: {e}", "error", 4)
+        else:
+            flash(f"{n} lançamento(s) conciliado(s) com o extrato.", "success", 3)
+        do_rerun()
+
 def page_conciliacao():
     st.markdown("## Conciliação")
     st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
     st.info("Marque lançamentos como conciliados. Os itens conciliados descem para a lista **Conciliados**.")
 
-    pendentes = fetch_df("""
-        SELECT id, trx_date as Data, description as Descrição, amount as Valor, status as Status
-        FROM transactions
-        WHERE status IN ('planned','paid','overdue')
-        ORDER BY date(trx_date) DESC, id DESC
-        LIMIT 300
-    """)
+    _conciliacao_automatica_ui()
+    st.markdown("---")
+
+    pendentes = fetch_df(_PENDENTES_SQL)
     st.subheader("A conciliar")
     if pendentes.empty:
         st.success("Não há lançamentos pendentes para conciliar.")
@@ -1219,13 +3894,7 @@ def page_conciliacao():
 
     st.markdown("---")
 
-    reconc = fetch_df("""
-        SELECT id, trx_date as Data, description as Descrição, amount as Valor, paid_date as 'Conciliado em'
-        FROM transactions
-        WHERE status='reconciled'
-        ORDER BY date(paid_date) DESC, id DESC
-        LIMIT 300
-    """)
+    reconc = fetch_df(_CONCILIADOS_SQL)
     st.subheader("Conciliados")
     if reconc.empty:
         st.info("Ainda não há itens conciliados.")
@@ -1234,24 +3903,32 @@ def page_conciliacao():
 
     st.markdown('</div>', unsafe_allow_html=True)
 
+def _resumo_categoria_df(query: str, params: Tuple) -> pd.DataFrame:
+    df = label_dimensions(fetch_df(query, params), (("Categoria", "categories"),))
+    if df.empty:
+        return df
+    df = df.groupby(["Categoria", "Tipo"], dropna=False, as_index=False, sort=False).sum()
+    return df.sort_values("Categoria", key=lambda c: c.fillna("(sem)"), kind="stable", ignore_index=True)
+
+_RESUMO_CATEGORIA_SQL = """
+    SELECT
+        r.category_id as Categoria,
+        r.type as Tipo,
+        SUM(CASE WHEN r.type='income' THEN r.total_cents ELSE 0 END) / 100.0 as Total_Receitas,
+        SUM(CASE WHEN r.type!='income' THEN r.total_cents ELSE 0 END) / 100.0 as Total_Despesas
+    FROM monthly_rollup r
+    WHERE r.status <> 'canceled'
+    GROUP BY r.category_id, r.type
+"""
+
 def page_relatorios():
     st.markdown("## Relatórios e Dashboard")
     kpis_cards()
 
     st.markdown('<div class="finapp-card">', unsafe_allow_html=True)
     st.subheader("Resumo por Categoria")
-    q = """
-        SELECT
-            (SELECT name FROM categories c WHERE c.id = t.category_id) as Categoria,
-            t.type as Tipo,
-            SUM(CASE WHEN t.type='income' THEN t.amount ELSE 0 END) as Total_Receitas,
-            SUM(CASE WHEN t.type!='income' THEN t.amount ELSE 0 END) as Total_Despesas
-        FROM transactions t
-        GROUP BY Categoria, Tipo
-        ORDER BY COALESCE(Categoria,'(sem)') ASC
-    """
-    q, p = scope_filters(q, [])
-    dfc = fetch_df(q, tuple(p))
+    q, p = scope_filters(_RESUMO_CATEGORIA_SQL, [])
+    dfc = page_memo("resumo_categoria", _resumo_categoria_df, q, tuple(p))
     show_df(dfc, empty_msg="Sem dados para o período.")
     col1, col2 = st.columns(2)
     with col1:
@@ -1260,6 +3937,105 @@ def page_relatorios():
         export_csv(dfc, "resumo_categoria.csv")
     st.markdown('</div>', unsafe_allow_html=True)
 
+# ====================== Planos de consulta (consultas quentes) ======================
+def _hot_queries() -> List[Tuple[str, str, List]]:
+    """Consultas quentes das páginas, com parâmetros representativos, para o EXPLAIN QUERY PLAN."""
+    ini, fim = date(date.today().year, 1, 1).isoformat(), date.today().isoformat()
+    out = []
+    for tipo, status in [("Todos", "Todos"), ("expense", "Todos"), ("Todos", "paid"), ("income", "planned")]:
+        q, p = _lancamentos_query(ini, fim, tipo, status)
+        out.append((f"lancamentos[{tipo}/{status}]", q, p))
+    q, p = _lancamentos_query(ini, fim, after=(fim, 10**9), limit=101)
+    out.append(("lancamentos[pagina 2]", q, p))
+    q, p = _lancamentos_total_query(ini, fim, "expense", "Todos")
+    out.append(("lancamentos[total]", q, p))
+    q, p = _extrato_query(1, ini, fim, 0, limit=101)
+    out.append(("extrato", q, p))
+    q, p = _extrato_query(1, ini, fim, 0, after=(fim, 10**9, 0.0), limit=101)
+    out.append(("extrato[pagina 2]", q, p))
+    q, p = _extrato_total_query(1, ini, fim)
+    out.append(("extrato[total]", q, p))
+    q, p = _saldo_inicial_query(1, ini)
+    out.append(("extrato[saldo inicial]", q, p))
+    q, p = _busca_query("acme", ini, fim)
+    out.append(("busca", q, p))
+    q, p = _busca_total_query("acme", ini, fim)
+    out.append(("busca[total]", q, p))
+    out.append(("conciliacao_pendentes", _PENDENTES_SQL, []))
+    out.append(("conciliacao_conciliados", _CONCILIADOS_SQL, []))
+    out.append(("conciliacao_extrato", _STATEMENT_LINES_SQL, [1]))
+    out.append(("conciliacao_candidatos", _RECON_CANDIDATES_SQL, [1, 1]))
+    return out
+
+def _is_full_scan(detail: str, query: str) -> bool:
+    if not detail.startswith("SCAN ") or detail.startswith(("SCAN (subquery", "SCAN CONSTANT ROW")):
+        return False
+    # FTS5 aparece como SCAN da tabela virtual; com MATCH (idxStr com 'M') a busca usa o índice invertido
+    if re.search(r" VIRTUAL TABLE INDEX \d+:\S*M", detail):
+        return False
+    # Percorrer um índice na ordem do ORDER BY e parar no LIMIT é aceitável
+    return not (" USING INDEX " in detail and " LIMIT " in " ".join(query.upper().split()) + " ")
+
+def check_query_plans() -> List[str]:
+    """Roda EXPLAIN QUERY PLAN nas consultas quentes e devolve as que regrediram para SCAN de tabela."""
+    problems = []
+    with _connect() as conn:
+        for name, q, params in _hot_queries():
+            plan = conn.execute("EXPLAIN QUERY PLAN " + q, tuple(params)).fetchall()
+            scans = [str(r[-1]) for r in plan if _is_full_scan(str(r[-1]), q)]
+            if scans:
+                problems.append(f"{name}: {'; '.join(scans)}")
+    return problems
+
+def _download_payloads() -> List[Tuple[str, Callable[[], Any]]]:
+    """(arquivo, gerador) dos downloads gerados sob demanda, para check_downloads."""
+    q, p = _lancamentos_query("0000-01-01", "9999-12-31")
+    out = [(file_name, make) for _, make, file_name, _ in _export_downloads(q, tuple(p), "lancamentos")]
+    out.append(("finapp-public.ics", lambda: _ics_bytes("public", None)))
+    return out
+
+def check_downloads() -> List[str]:
+    """Passa cada gerador de download pelo conversor do st.download_button; devolve os que falham."""
+    try:
+        from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+    except ImportError:  # Streamlit antigo
+        from streamlit.elements.widgets.button import convert_data_to_bytes_and_infer_mime
+    problems = []
+    for file_name, make in _download_payloads():
+        try:
+            payload = make()
+            data, _ = convert_data_to_bytes_and_infer_mime(payload, RuntimeError(f"tipo não aceito: {type(payload).__name__}"))
+        except Exception as e:
+            problems.append(f"{file_name}: {e}")
+            continue
+        if not data:
+            problems.append(f"{file_name}: arquivo vazio")
+    return problems
+
+def _dashboard_totals() -> dict:
+    return {name: fetch_df(q).to_dict("list") for name, q in
+            (("kpis", _KPI_SQL), ("fluxo_caixa", _FLUXO_CAIXA_SQL), ("resumo_categoria", _RESUMO_CATEGORIA_SQL))}
+
+def check_reconciliation_totals() -> List[str]:
+    """Lança uma despesa, importa a linha do extrato dela e concilia: KPIs, fluxo de caixa e resumo
+    por categoria devem ficar iguais aos de antes da importação. GRAVA DADOS: só em banco de teste."""
+    problems = []
+    today = date.today().isoformat()
+    acc = exec_sql("INSERT INTO accounts (name, type) VALUES (?, 'bank')", (f"check-conciliacao-{time.time_ns()}",))
+    cid = exec_sql("INSERT INTO transactions (trx_date, type, amount, status, origin, description) "
+                   "VALUES (?, 'expense', 1000, 'planned', 'manual', 'check conciliação')", (today,))
+    before = _dashboard_totals()
+    lid = exec_sql("INSERT INTO transactions (trx_date, type, amount, status, origin, account_id, description, external_id) "
+                   "VALUES (?, 'expense', 1000, 'paid', 'import', ?, 'check conciliação', ?)",
+                   (today, acc, f"check-{time.time_ns()}"))
+    if apply_reconciliation([(lid, cid)]) != 1:
+        problems.append("apply_reconciliation não conciliou o par de teste")
+    after = _dashboard_totals()
+    for name in before:
+        if before[name] != after[name]:
+            problems.append(f"{name}: {before[name]} antes, {after[name]} depois da conciliação")
+    return problems
+
 # ====================== Página Configurações ======================
 def section_campos_formulario():
     st.markdown("### Campos do formulário")
@@ -1468,15 +4244,64 @@ def section_cadastros():
 
     st.markdown('</div>', unsafe_allow_html=True)
 
+def section_diagnostico():
+    st.markdown("### Diagnóstico")
+    tracer = _tracer()
+    st.markdown("#### Cache de consultas")
+    stats = query_cache_stats()
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Acertos", f"{stats['hits']:,}".replace(",", "."))
+    c2.metric("Faltas", f"{stats['misses']:,}".replace(",", "."))
+    c3.metric("Taxa de acerto", f"{stats['hit_rate']:.0%}")
+    c4.metric("Entradas", f"{stats['entries']} ({stats['bytes'] / 1024 / 1024:.1f} MB)")
+    st.caption(f"Evicções LRU: {stats['evictions']} • Invalidações por escrita: {stats['invalidations']}")
+
+    st.markdown("#### Tempos")
+    events = tracer.events()
+    st.caption(f"Últimos {len(events)} evento(s) do processo (buffer de {TRACE_BUFFER_SIZE}) • "
+               f"consulta lenta: ≥ {SLOW_QUERY_MS:.0f} ms (FINAPP_SLOW_QUERY_MS) • "
+               + (f"trace em {tracer.path}" if tracer.path else "trace em arquivo desligado (FINAPP_TRACE_FILE)"))
+    kinds = {"Páginas": "page", "Consultas": "query", "Escritas": "write", "Gráficos": "chart", "Prévias": "preview",
+             "Tudo": None}
+    c1, c2 = st.columns([3, 1])
+    kind = c1.radio("Tipo", list(kinds), horizontal=True, key="diag_kind", label_visibility="collapsed")
+    if c2.button("Limpar eventos", key="diag_clear"):
+        tracer.clear()
+        do_rerun()
+    summary = tracer.summary(kinds[kind])
+    if summary.empty:
+        st.info("Nenhum evento registrado ainda.")
+    else:
+        st.dataframe(summary.round(2), use_container_width=True, hide_index=True,
+                     column_config={"name": st.column_config.TextColumn("nome", width="large")})
+
+    slow = [e for e in events if e.get("plan")]
+    if slow:
+        with st.expander(f"Consultas lentas ({len(slow)})", expanded=False):
+            for e in reversed(slow[-20:]):
+                st.markdown(f"**{e['ms']:.0f} ms** • {e.get('rows', '?')} linha(s)")
+                st.code(e["name"], language="sql")
+                st.caption(f"Plano: {e['plan']}")
+    with st.expander("Eventos recentes", expanded=False):
+        recent = pd.DataFrame(events[-200:][::-1])
+        if not recent.empty:
+            recent["ts"] = pd.to_datetime(recent["ts"], unit="s").dt.strftime("%H:%M:%S")
+        st.dataframe(recent, use_container_width=True, hide_index=True)
+
 def page_configuracoes():
     st.markdown("## Configurações")
-    tabs = st.tabs(["Campos do formulário", "Usuários & Permissões", "Cadastros"])
+    is_manager = st.session_state.get("user", {}).get("role") == "manager"
+    labels = ["Campos do formulário", "Usuários & Permissões", "Cadastros"] + (["Diagnóstico"] if is_manager else [])
+    tabs = st.tabs(labels)
     with tabs[0]:
         section_campos_formulario()
     with tabs[1]:
         section_usuarios_permissoes()
     with tabs[2]:
         section_cadastros()
+    if is_manager:
+        with tabs[3]:
+            section_diagnostico()
 
 # ====================== Página Agenda (Minha & Pública) ======================
 def _render_big_calendar(year: int, month: int, scope: str):
@@ -1531,10 +4356,11 @@ def _event_share_links(title: str, dt_ev: date, is_rec: bool, recur_rule: Option
     if desc:
         body += f"Notas: {desc}\\n"
     mailto = f"mailto:?subject={urlparse.quote(subj)}&body={urlparse.quote(body)}"
-    wa = f"https://wa.me/?text={urlparse.quote(subj + '\\n' + body)}"
+    wa_text = subj + "\\n" + body
+    wa = f"https://wa.me/?text={urlparse.quote(wa_text)}"
     return mailto, wa
 
-def _event_detail_form(eid: int):
+def _event_detail_form(eid: int, scope: str = "mine"):
     col = cal_date_col()
     df = fetch_df(f"SELECT *, {col} AS ev_date FROM calendar_events WHERE id=?", (int(eid),))
     if df.empty:
@@ -1545,7 +4371,8 @@ def _event_detail_form(eid: int):
     uid = _get_user_id()
     can_edit = (uid is not None) and (uid == owner or st.session_state.get("user",{}).get("role")=="manager")
 
-    with st.form(f"event_edit_{eid}"):
+    # o mesmo evento pode estar aberto nas abas "meus" e "públicos" na mesma execução
+    with st.form(f"event_edit_{scope}_{eid}"):
         c1, c2 = st.columns([2,1])
         title = c1.text_input("Título", value=str(r["title"]), disabled=not can_edit)
         dt_ev = c2.date_input("Data base", value=_parse_date(str(r["ev_date"])).date(), disabled=not can_edit)
@@ -1601,6 +4428,40 @@ def _event_detail_form(eid: int):
         st.markdown(f"- 💬 [Enviar no WhatsApp]({wa})")
         st.markdown('</div>', unsafe_allow_html=True)
 
+def _agenda_ics_ui():
+    uid = _get_user_id()
+    with st.expander("📆 Exportar, assinar ou importar (.ics)", expanded=False):
+        scope = st.radio("Escopo", ["mine", "public"], horizontal=True, key="ag_ics_scope",
+                         format_func=lambda x: {"mine": "Minha agenda", "public": "Agenda pública"}[x])
+        _download("⬇️ Baixar .ics", lambda: _ics_bytes(scope, uid), f"finapp-{scope}.ics", "text/calendar",
+                  key=f"ics_dl_{scope}")
+        if _ics_server() is not None and uid is not None:
+            st.caption("Link de assinatura (Google Agenda, Outlook, Calendário do iOS). Quem tiver o link lê este escopo.")
+            st.code(ics_feed_url(ics_token(uid), scope), language=None)
+            if st.button("Gerar novo link (invalida o anterior)", key="ics_rotate"):
+                ics_token(uid, rotate=True)
+                flash("Novo link de assinatura gerado.", "success", 3)
+                do_rerun()
+        else:
+            st.caption("Assinatura por link desativada (defina FINAPP_ICS_PORT para servir o feed).")
+
+        st.markdown("---")
+        up = st.file_uploader("Importar arquivo .ics", type=["ics"], key="ics_file")
+        if up is not None:
+            vis = st.selectbox("Visibilidade dos importados", ["Privado", "Público"], key="ics_vis")
+            if st.button("Importar compromissos", type="primary", key="ics_go"):
+                try:
+                    with st.spinner("Importando..."):
+                        stats = import_ics(up, uid, is_public=(vis == "Público"))
+                except Exception as e:
+                    st.error(f"Falha ao importar: {e}")
+                    return
+                msg = import_summary(up.name, stats)
+                if stats["simplified"]:
+                    msg += f"; {stats['simplified']} recorrência(s) não suportada(s) importada(s) como evento único"
+                flash(msg, "success" if stats["inserted"] else "info", 6)
+                do_rerun()
+
 def page_agenda():
     st.markdown("## Agenda")
     tabs = st.tabs(["Minha Agenda", "Calendário Público"])
@@ -1609,8 +4470,10 @@ def page_agenda():
     with tabs[0]:
         c1, c2, _ = st.columns([1,1,2])
         today = date.today()
-        year = c1.number_input("Ano", min_value=2000, max_value=2100, value=today.year, step=1, key="ag_my_year")
-        month = c2.number_input("Mês", min_value=1, max_value=12, value=today.month, step=1, key="ag_my_month")
+        st.session_state.setdefault("ag_my_year", today.year)
+        st.session_state.setdefault("ag_my_month", today.month)
+        year = c1.number_input("Ano", min_value=2000, max_value=2100, step=1, key="ag_my_year")
+        month = c2.number_input("Mês", min_value=1, max_value=12, step=1, key="ag_my_month")
         _render_big_calendar(int(year), int(month), scope="mine")
 
         st.markdown("### Novo compromisso")
@@ -1659,8 +4522,10 @@ def page_agenda():
     with tabs[1]:
         c1, c2, _ = st.columns([1,1,2])
         today = date.today()
-        year = c1.number_input("Ano", min_value=2000, max_value=2100, value=today.year, step=1, key="ag_pub_year")
-        month = c2.number_input("Mês", min_value=1, max_value=12, value=today.month, step=1, key="ag_pub_month")
+        st.session_state.setdefault("ag_pub_year", today.year)
+        st.session_state.setdefault("ag_pub_month", today.month)
+        year = c1.number_input("Ano", min_value=2000, max_value=2100, step=1, key="ag_pub_year")
+        month = c2.number_input("Mês", min_value=1, max_value=12, step=1, key="ag_pub_month")
         _render_big_calendar(int(year), int(month), scope="public")
 
         st.markdown("---")
@@ -1674,12 +4539,35 @@ def page_agenda():
             options = list(zip(ids, labels))
             sel = st.selectbox("Escolha um compromisso público", options=options, format_func=lambda x: x[1], key="pub_sel")
             if sel:
-                _event_detail_form(int(sel[0]))
+                _event_detail_form(int(sel[0]), scope="public")
+
+    _agenda_ics_ui()
 
 # ====================== Layout principal ======================
+PAGES: List[Tuple[str, Callable[[], None]]] = [
+    ("Home", page_home),
+    ("Receitas e Despesas", page_receitas_despesas),
+    ("Extratos", page_extratos),
+    ("Conciliação", page_conciliacao),
+    ("Relatórios e Dashboard", page_relatorios),
+    ("Agenda", page_agenda),
+    ("Configurações", page_configuracoes),
+]
+
+# Widgets com estes prefixos guardam o valor mesmo quando a página não é desenhada (modo lazy)
+_PERSISTED_WIDGET_PREFIXES = ("flt_", "ext_", "rd_", "ag_")
+
+def _keep_widget_state():
+    # O Streamlit descarta o estado de widgets que não aparecem numa execução; reatribuir
+    # o valor no início da execução o mantém para quando a página voltar a ser exibida.
+    for k in list(st.session_state.keys()):
+        if isinstance(k, str) and k.startswith(_PERSISTED_WIDGET_PREFIXES):
+            st.session_state[k] = st.session_state[k]
+
 def main():
     init_db()
-    seed_minimums()
+    _ics_server()
+    render_notifications()
     top_ticker()
 
     st.markdown(f"### {PAGE_TITLE}")
@@ -1687,23 +4575,22 @@ def main():
     signup_widget()
     logged = login_widget()
     if not logged:
+        settle_notifications()
         st.stop()
 
-    tabs = st.tabs(["Home", "Receitas e Despesas", "Extratos", "Conciliação", "Relatórios e Dashboard", "Agenda", "Configurações"])
-    with tabs[0]:
-        page_home()
-    with tabs[1]:
-        page_receitas_despesas()
-    with tabs[2]:
-        page_extratos()
-    with tabs[3]:
-        page_conciliacao()
-    with tabs[4]:
-        page_relatorios()
-    with tabs[5]:
-        page_agenda()
-    with tabs[6]:
-        page_configuracoes()
+    labels = [label for label, _ in PAGES]
+    if NAV_MODE == "tabs":
+        tabs = st.tabs(labels)
+        for tab, (label, page) in zip(tabs, PAGES):
+            with tab, trace_span("page", label):
+                page()
+    else:
+        _keep_widget_state()
+        choice = st.radio("Página", labels, horizontal=True, key="nav_page", label_visibility="collapsed")
+        with trace_span("page", choice):
+            dict(PAGES)[choice]()
+
+    settle_notifications()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,198 @@
+# benchmarks/generate_data.py — banco sintético do FinApp para testes de volume e de carga
+# Uso: python benchmarks/generate_data.py --db /tmp/carga.db [--transactions 1M] [--events 20k] [--users 50]
+#
+# Cria (ou completa) o banco pelas migrações do app e preenche accounts, categories, sectors,
+# users, transactions e calendar_events. As escritas passam pela fila de escrita do app em lotes
+# `bulk`, com os triggers (monthly_rollup, checkpoints de saldo) ativos como em produção, e as
+# ocorrências da agenda são materializadas como no cadastro pela tela.
+#
+# Contagens aceitam sufixo: 10k, 2.5M. Pesos no formato "paid=55,planned=15,...".
+
+import os
+import sys
+import time
+import argparse
+from datetime import date, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlit import config as st_config  # noqa: E402
+from streamlit import logger as st_logger  # noqa: E402
+
+st_config.set_option("global.showWarningOnDirectExecution", False)
+st_logger.set_log_level("error")
+
+import app  # noqa: E402
+
+TYPES = "expense=45,income=25,card=10,tax=8,payroll=7,transfer=5"
+STATUSES = "paid=55,reconciled=20,planned=15,overdue=7,canceled=3"
+RULES = "monthly=5,weekly=3,yearly=1,daily=1"
+ACCOUNT_TYPES = ("bank", "bank", "cash", "card")
+CATEGORY_KINDS = ("expense", "expense", "expense", "income", "tax", "payroll")
+WORDS = ("Aluguel", "Energia", "Internet", "Fornecedor", "Cliente", "Serviço", "Material", "Frete", "Salário",
+         "Imposto", "Tarifa", "Reembolso", "Consultoria", "Manutenção", "Licença", "Venda", "Compra", "Taxa")
+PARTIES = ("ACME Ltda", "Silva & Filhos", "Mercado Central", "Posto Rota", "TechNet", "Gráfica Sol",
+           "Transportes BR", "Clínica Vida", "Padaria Pão Bom", "Escritório Lima", None)
+
+
+def count(s: str) -> int:
+    """'10k' -> 10000, '2.5M' -> 2500000."""
+    s = s.strip().lower()
+    mult = {"k": 1_000, "m": 1_000_000}.get(s[-1:], 1)
+    return int(float(s[:-1] if mult > 1 else s) * mult)
+
+
+def weights(spec: str) -> tuple:
+    """'a=3,b=1' -> (['a', 'b'], [0.75, 0.25])."""
+    pairs = [p.split("=") for p in spec.split(",") if p.strip()]
+    names = [k.strip() for k, _ in pairs]
+    w = np.array([float(v) for _, v in pairs])
+    return names, w / w.sum()
+
+
+def _insert_many(sql: str, rows: list, tables: tuple) -> None:
+    app._db_write(lambda conn: conn.executemany(sql, rows), tables=tables, bulk=True)
+
+
+def seed_dimensions(args, rng) -> dict:
+    """Contas, categorias, setores e usuários; devolve os ids para sortear nos lançamentos."""
+    _insert_many("INSERT INTO accounts (name, type, institution, number) VALUES (?,?,?,?)", [
+        (f"Conta {i + 1:03d}", ACCOUNT_TYPES[i % len(ACCOUNT_TYPES)], f"Banco {i % 7 + 1}", f"{1000 + i}-{i % 10}")
+        for i in range(args.accounts)
+    ], ("accounts",))
+    _insert_many("INSERT INTO categories (name, kind) VALUES (?,?)", [
+        (f"{WORDS[i % len(WORDS)]} {i + 1:03d}", CATEGORY_KINDS[i % len(CATEGORY_KINDS)]) for i in range(args.categories)
+    ], ("categories",))
+    _insert_many("INSERT OR IGNORE INTO sectors (name) VALUES (?)", [
+        (f"Setor {i + 1:02d}",) for i in range(args.sectors)
+    ], ("sectors",))
+
+    ids = {t: [int(x) for x in app.fetch_df(f"SELECT id FROM {t}")["id"]] for t in ("accounts", "categories")}
+    ids["sectors"] = list(app.fetch_df("SELECT name FROM sectors")["name"])
+
+    pwd = app.hash_password(args.password)
+    stamp = int(time.time())
+    users = []
+    for i in range(args.users):
+        role = "manager" if i % 5 == 0 else "launcher"
+        acc = None if role == "manager" else int(rng.choice(ids["accounts"]))
+        sectors = ",".join(rng.choice(ids["sectors"], size=min(2, len(ids["sectors"])), replace=False)) if ids["sectors"] else ""
+        users.append((f"Usuário {i + 1}", f"carga{stamp}.{i + 1}@finapp.local", pwd, role, acc, sectors))
+    _insert_many("INSERT INTO users (name, email, password_hash, role, account_id, sectors, is_active) "
+                 "VALUES (?,?,?,?,?,?,1)", users, ("users",))
+    ids["users"] = [int(x) for x in app.fetch_df("SELECT id FROM users")["id"]]
+    return ids
+
+
+def _dates(rng, n: int, first: date, days: int) -> np.ndarray:
+    base = np.datetime64(first, "D")
+    return (base + rng.integers(0, days, size=n).astype("timedelta64[D]")).astype(str)
+
+
+def seed_transactions(args, rng, ids: dict) -> None:
+    types, type_w = weights(args.types)
+    statuses, status_w = weights(args.statuses)
+    today = date.today()
+    first = today - timedelta(days=int(365 * args.years))
+    days = (today - first).days + args.future_days
+    sectors = np.array(ids["sectors"] + [None], dtype=object)
+    words, parties = np.array(WORDS, dtype=object), np.array(PARTIES, dtype=object)
+    sql = ("INSERT INTO transactions (trx_date, due_date, paid_date, type, sector, category_id, account_id, "
+           "counterparty, description, amount, status, origin) VALUES (?,?,?,?,?,?,?,?,?,?,?,'manual')")
+
+    done, t0 = 0, time.perf_counter()
+    while done < args.transactions:
+        n = min(args.batch, args.transactions - done)
+        trx = _dates(rng, n, first, days)
+        st_ = rng.choice(statuses, size=n, p=status_w)
+        paid = np.where(np.isin(st_, ("paid", "reconciled")), trx, None)
+        desc = words[rng.integers(0, len(words), n)] + " #" + rng.integers(1, 10_000, n).astype(str).astype(object)
+        amount = np.round(np.exp(rng.normal(5.5, 1.3, n)), 2)   # log-normal: muitos valores pequenos, poucos grandes
+        rows = list(zip(
+            trx, trx, paid, rng.choice(types, size=n, p=type_w), sectors[rng.integers(0, len(sectors), n)],
+            rng.choice(ids["categories"], size=n).tolist(), rng.choice(ids["accounts"], size=n).tolist(),
+            parties[rng.integers(0, len(parties), n)], desc, amount.tolist(), st_,
+        ))
+        _insert_many(sql, rows, ("transactions",))
+        done += n
+        dt = time.perf_counter() - t0
+        print(f"  transactions: {done:>10,} / {args.transactions:,}  ({done / dt:,.0f} linhas/s)".replace(",", "."))
+
+
+def seed_events(args, rng, ids: dict) -> None:
+    rules, rule_w = weights(args.rules)
+    today = date.today()
+    first = today - timedelta(days=int(365 * args.years))
+    days = (today - first).days + args.future_days
+    with app._connect() as conn:
+        col = app._calendar_date_col_of(conn)
+    sql = (f"INSERT INTO calendar_events (title, description, {col}, is_recurring, recur_rule, recur_until, "
+           f"is_public, created_by) VALUES (?,?,?,?,?,?,?,?)")
+
+    def _write(conn, rows):
+        new_ids = [conn.execute(sql, r).lastrowid for r in rows]
+        return app._materialize_occurrences(conn, new_ids)
+
+    done, t0 = 0, time.perf_counter()
+    while done < args.events:
+        n = min(args.batch, args.events - done)
+        base = _dates(rng, n, first, days)
+        recurring = rng.random(n) < args.recurring
+        rule = np.where(recurring, rng.choice(rules, size=n, p=rule_w), None)
+        # um terço das recorrentes tem data final, entre 1 mês e 3 anos depois da base
+        until = base.astype("datetime64[D]") + rng.integers(30, 3 * 365, n).astype("timedelta64[D]")
+        until = np.where(recurring & (rng.random(n) < 1 / 3), until.astype(str), None)
+        rows = list(zip(
+            [f"{WORDS[i % len(WORDS)]} {i}" for i in rng.integers(0, 100_000, n)], [None] * n, base,
+            recurring.astype(int).tolist(), rule, until, (rng.random(n) < 0.3).astype(int).tolist(),
+            rng.choice(ids["users"], size=n).tolist(),
+        ))
+        app._db_write(lambda conn: _write(conn, rows), tables=("calendar_events",), bulk=True)
+        done += n
+        dt = time.perf_counter() - t0
+        print(f"  calendar_events: {done:>8,} / {args.events:,}  ({done / dt:,.0f} eventos/s)".replace(",", "."))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="generate_data.py", description="Gera um banco sintético do FinApp.")
+    parser.add_argument("--db", required=True, help="arquivo SQLite a criar/completar (nunca o finapp.db de produção)")
+    parser.add_argument("--transactions", type=count, default=count("100k"))
+    parser.add_argument("--events", type=count, default=count("5k"))
+    parser.add_argument("--users", type=count, default=20)
+    parser.add_argument("--accounts", type=int, default=6)
+    parser.add_argument("--categories", type=int, default=30)
+    parser.add_argument("--sectors", type=int, default=8)
+    parser.add_argument("--years", type=float, default=3, help="espalhamento das datas para trás (anos)")
+    parser.add_argument("--future-days", type=int, default=90, help="lançamentos/eventos até N dias à frente")
+    parser.add_argument("--types", default=TYPES, help=f"pesos dos tipos (padrão: {TYPES})")
+    parser.add_argument("--statuses", default=STATUSES, help=f"pesos dos status (padrão: {STATUSES})")
+    parser.add_argument("--recurring", type=float, default=0.3, help="fração de eventos recorrentes")
+    parser.add_argument("--rules", default=RULES, help=f"pesos das regras de recorrência (padrão: {RULES})")
+    parser.add_argument("--password", default="carga123", help="senha dos usuários gerados")
+    parser.add_argument("--batch", type=count, default=count("20k"), help="linhas por transação de escrita")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    if os.path.abspath(args.db) == os.path.abspath(os.path.join(app.BASE_DIR, "finapp.db")):
+        parser.error("use um arquivo separado para dados sintéticos")
+    app.DB_PATH = args.db
+    app.init_db()
+    rng = np.random.default_rng(args.seed)
+
+    t0 = time.perf_counter()
+    ids = seed_dimensions(args, rng)
+    print(f"Cadastros: {len(ids['accounts'])} contas, {len(ids['categories'])} categorias, "
+          f"{len(ids['sectors'])} setores, {len(ids['users'])} usuários (senha: {args.password})")
+    if args.transactions:
+        seed_transactions(args, rng, ids)
+    if args.events:
+        seed_events(args, rng, ids)
+    app._db_write(lambda conn: conn.execute("ANALYZE;"), tables=())
+    print(f"Pronto em {time.perf_counter() - t0:.1f}s: {args.db}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+# benchmarks/load_test.py — teste de carga headless do FinApp com o AppTest do Streamlit
+# Uso: python benchmarks/load_test.py --db /tmp/carga.db [--sessions 8] [--iterations 20]
+#                                     [--pages "Home,Extratos"] [--writers 1 --write-rate 20] [--json out.json]
+#
+# Cada sessão simulada é um AppTest próprio, logado como um usuário do banco, que navega pelas
+# páginas em rodízio. As sessões rodam em processos separados: o AppTest troca um Runtime global
+# a cada execução, então duas sessões em threads do mesmo processo se atropelam. Cada processo
+# tem seus próprios caches e sua fila de escrita, como vários servidores sobre o mesmo arquivo.
+# Os escritores externos gravam lançamentos por conexões próprias e medem quanto esperam pelo
+# lock de escrita (BEGIN IMMEDIATE) enquanto as sessões navegam.
+#
+# Gere o banco antes com benchmarks/generate_data.py; ele é usado no lugar (não é copiado).
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "app.py")
+PERCENTILES = (50, 90, 99)
+
+
+def _user_session(db: str, role: str, offset: int) -> dict:
+    """Mesmo dicionário que o login_widget guarda em session_state['user']."""
+    with sqlite3.connect(db) as conn:
+        rows = conn.execute(
+            "SELECT id, name, email, role, account_id, sectors FROM users "
+            "WHERE is_active = 1 AND role = ? ORDER BY id", (role,)
+        ).fetchall()
+    if not rows:
+        raise SystemExit(f"nenhum usuário ativo com role={role} em {db} (rode generate_data.py)")
+    uid, name, email, role, acc, sectors = rows[offset % len(rows)]
+    return {"id": uid, "name": name, "email": email, "role": role, "account_id": acc,
+            "sectors": [s.strip() for s in str(sectors or "").split(",") if s.strip()]}
+
+
+def _errors(at) -> list:
+    return [str(e.value).splitlines()[0] for e in at.exception]
+
+
+def _setup_env(args) -> None:
+    # O app lê estas variáveis ao ser carregado pelo AppTest
+    os.environ["FINAPP_DB_PATH"] = os.path.abspath(args.db)
+    os.environ["FINAPP_NAV_MODE"] = "lazy"
+    if args.journal_mode:
+        os.environ["FINAPP_JOURNAL_MODE"] = args.journal_mode
+    logging.disable(logging.WARNING)
+
+
+def run_session(sid: int, args, pages: list) -> list:
+    """Uma sessão (num processo próprio): [(página, segundos, erros)]."""
+    _setup_env(args)
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_FILE, default_timeout=args.timeout)
+    at.run()
+    at.session_state["user"] = _user_session(args.db, args.role, sid)
+    t0 = time.perf_counter()
+    at.run()
+    local = [("(login)", time.perf_counter() - t0, _errors(at))]
+    for i in range(args.iterations):
+        page = pages[(sid + i) % len(pages)]
+        at.radio(key="nav_page").set_value(page)
+        t0 = time.perf_counter()
+        at.run()
+        local.append((page, time.perf_counter() - t0, _errors(at)))
+        if args.think:
+            time.sleep(random.uniform(0, 2 * args.think))
+    return local
+
+
+def run_writer(args, stop: threading.Event, waits: list, lock: threading.Lock) -> None:
+    conn = sqlite3.connect(args.db, timeout=60, isolation_level=None)
+    accounts = [r[0] for r in conn.execute("SELECT id FROM accounts")] or [None]
+    local, today = [], date.today()
+    while not stop.is_set():
+        time.sleep(random.expovariate(args.write_rate))
+        t0 = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE;")
+        local.append(time.perf_counter() - t0)
+        d = (today - timedelta(days=random.randint(0, 365))).isoformat()
+        conn.execute(
+            "INSERT INTO transactions (trx_date, type, description, amount, status, account_id, origin) "
+            "VALUES (?, ?, 'carga', ?, 'paid', ?, 'manual')",
+            (d, random.choice(("income", "expense")), round(random.uniform(1, 5000), 2), random.choice(accounts)),
+        )
+        conn.execute("COMMIT;")
+    conn.close()
+    with lock:
+        waits.extend(local)
+
+
+def _summary(values) -> dict:
+    a = np.asarray(values, dtype="float64") * 1000
+    if not len(a):
+        return {"n": 0}
+    out = {"n": int(len(a)), "mean_ms": float(a.mean()), "max_ms": float(a.max())}
+    for p, v in zip(PERCENTILES, np.percentile(a, PERCENTILES)):
+        out[f"p{p}_ms"] = float(v)
+    return out
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="load_test.py", description="Teste de carga do FinApp com N sessões simuladas.")
+    parser.add_argument("--db", required=True, help="banco gerado por generate_data.py")
+    parser.add_argument("--sessions", type=int, default=4, help="sessões simultâneas (um processo cada)")
+    parser.add_argument("--iterations", type=int, default=10, help="páginas visitadas por sessão")
+    parser.add_argument("--pages", default="", help="páginas separadas por vírgula (padrão: todas do menu)")
+    parser.add_argument("--role", choices=("manager", "launcher"), default="manager")
+    parser.add_argument("--think", type=float, default=0.0, help="pausa média entre páginas (s)")
+    parser.add_argument("--writers", type=int, default=0, help="escritores externos gravando lançamentos")
+    parser.add_argument("--write-rate", type=float, default=10.0, help="escritas por segundo por escritor")
+    parser.add_argument("--journal-mode", choices=("wal", "delete"), default=None, help="FINAPP_JOURNAL_MODE do app")
+    parser.add_argument("--timeout", type=float, default=120.0, help="limite por execução do script (s)")
+    parser.add_argument("--json", help="grava o resultado em JSON")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} não existe (rode benchmarks/generate_data.py)")
+    _setup_env(args)
+    sys.path.insert(0, ROOT)
+    from streamlit import config as st_config
+    st_config.set_option("global.showWarningOnDirectExecution", False)
+    import app
+    app.init_db()   # migrações uma vez, antes das sessões
+    pages = [p.strip() for p in args.pages.split(",") if p.strip()] or [label for label, _ in app.PAGES]
+    unknown = set(pages) - {label for label, _ in app.PAGES}
+    if unknown:
+        parser.error(f"página(s) desconhecida(s): {', '.join(sorted(unknown))}")
+
+    results, waits, lock, stop = [], [], threading.Lock(), threading.Event()
+    writers = [threading.Thread(target=run_writer, args=(args, stop, waits, lock), daemon=True)
+               for _ in range(args.writers)]
+    t0 = time.perf_counter()
+    for t in writers:
+        t.start()
+    try:
+        with ProcessPoolExecutor(max_workers=args.sessions, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for local in pool.map(run_session, range(args.sessions), [args] * args.sessions, [pages] * args.sessions):
+                results.extend(local)
+    finally:
+        stop.set()
+        for t in writers:
+            t.join()
+    elapsed = time.perf_counter() - t0
+
+    report = {"db": args.db, "sessions": args.sessions, "iterations": args.iterations, "writers": args.writers,
+              "elapsed_s": elapsed, "pages": {}, "lock_waits": _summary(waits)}
+    print(f"{args.sessions} sessão(ões) x {args.iterations} página(s), {args.writers} escritor(es), {elapsed:.1f}s")
+    print(f"{'página':<26}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'máx ms':>10}{'erros':>7}")
+    for page in ["(login)"] + pages:
+        rows = [r for r in results if r[0] == page]
+        if not rows:
+            continue
+        s = _summary([r[1] for r in rows])
+        s["errors"] = sum(1 for r in rows if r[2])
+        s["first_error"] = next((r[2][0] for r in rows if r[2]), None)
+        report["pages"][page] = s
+        print(f"{page:<26}{s['n']:>5}{s['p50_ms']:>10.0f}{s['p90_ms']:>10.0f}{s['p99_ms']:>10.0f}"
+              f"{s['max_ms']:>10.0f}{s['errors']:>7}")
+    lw = report["lock_waits"]
+    if lw["n"]:
+        print(f"espera pelo lock de escrita: {lw['n']} escritas, p50 {lw['p50_ms']:.1f} ms, "
+              f"p99 {lw['p99_ms']:.1f} ms, máx {lw['max_ms']:.1f} ms")
+    for page, s in report["pages"].items():
+        if s["first_error"]:
+            print(f"  {page}: {s['first_error']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if any(p["errors"] for p in report["pages"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# benchmarks/recurrence.py — custo da expansão de recorrências da agenda por idade do evento
+# Uso: python benchmarks/recurrence.py [--events 10000] [--repeat 5]
+#
+# Mede occurrences_between() (fórmula fechada, vetorizada) para eventos criados há 0..50 anos,
+# consultando o mês corrente. O tempo por evento deve ficar constante com a idade; a coluna
+# "passo a passo" mostra, para comparação, o laço que anda da data base até o mês pedido.
+
+import os
+import sys
+import time
+import argparse
+from datetime import date, timedelta
+from calendar import monthrange
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlit import config as st_config  # noqa: E402
+from streamlit import logger as st_logger  # noqa: E402
+
+st_config.set_option("global.showWarningOnDirectExecution", False)
+st_logger.set_log_level("error")
+
+import app  # noqa: E402
+
+RULES = ["daily", "weekly", "monthly", "yearly"]
+AGES_YEARS = [0, 1, 10, 50]
+
+
+def _stepwise(base: date, rule: str, start: date, end: date) -> int:
+    """Expansão ingênua: anda da base até o fim do intervalo (referência, sem limite de passos)."""
+    n, cur = 0, base
+    while cur <= end:
+        if cur >= start:
+            n += 1
+        if rule == "daily":
+            cur += timedelta(days=1)
+        elif rule == "weekly":
+            cur += timedelta(weeks=1)
+        else:
+            k = 1 if rule == "monthly" else 12
+            y, m = divmod(cur.month - 1 + k, 12)
+            y, m = cur.year + y, m + 1
+            cur = date(y, m, min(base.day, monthrange(y, m)[1]))
+    return n
+
+
+def _best(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="recurrence.py", description="Custo da expansão de recorrências por idade do evento.")
+    parser.add_argument("--events", type=int, default=10000, help="eventos por idade (vetorizado)")
+    parser.add_argument("--single", type=int, default=300, help="eventos chamados um a um / passo a passo")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    today = date.today()
+    start, end = date(today.year, today.month, 1), date(today.year, today.month, monthrange(today.year, today.month)[1])
+    rng = np.random.default_rng(42)
+
+    print(f"Mês consultado: {start:%Y-%m}  |  {args.events} eventos por idade, regras misturadas")
+    print(f"{'idade':>8} {'vetorizado':>16} {'um a um':>14} {'passo a passo':>16} {'ocorrências':>12}")
+    for age in AGES_YEARS:
+        offsets = rng.integers(0, 365, size=args.events)
+        bases = np.datetime64(today - timedelta(days=365 * age), "D") - offsets.astype("timedelta64[D]")
+        rules = [RULES[i % len(RULES)] for i in range(args.events)]
+        untils = np.full(args.events, np.datetime64("NaT"), dtype="datetime64[D]")
+
+        vec = _best(lambda: app.occurrences_between(bases, rules, untils, start, end), args.repeat)
+        occ = len(app.occurrences_between(bases, rules, untils, start, end)[0])
+
+        k = min(args.single, args.events)
+        one = _best(lambda: [app.occurrences_between(bases[i:i + 1], rules[i:i + 1], untils[i:i + 1], start, end)
+                             for i in range(k)], args.repeat)
+        py_bases = bases[:k].astype(object)
+        step = _best(lambda: [_stepwise(py_bases[i], rules[i], start, end) for i in range(k)], 1)
+
+        print(f"{age:>6} a {vec / args.events * 1e6:>11.2f} µs/ev {one / k * 1e6:>9.1f} µs/ev "
+              f"{step / k * 1e6:>11.1f} µs/ev {occ:>12}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
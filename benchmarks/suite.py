@@ -0,0 +1,225 @@
+# benchmarks/suite.py — micro-benchmarks das funções e consultas quentes do FinApp
+# Uso: python benchmarks/suite.py [--sizes 10k,100k] [--only fetch_df,money] [--save base.json]
+#      python benchmarks/suite.py --compare base.json [--threshold 0.15]
+#
+# Cada tamanho tem seu banco gerado por generate_data.py (reaproveitado entre execuções, em
+# --workdir) e roda num processo próprio, com os caches do app zerados. Cada caso é calibrado
+# como no timeit (laços até passar de --min-time) e repetido --rounds vezes; vale a mediana.
+# Casos marcados [frio] invalidam o cache de consultas antes de cada chamada.
+#
+# --save grava o resultado em JSON (linha de base); --compare lê uma linha de base e sai com
+# código 1 se algum caso ficar mais lento que ela além de --threshold.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate_data  # noqa: E402
+
+
+def measure(fn, rounds: int, min_time: float) -> dict:
+    """Tempo por chamada: mediana/mínimo de `rounds` rodadas de `loops` chamadas cada."""
+    fn()  # aquecimento (conexões, statements preparados, imports tardios)
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10 if dt < min_time / 10 else 2
+    times = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        times.append((time.perf_counter() - t0) / loops)
+    return {"median_s": statistics.median(times), "min_s": min(times), "stdev_s": statistics.pstdev(times),
+            "rounds": rounds, "loops": loops}
+
+
+def _db_cases(app, st) -> dict:
+    """Casos que dependem do banco; as consultas usam a conta e o mês com mais movimento."""
+    import pandas as pd
+
+    users = app.fetch_df("SELECT id, name, email, role FROM users WHERE role = 'manager' ORDER BY id LIMIT 1")
+    u = users.iloc[0]
+    st.session_state["user"] = {"id": int(u["id"]), "name": u["name"], "email": u["email"], "role": "manager",
+                                "account_id": None, "sectors": []}
+    acc = int(app.fetch_df("SELECT account_id, COUNT(*) AS n FROM transactions GROUP BY 1 ORDER BY 2 DESC LIMIT 1").iloc[0, 0])
+    tid = int(app.fetch_df("SELECT MAX(id) FROM transactions").iloc[0, 0])
+    today = date.today()
+    ini, fim = date(today.year, 1, 1).isoformat(), today.isoformat()
+    q, p = app._extrato_query(acc, ini, fim, 0, limit=101)
+    lq, lp = app._lancamentos_query(ini, fim, limit=5000)
+    export_df = app.fetch_df(lq, tuple(lp))
+    table_df = export_df.head(200)
+
+    col = app.cal_date_col()
+    events = app.fetch_df(f"SELECT id, title, {col} AS ev_date, is_recurring, recur_rule, recur_until FROM calendar_events")
+    month_start = date(today.year, today.month, 1)
+    month_end = (pd.Timestamp(month_start) + pd.offsets.MonthEnd(0)).date()
+
+    def cold(fn, *tables):
+        def run():
+            app._bump_generation(tables)
+            return fn()
+        return run
+
+    return {
+        "fetch_df[cache]": lambda: app.fetch_df(q, tuple(p)),
+        "fetch_df[frio]": cold(lambda: app.fetch_df(q, tuple(p)), "transactions"),
+        "exec_sql[update]": lambda: app.exec_sql("UPDATE transactions SET description = description WHERE id = ?", (tid,)),
+        "get_month_events[cache]": lambda: app.get_month_events(today.year, today.month, scope="mine"),
+        "get_month_events[frio]": cold(lambda: app.get_month_events(today.year, today.month, scope="mine"),
+                                       "calendar_events"),
+        "_expand_event_occurrences": lambda: app._expand_event_occurrences(events, month_start, month_end),
+        "_fluxo_caixa_df[frio]": cold(app._fluxo_caixa_df, "transactions"),
+        "kpis_cards[frio]": cold(app.kpis_cards, "transactions"),
+        "show_df[200]": lambda: app.show_df(table_df),
+        "export_excel[5k]": lambda: app._df_xlsx_bytes(export_df),
+        "export_csv[5k]": lambda: app._df_csv_bytes(export_df),
+    }
+
+
+def _pure_cases(app) -> dict:
+    """Casos que não dependem do banco (rodam uma vez, sem tamanho)."""
+    import numpy as np
+    import pandas as pd
+
+    values = pd.Series(np.round(np.random.default_rng(1).normal(0, 50_000, 10_000), 2))
+    typed = app.money_series(values, symbol=False).tolist()
+    return {
+        "money[10k]": lambda: [app.money(v) for v in values],
+        "money_series[10k]": lambda: app.money_series(values),
+        "money_input[10k]": lambda: [app.parse_money_cents(s) for s in typed],   # o parser do money_input
+    }
+
+
+def run_size(label: str, db: str, opts: dict) -> dict:
+    """Roda os casos num processo novo apontado para `db`; {caso@tamanho: medida}."""
+    from streamlit import config as st_config
+    from streamlit import logger as st_logger
+    st_config.set_option("global.showWarningOnDirectExecution", False)
+    st_logger.set_log_level("error")
+    import streamlit as st
+    import app
+
+    app.DB_PATH = db
+    app.init_db()
+    cases = {f"{k}@{label}": v for k, v in _db_cases(app, st).items()}
+    if opts["pure"]:
+        cases.update(_pure_cases(app))
+    out = {}
+    for name, fn in cases.items():
+        if opts["only"] and not any(o in name for o in opts["only"]):
+            continue
+        out[name] = measure(fn, opts["rounds"], opts["min_time"])
+        print(f"  {name:<42} {_fmt(out[name]['median_s']):>10}", flush=True)
+    return out
+
+
+def _fmt(seconds: float) -> str:
+    for unit, k in (("s", 1), ("ms", 1e3), ("µs", 1e6)):
+        if seconds * k >= 1 or unit == "µs":
+            return f"{seconds * k:.2f} {unit}"
+
+
+def _meta() -> dict:
+    import sqlite3
+    import numpy
+    import pandas
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                             text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        rev = None
+    return {"when": datetime.now().isoformat(timespec="seconds"), "git": rev, "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version, "numpy": numpy.__version__, "pandas": pandas.__version__,
+            "machine": f"{platform.system()} {platform.machine()} ({os.cpu_count()} CPUs)"}
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> int:
+    """Tabela caso a caso contra a linha de base; devolve quantos casos regrediram."""
+    regressions = 0
+    print(f"\n{'caso':<42} {'base':>10} {'atual':>10} {'Δ':>8}")
+    for name, cur in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<42} {'—':>10} {_fmt(cur['median_s']):>10} {'novo':>8}")
+            continue
+        delta = cur["median_s"] / base["median_s"] - 1
+        flag = ""
+        if delta > threshold:
+            flag, regressions = "  REGRESSÃO", regressions + 1
+        elif delta < -threshold:
+            flag = "  melhorou"
+        print(f"{name:<42} {_fmt(base['median_s']):>10} {_fmt(cur['median_s']):>10} {delta:>+7.0%}{flag}")
+    print(f"\nlinha de base: {baseline['meta'].get('git')} em {baseline['meta'].get('when')}; "
+          f"limite {threshold:.0%}; {regressions} regressão(ões)")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="suite.py", description="Micro-benchmarks do FinApp com linha de base em JSON.")
+    parser.add_argument("--sizes", default="10k,100k", help="lançamentos por banco gerado (ex.: 10k,100k,1M)")
+    parser.add_argument("--only", default="", help="só os casos cujo nome contém um destes textos (vírgulas)")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.05, help="duração mínima de cada rodada (s)")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "finapp-bench"),
+                        help="onde ficam os bancos gerados")
+    parser.add_argument("--regen", action="store_true", help="gera os bancos de novo")
+    parser.add_argument("--save", help="grava o resultado (linha de base) neste JSON")
+    parser.add_argument("--compare", help="compara com a linha de base deste JSON")
+    parser.add_argument("--threshold", type=float, default=0.15, help="aumento relativo que conta como regressão")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    only = [o.strip() for o in args.only.split(",") if o.strip()]
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for i, label in enumerate(sizes):
+        n = generate_data.count(label)
+        db = os.path.join(args.workdir, f"bench-{n}.db")
+        if args.regen and os.path.exists(db):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db + suffix):
+                    os.remove(db + suffix)
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            if not os.path.exists(db):
+                print(f"Gerando {db} ({n:,} lançamentos)...".replace(",", "."), flush=True)
+                pool.submit(generate_data.main, ["--db", db, "--transactions", str(n),
+                                                 "--events", str(max(100, n // 20))]).result()
+            print(f"[{label}] {db}", flush=True)
+            opts = {"pure": i == 0, "only": only, "rounds": args.rounds, "min_time": args.min_time}
+            results.update(pool.submit(run_size, label, db, opts).result())
+
+    current = {"meta": _meta(), "sizes": sizes, "results": results}
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"Linha de base gravada em {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        return 1 if compare(current, baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+# manage.py — tarefas de manutenção do FinApp pela linha de comando
+# Uso: python manage.py [--db caminho/finapp.db] <comando>
+#   check-plans      falha (exit 1) se alguma consulta quente cair em SCAN de tabela
+#   check-downloads  falha (exit 1) se algum download sob demanda gerar um tipo que o Streamlit recusa
+#   check-reconciliation  concilia um par num banco temporário; falha se os totais dos painéis mudarem
+#   rebuild-rollup   recalcula o monthly_rollup a partir de transactions
+#   rebuild-fts      reindexa a busca textual (transactions_fts) a partir de transactions
+#   export           exporta lançamentos (CSV/XLSX pela extensão de --out) em blocos
+#   import           importa extratos CSV/OFX numa conta (duplicados ignorados por external_id)
+#   attachments-gc   remove anexos (blobs) que nenhum lançamento referencia
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+from streamlit import config as st_config
+from streamlit import logger as st_logger
+
+# Importar o app fora do `streamlit run` gera avisos de "bare mode"/"missing ScriptRunContext"
+st_config.set_option("global.showWarningOnDirectExecution", False)
+st_logger.set_log_level("error")
+
+import app  # noqa: E402
+
+
+def cmd_check_plans(args) -> int:
+    problems = app.check_query_plans()
+    for p in problems:
+        print(f"SCAN  {p}")
+    if problems:
+        print(f"{len(problems)} consulta(s) quente(s) sem índice.")
+        return 1
+    print("OK: todas as consultas quentes usam índice.")
+    return 0
+
+
+def cmd_check_downloads(args) -> int:
+    problems = app.check_downloads()
+    for p in problems:
+        print(f"FALHA {p}")
+    if problems:
+        print(f"{len(problems)} download(s) com problema.")
+        return 1
+    print("OK: todos os downloads geram bytes aceitos pelo st.download_button.")
+    return 0
+
+
+def cmd_check_reconciliation(args) -> int:
+    problems = app.check_reconciliation_totals()
+    for p in problems:
+        print(f"FALHA {p}")
+    if problems:
+        return 1
+    print("OK: conciliar não altera KPIs, fluxo de caixa nem resumo por categoria.")
+    return 0
+
+
+def cmd_rebuild_rollup(args) -> int:
+    app.rebuild_monthly_rollup()
+    n = app.fetch_df("SELECT COUNT(*) AS n FROM monthly_rollup").iloc[0, 0]
+    print(f"monthly_rollup reconstruído: {n} linha(s).")
+    return 0
+
+
+def cmd_rebuild_fts(args) -> int:
+    app.rebuild_search_index()
+    print("transactions_fts reindexado.")
+    return 0
+
+
+def cmd_export(args) -> int:
+    q, params = app._lancamentos_query(args.de, args.ate, args.tipo, args.status)
+    writer = app.write_xlsx_export if args.out.lower().endswith(".xlsx") else app.write_csv_export
+    with open(args.out, "wb") as f:
+        n = writer(q, tuple(params), f)
+    print(f"{n} linha(s) exportada(s) para {args.out}.")
+    return 0
+
+
+def cmd_import(args) -> int:
+    # Colunas passadas na linha de comando substituem só as suas; as demais vêm do cabeçalho
+    overrides = {k: v for k, v in {"date": args.date_col, "amount": args.amount_col,
+                                   "description": args.desc_col, "id": args.id_col}.items() if v}
+    for path in args.files:
+        with open(path, "rb") as f:
+            mapping = None
+            if overrides and not path.lower().endswith(".ofx"):
+                mapping = {**app.guess_csv_mapping(app.csv_statement_header(f, args.encoding)[0]), **overrides}
+            stats = app.import_statement_file(f, path, args.account, mapping=mapping, encoding=args.encoding,
+                                              default_category_id=args.category)
+        print(app.import_summary(path, stats))
+    return 0
+
+
+def cmd_attachments_gc(args) -> int:
+    stats = app.collect_attachment_garbage(dry_run=args.dry_run, grace_s=args.grace)
+    verb = "seriam removido(s)" if args.dry_run else "removido(s)"
+    print(f"{stats['blobs']} blob(s), {stats['referenced']} referenciado(s); {stats['removed']} arquivo(s) {verb} "
+          f"({stats['freed_bytes'] / 1024 / 1024:.1f} MB).")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="manage.py", description="Manutenção do banco do FinApp.")
+    parser.add_argument("--db", default=app.DB_PATH, help="arquivo SQLite (padrão: $FINAPP_DB_PATH ou finapp.db ao lado do app.py)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    sub.add_parser("check-plans", help="EXPLAIN QUERY PLAN das consultas quentes").set_defaults(func=cmd_check_plans)
+    sub.add_parser("check-downloads", help="gera os downloads sob demanda como o st.download_button").set_defaults(
+        func=cmd_check_downloads)
+    # grava dados: roda sempre num banco temporário, nunca no --db
+    sub.add_parser("check-reconciliation", help="totais dos painéis antes/depois de conciliar (banco temporário)").set_defaults(
+        func=cmd_check_reconciliation, scratch=True)
+    sub.add_parser("rebuild-rollup", help="recalcula o monthly_rollup").set_defaults(func=cmd_rebuild_rollup)
+    sub.add_parser("rebuild-fts", help="reindexa a busca textual").set_defaults(func=cmd_rebuild_fts)
+
+    p = sub.add_parser("export", help="exporta lançamentos filtrados")
+    p.add_argument("--out", required=True, help="arquivo .csv ou .xlsx")
+    p.add_argument("--de", default="0000-01-01", help="data inicial (AAAA-MM-DD)")
+    p.add_argument("--ate", default="9999-12-31", help="data final (AAAA-MM-DD)")
+    p.add_argument("--tipo", default="Todos")
+    p.add_argument("--status", default="Todos")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("import", help="importa extratos CSV/OFX")
+    p.add_argument("files", nargs="+", help="arquivos .ofx ou .csv")
+    p.add_argument("--account", type=int, required=True, help="id da conta (accounts.id)")
+    p.add_argument("--category", type=int, default=None, help="categoria padrão (categories.id)")
+    p.add_argument("--encoding", default="utf-8-sig", help="codificação do CSV (ex.: cp1252)")
+    p.add_argument("--date-col", help="coluna de data do CSV (padrão: pelo cabeçalho)")
+    p.add_argument("--amount-col", help="coluna de valor do CSV")
+    p.add_argument("--desc-col", help="coluna de descrição do CSV")
+    p.add_argument("--id-col", help="coluna com o ID da transação no banco")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("attachments-gc", help="remove anexos sem referência")
+    p.add_argument("--dry-run", action="store_true", help="só lista o que seria removido")
+    p.add_argument("--grace", type=float, default=app.ATTACH_GC_GRACE_S,
+                   help="idade mínima (s) de um blob sem referência para ser removido")
+    p.set_defaults(func=cmd_attachments_gc)
+
+    args = parser.parse_args(argv)
+    scratch = tempfile.mkdtemp(prefix="finapp-check-") if getattr(args, "scratch", False) else None
+    app.DB_PATH = os.path.join(scratch, "finapp.db") if scratch else args.db
+    try:
+        app.init_db()
+        return args.func(args)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())